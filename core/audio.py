@@ -0,0 +1,140 @@
+"""
+Komomo System Core - Audio Buffer
+Version: v4.3.0
+
+[役割]
+マイクから取り込んだ音声を、録音の途中でも読み出せる形で保持するための部品。
+固定長の領域を使い回すリングバッファのため、録音中に配列の確保・連結を繰り返しません。
+
+[主な機能]
+- AudioRingBuffer : 書き込み総数（絶対位置）で範囲を指定して読み出せる float32 のリングバッファ
+- pcm16_to_float32 : マイクの16bit PCM を Whisper が受け取る float32（-1.0〜1.0）に変換
+- rms : 音量（実効値）の計算
+- resample : サンプリングレートの変換（マイクが 16kHz 以外の場合）
+- EnergyVAD : フレームごとの音量（RMS）とゼロ交差率（ZCR）をブロック単位でまとめて計算する発話検出
+  （ノイズフロアは録音のたびに測り直さず、聴取しながら追従させる）
+"""
+import threading
+
+import numpy as np
+
+
+def pcm16_to_float32(raw):
+    """16bit PCM（bytes）-> float32 の numpy 配列（bytes はコピーせずに読み、変換後の配列を1つだけ確保する）"""
+    samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32)
+    samples *= 1.0 / 32768.0
+    return samples
+
+
+def rms(samples):
+    """float32 音声の実効値（0.0〜1.0）"""
+    return float(np.sqrt(np.dot(samples, samples) / len(samples))) if len(samples) else 0.0
+
+
+def resample(samples, src_rate, dst_rate):
+    """線形補間によるサンプリングレート変換"""
+    if src_rate == dst_rate or not len(samples):
+        return samples
+    n_out = int(round(len(samples) * dst_rate / src_rate))
+    positions = np.arange(n_out, dtype=np.float32) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(len(samples), dtype=np.float32), samples).astype(np.float32)
+
+
+class EnergyVAD:
+    def __init__(self, sample_rate=16000, frame_seconds=0.02, threshold=0.008, margin=3.0,
+                 zcr_max=0.4, adapt_rate=0.05):
+        """
+        threshold  : 発話とみなす音量（RMS）の下限
+        margin     : ノイズフロアの何倍を超えたら発話とみなすか
+        zcr_max    : これよりゼロ交差率が高いフレームは雑音（サー音など）とみなす
+        adapt_rate : ノイズフロアが上がる方向への追従の速さ（下がる方向には即座に追従）
+        """
+        self.frame = max(2, int(sample_rate * frame_seconds))
+        self.min_threshold = threshold
+        self.margin = margin
+        self.zcr_max = zcr_max
+        self.adapt_rate = adapt_rate
+        self.noise_floor = None
+
+    @property
+    def threshold(self):
+        return max(self.min_threshold, (self.noise_floor or 0.0) * self.margin)
+
+    def _features(self, samples):
+        """ブロック内の全フレームの (RMS, ZCR) をまとめて計算する"""
+        n = len(samples) // self.frame
+        frames = np.asarray(samples[:n * self.frame], dtype=np.float32).reshape(n, self.frame)
+        energy = np.sqrt(np.einsum("ij,ij->i", frames, frames) / self.frame)
+        signs = np.signbit(frames)
+        zcr = np.count_nonzero(signs[:, 1:] != signs[:, :-1], axis=1) / (self.frame - 1)
+        return energy, zcr
+
+    def calibrate(self, samples):
+        """環境音だけの音声からノイズフロアを初期化する"""
+        energy, _ = self._features(samples)
+        if len(energy):
+            self.noise_floor = float(np.median(energy))
+
+    def analyze(self, samples):
+        """フレームごとの発話判定（bool 配列）を返し、ノイズフロアを更新する"""
+        energy, zcr = self._features(samples)
+        if not len(energy):
+            return np.zeros(0, dtype=bool)
+        speech = (energy > self.threshold) & (zcr < self.zcr_max)
+        # 最小値統計：ブロック内の静かなフレームの音量に追従する
+        # 発話中は上がる方向をごく緩やかにし、長い発話の途中で閾値が声に追いつかないようにする
+        # （雑音が大きくなって常に発話と判定され続けても、いずれは追従する）
+        level = float(np.percentile(energy, 10))
+        if self.noise_floor is None or level < self.noise_floor:
+            self.noise_floor = level
+        else:
+            rate = self.adapt_rate * (0.02 if speech.any() else 1.0)
+            self.noise_floor += rate * (level - self.noise_floor)
+        return speech
+
+
+class AudioRingBuffer:
+    def __init__(self, capacity):
+        """capacity : 保持する最大サンプル数（これより古い音声は上書きされる）"""
+        self.capacity = int(capacity)
+        self._data = np.zeros(self.capacity, dtype=np.float32)
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        """これまでに書き込んだ総サンプル数（読み出し位置の基準）"""
+        with self._lock:
+            return self._total
+
+    @property
+    def oldest(self):
+        """まだ上書きされていない最も古いサンプルの位置"""
+        with self._lock:
+            return max(0, self._total - self.capacity)
+
+    def write(self, samples):
+        samples = np.asarray(samples, dtype=np.float32)
+        if len(samples) > self.capacity:
+            skipped = len(samples) - self.capacity
+            samples = samples[skipped:]
+        else:
+            skipped = 0
+        with self._lock:
+            pos = (self._total + skipped) % self.capacity
+            head = min(len(samples), self.capacity - pos)
+            self._data[pos:pos + head] = samples[:head]
+            self._data[:len(samples) - head] = samples[head:]
+            self._total += skipped + len(samples)
+
+    def read(self, start, end=None):
+        """位置 start〜end のサンプルを連続した配列で返す（上書き済みの部分は含まない）"""
+        with self._lock:
+            end = self._total if end is None else min(end, self._total)
+            start = max(start, self._total - self.capacity, 0)
+            if start >= end:
+                return np.zeros(0, dtype=np.float32)
+            a, b = start % self.capacity, end % self.capacity
+            if a < b:
+                return self._data[a:b].copy()
+            return np.concatenate((self._data[a:], self._data[:b]))
@@ -0,0 +1,174 @@
+"""
+Komomo System Core - Cache Utilities
+Version: v4.3.0
+
+[役割]
+繰り返し発生する処理結果を使い回すためのキャッシュ部品。
+「おはよう」「今日の天気は？」のような定番の問いかけに対して、
+LLM呼び出し（と記憶検索・音声合成）を省略できるようにします。
+
+[主な機能]
+- LRUCache : 上限件数・有効期限（TTL）付きのスレッドセーフなLRUキャッシュ
+- ResponseCache : 正規化した質問文＋コンテキストのハッシュをキーにした回答キャッシュ
+  （任意で埋め込みベクトルの類似度による「ほぼ同じ質問」のヒット判定）
+- normalize_query : 音声認識の揺らぎを吸収する質問文の正規化
+- is_context_dependent : 直前の会話がないと意味が決まらない発話（「うん」「なんで？」等）の判定
+"""
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def normalize_query(text):
+    """音声認識の揺らぎ対策（句読点・記号・空白を除去）"""
+    return re.sub(r'[。\?？!！、\s]', '', text)
+
+
+# 直前の会話を指す語（これを含む発話は、同じ文でも会話の流れによって答えが変わる）
+_CONTEXT_WORDS = ("それ", "あれ", "これ", "その", "あの", "この", "そう", "なんで", "なぜ", "どうして",
+                  "続き", "つづき", "もう一回", "もっと", "さっき", "次は")
+
+
+def is_context_dependent(normalized, min_length=4):
+    """正規化済みの発話が直前の会話に依存するか（短い相づち・指示語を含む発話は回答キャッシュの対象外）"""
+    return len(normalized) < min_length or any(w in normalized for w in _CONTEXT_WORDS)
+
+
+class LRUCache:
+    def __init__(self, maxsize=128, ttl=None):
+        """maxsize: 最大件数（0以下で無効）, ttl: 有効期限[秒]（None で無期限）"""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                value, expires_at = item
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """期限切れを除いた (key, value) の一覧（古い順）"""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (v, exp) in self._data.items() if exp is None or exp > now]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    def __init__(self, maxsize=256, ttl=3600, similarity_threshold=None, embed_fn=None):
+        """
+        similarity_threshold : 0〜1。指定時は完全一致しなくても、同じコンテキストで
+                               質問文の埋め込みのコサイン類似度がこれ以上ならヒットとみなす
+        embed_fn             : embed_fn([text, ...]) -> [[float, ...], ...]
+        """
+        self.cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.similarity_threshold = similarity_threshold
+        self.embed_fn = embed_fn
+        self.semantic_hits = 0
+
+    @property
+    def hits(self):
+        return self.cache.hits + self.semantic_hits
+
+    @property
+    def misses(self):
+        return self.cache.misses - self.semantic_hits
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "semantic_hits": self.semantic_hits,
+                "hit_rate": self.hits / total if total else 0.0, "size": len(self.cache)}
+
+    def _context_hash(self, context_sections):
+        h = hashlib.sha1()
+        for section in context_sections:
+            h.update((section or "").encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, query, context_sections):
+        """キャッシュ済みの回答を返す（なければ None）"""
+        normalized = normalize_query(query)
+        context_hash = self._context_hash(context_sections)
+        entry = self.cache.get((normalized, context_hash))
+        if entry is not None:
+            self._log("HIT", normalized)
+            return entry["response"]
+
+        if self.similarity_threshold and self.embed_fn:
+            found = self._similar(normalized, context_hash)
+            if found is not None:
+                self.semantic_hits += 1
+                self._log("HIT(類似)", normalized)
+                return found
+        self._log("MISS", normalized)
+        return None
+
+    def put(self, query, context_sections, response):
+        normalized = normalize_query(query)
+        entry = {"response": response, "embedding": None}
+        if self.similarity_threshold and self.embed_fn:
+            try:
+                entry["embedding"] = self.embed_fn([normalized])[0]
+            except Exception as e:
+                print(f"[Cache] 埋め込み計算エラー: {e}")
+        self.cache.put((normalized, self._context_hash(context_sections)), entry)
+
+    def _similar(self, normalized, context_hash):
+        try:
+            query_vec = self.embed_fn([normalized])[0]
+        except Exception as e:
+            print(f"[Cache] 埋め込み計算エラー: {e}")
+            return None
+        best, best_score = None, self.similarity_threshold
+        for (_, entry_hash), entry in self.cache.items():
+            if entry_hash != context_hash or entry["embedding"] is None:
+                continue
+            score = _cosine(query_vec, entry["embedding"])
+            if score >= best_score:
+                best, best_score = entry["response"], score
+        return best
+
+    def _log(self, kind, normalized):
+        s = self.stats()
+        print(f"[Cache] {kind}: '{normalized[:15]}' (hit {s['hits']} / miss {s['misses']})")
+
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = sum(x * x for x in a) ** 0.5
+    norm_b = sum(y * y for y in b) ** 0.5
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
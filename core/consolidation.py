@@ -0,0 +1,172 @@
+"""
+Komomo System Core - Memory Consolidation
+Version: v4.3.0
+
+[役割]
+古い会話の記憶を日ごとにまとめて要約し、記憶ストアとDBの肥大化を防ぐモジュール。
+毎ターン追記される思い出（1往復ごとのベクトル）を「その日の思い出」の要約1件に置き換え、
+保存期間・件数の上限を超えた会話履歴を削除します。
+数か月使い続けても、検索の精度・速度とディスク使用量が一定の範囲に収まります。
+
+[主な機能]
+- 一定日数より古い会話履歴を日ごとにまとめ、LLMで要約して1件の思い出として記憶ストアへ登録
+- 要約済みの日の1往復ごとのベクトルを記憶ストアから削除（要約のベクトルに置き換え）
+- 要約済みの会話履歴に対する保存期間（日数）・件数上限の適用
+- バックグラウンドでの定期実行
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+
+
+def migrate_schema(conn):
+    """要約済みの印（conversation_history.consolidated）と要約の記録テーブルを用意する"""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(conversation_history)")]
+    if "consolidated" not in columns:
+        conn.execute("ALTER TABLE conversation_history ADD COLUMN consolidated INTEGER DEFAULT 0")
+    conn.execute('''CREATE TABLE IF NOT EXISTS memory_summaries
+                    (id TEXT PRIMARY KEY, day TEXT, summary TEXT,
+                     turn_count INTEGER, created_at TIMESTAMP)''')
+
+
+class MemoryConsolidator:
+    def __init__(self, db, memory_store, summarize_fn, min_age_days=7, retention_days=90,
+                 max_history_rows=None, max_turns_per_summary=30, interval_hours=24.0):
+        """
+        db                    : conversation_history を持つ MemoryDB
+        memory_store          : 思い出のベクトルを保存している MemoryStore
+        summarize_fn          : summarize_fn(day, [(user_text, ai_response), ...]) -> 要約文（失敗時は例外）
+        min_age_days          : 何日より前の会話を要約の対象にするか
+        retention_days        : 要約済みの会話履歴を何日残すか（None で無期限）
+        max_history_rows      : 会話履歴の件数上限（超えた分は要約済みの古いものから削除、None で無制限）
+        max_turns_per_summary : 1件の要約にまとめる最大往復数（多い日は分割して要約）
+        interval_hours        : 定期実行の間隔
+        """
+        self.db = db
+        self.memory_store = memory_store
+        self.summarize_fn = summarize_fn
+        self.min_age_days = min_age_days
+        self.retention_days = retention_days
+        self.max_history_rows = max_history_rows
+        self.max_turns_per_summary = max(1, max_turns_per_summary)
+        self.interval_hours = interval_hours
+        self._lock = threading.Lock()
+        self.last_report = {}
+        self._init_db()
+
+    def _init_db(self):
+        self.db.transaction(migrate_schema)
+
+    def start(self):
+        """定期実行のスレッドを開始する（起動直後の1回目は少し遅らせる）"""
+        threading.Thread(target=self._loop, name="komomo-consolidation", daemon=True).start()
+
+    def _loop(self):
+        time.sleep(60)
+        while True:
+            try:
+                self.run()
+            except Exception as e:
+                print(f"[Consolidation] 記憶の整理に失敗しました: {e}")
+            time.sleep(self.interval_hours * 3600)
+
+    def run(self):
+        """記憶の整理を1回実行する"""
+        with self._lock:
+            started = time.perf_counter()
+            cutoff = (datetime.now() - timedelta(days=self.min_age_days)).strftime("%Y-%m-%d")
+            days = [d for (d,) in self.db.fetchall(
+                "SELECT DISTINCT substr(created_at, 1, 10) AS day FROM conversation_history "
+                "WHERE consolidated = 0 AND created_at < ? ORDER BY day", (cutoff,)
+            )]
+            summarized = 0
+            # 記憶ストアの全件走査は1回の整理につき1回だけ行い、日ごとの置き換えはこの索引から引く
+            raw_index = self._index_raw_memories() if days else ({}, {})
+            for day in days:
+                try:
+                    summarized += self._consolidate_day(day, raw_index)
+                except Exception as e:
+                    # 失敗した日は次回に持ち越す
+                    print(f"[Consolidation] {day} の要約に失敗しました: {e}")
+            purged = self._apply_retention()
+            self.last_report = {"days": len(days), "summaries": summarized, "purged": purged,
+                                "seconds": time.perf_counter() - started}
+            if days or purged:
+                print(f"[Consolidation] {len(days)}日分を要約 ({summarized}件), 履歴 {purged}件を削除"
+                      f" ({self.last_report['seconds']:.1f}s)")
+            return self.last_report
+
+    def _index_raw_memories(self):
+        """要約以外の思い出を (history_id -> [id], 日付 -> [id]) に振り分ける（history_id の無い古い思い出は日付で照合）"""
+        by_history, by_day = {}, {}
+        for mem_id, meta in self.memory_store.metadata_items():
+            if meta.get("kind") == "summary":
+                continue
+            if meta.get("history_id") is not None:
+                by_history.setdefault(meta["history_id"], []).append(mem_id)
+            else:
+                by_day.setdefault(str(meta.get("timestamp", ""))[:10], []).append(mem_id)
+        return by_history, by_day
+
+    def _consolidate_day(self, day, raw_index):
+        rows = self.db.fetchall(
+            "SELECT id, user_text, ai_response FROM conversation_history "
+            "WHERE consolidated = 0 AND substr(created_at, 1, 10) = ? ORDER BY id", (day,)
+        )
+        if not rows:
+            return 0
+
+        # 1. 要約（多い日は分割）。1つでも失敗したらその日は丸ごと持ち越す
+        chunks = [rows[i:i + self.max_turns_per_summary] for i in range(0, len(rows), self.max_turns_per_summary)]
+        summaries = []
+        for chunk in chunks:
+            summary = self.summarize_fn(day, [(u, a) for _, u, a in chunk])
+            if not summary:
+                raise RuntimeError("要約が空でした")
+            summaries.append((chunk, summary.strip()))
+
+        # 2. 要約を思い出として登録
+        # IDは要約した会話履歴の範囲から決まるため、やり直しても重複せず、
+        # 要約済みの日に後から履歴が増えても（遅れた分析・インポート）既存の要約を上書きしない
+        ids = [f"summary_{day}_{chunk[0][0]}-{chunk[-1][0]}" for chunk, _ in summaries]
+        documents = [f"{day}の思い出: {summary}" for _, summary in summaries]
+        metadatas = [{"timestamp": f"{day}T23:59:59", "kind": "summary", "day": day, "turns": len(chunk)}
+                     for chunk, _ in summaries]
+        self.memory_store.delete(ids)
+        self.memory_store.add(ids=ids, documents=documents, metadatas=metadatas)
+
+        # 3. その日の1往復ごとのベクトルを削除（要約のベクトルに置き換え）
+        by_history, by_day = raw_index
+        history_ids = {row[0] for row in rows}
+        raw_ids = [mem_id for hid in history_ids for mem_id in by_history.get(hid, ())] + by_day.get(day, [])
+        if raw_ids:
+            self.memory_store.delete(raw_ids)
+
+        # 4. 要約済みとして記録
+        now = datetime.now().isoformat()
+
+        def mark(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO memory_summaries (id, day, summary, turn_count, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(mem_id, day, doc, len(chunk), now) for mem_id, doc, (chunk, _) in zip(ids, documents, summaries)]
+            )
+            conn.executemany("UPDATE conversation_history SET consolidated = 1 WHERE id = ?", [(i,) for i in history_ids])
+        self.db.transaction(mark)
+        print(f"[Consolidation] {day}: {len(rows)}往復 -> 要約{len(summaries)}件 (ベクトル {len(raw_ids)}件を置き換え)")
+        return len(summaries)
+
+    def _apply_retention(self):
+        """要約済みの会話履歴に保存期間・件数上限を適用する（未要約の履歴は消さない）"""
+        purged = 0
+        if self.retention_days is not None:
+            limit = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+            purged += self.db.execute(
+                "DELETE FROM conversation_history WHERE consolidated = 1 AND created_at < ?", (limit,)
+            )
+        if self.max_history_rows is not None:
+            purged += self.db.execute(
+                "DELETE FROM conversation_history WHERE consolidated = 1 AND id IN ("
+                "  SELECT id FROM conversation_history ORDER BY id DESC LIMIT -1 OFFSET ?)",
+                (self.max_history_rows,)
+            )
+        return purged
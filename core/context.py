@@ -0,0 +1,97 @@
+"""
+Komomo System Core - Context Assembler
+Version: v4.3.0
+
+[役割]
+LLM呼び出し直前の「記憶の取り出し」を並列化するモジュール。
+プロフィール・最近の履歴・関連する思い出など、互いに独立した取得処理を
+スレッドプールで同時に実行し、合計待ち時間を「最も遅いソース」まで短縮します。
+
+[主な機能]
+- 複数のコンテキストソースの並列実行
+- ソースごとの締め切り（デッドライン）超過時の切り捨て
+- ソースごとの所要時間の計測とログ出力
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+
+class ContextAssembler:
+    def __init__(self, default_deadline=2.0, deadlines=None, max_workers=4):
+        self.default_deadline = default_deadline
+        # ソース名 -> 締め切り秒数（未指定は default_deadline）
+        self.deadlines = dict(deadlines or {})
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="komomo-context")
+        # 締め切りで切り捨てたが、まだ裏で実行中のソース -> その件数
+        # （同じソースが詰まり続けてプールを食い潰さないよう、完了までは再投入しない。
+        #   締め切り内で実行中のものは対象外：連続したターンでも記憶を取りこぼさない）
+        self._stuck = {}
+        self._lock = threading.Lock()
+        self.last_report = {}
+
+    def assemble(self, sources, default=""):
+        """
+        sources: {名前: 引数なしの呼び出し可能オブジェクト}
+        すべてを同時に開始し、各ソースの締め切りまでに返ったものだけを採用する。
+        戻り値: {名前: 結果}（締め切り超過・エラー時は default）
+        """
+        started = time.perf_counter()
+        futures = {}
+        results = {}
+        report = {}
+
+        for name, func in sources.items():
+            with self._lock:
+                if self._stuck.get(name):
+                    results[name] = default
+                    report[name] = {"ms": 0.0, "status": "busy"}
+                    continue
+            state = {"done": False, "abandoned": False}
+            futures[name] = (self.executor.submit(self._run, name, func, state), state)
+
+        for name, (future, state) in futures.items():
+            # 締め切りは全ソース共通の開始時刻から数える
+            deadline = self.deadlines.get(name, self.default_deadline)
+            remaining = max(0.0, started + deadline - time.perf_counter())
+            try:
+                value, elapsed, error = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                with self._lock:
+                    # 締め切り直後に終わっていた場合は数えない
+                    if not state["done"]:
+                        state["abandoned"] = True
+                        self._stuck[name] = self._stuck.get(name, 0) + 1
+                results[name] = default
+                report[name] = {"ms": deadline * 1000, "status": "timeout"}
+                continue
+            if error is None:
+                results[name] = value
+                report[name] = {"ms": elapsed * 1000, "status": "ok"}
+            else:
+                results[name] = default
+                report[name] = {"ms": elapsed * 1000, "status": f"error: {error}"}
+
+        total_ms = (time.perf_counter() - started) * 1000
+        self.last_report = {"total_ms": total_ms, "sources": report}
+        summary = " ".join(
+            f"{name}={r['ms']:.0f}ms" + ("" if r["status"] == "ok" else f"({r['status']})")
+            for name, r in report.items()
+        )
+        print(f"[Context] 記憶取得 {total_ms:.0f}ms: {summary}")
+        return results
+
+    def _run(self, name, func, state):
+        """ソースを実行し、(結果, 所要秒数, 例外) を返す。締め切りで切り捨てられていた場合は完了時に解除する"""
+        started = time.perf_counter()
+        try:
+            return func(), time.perf_counter() - started, None
+        except Exception as e:
+            return None, time.perf_counter() - started, e
+        finally:
+            with self._lock:
+                state["done"] = True
+                if state["abandoned"]:
+                    self._stuck[name] -= 1
+                    if not self._stuck[name]:
+                        del self._stuck[name]
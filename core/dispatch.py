@@ -0,0 +1,208 @@
+"""
+Komomo System Core - Hook Dispatch Bus
+Version: v4.3.0
+
+[役割]
+pluggy の Hook 呼び出し（登録順に同期実行）の上に被せる非同期配送レイヤー。
+`KomomoSpecs` で定義された Hook を、購読プラグインごとに並行実行します。
+遅いプラグイン（Unity送信など）が他のプラグインや会話スレッドを止めなくなります。
+
+[主な機能]
+- 独立した購読者の並行実行（呼び出し側は配送を投げた時点で即復帰）
+- 購読者ごとのタイムアウト（超過した購読者を待たずに後続を進める）
+- 宣言された場合のみの順序制御（after: 先に完了させたい購読者名）
+- タイムアウト後も戻らない呼び出しの追跡と、詰まった購読者への配送の一時停止
+
+[制限]
+タイムアウトは「待つのをやめる」だけで、実行中の呼び出しは止められません。
+戻らない呼び出しはワーカースレッド（max_workers 本）を1本ずつ占有し続けるため、
+タイムアウト後も実行中の呼び出しが max_stuck 件ある購読者には、戻るまで新しい配送を行いません。
+件数は HookDispatcher.stats() で確認できます。
+
+[順序・タイムアウトの宣言]
+プラグイン側でクラス属性 `dispatch_policy` を定義するか、
+`HookDispatcher.declare()` で外部から指定します。
+    dispatch_policy = {
+        "on_llm_response_generated": {"timeout": 45, "after": ["GUIPlugin"]},
+    }
+"""
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+
+def subscriber_name(plugin):
+    """購読者名：クラス名（汎用名 'Plugin' の場合はモジュール名）"""
+    cls = plugin.__class__
+    if cls.__name__ == "Plugin":
+        return cls.__module__.rsplit(".", 1)[-1]
+    return cls.__name__
+
+
+class _Subscriber:
+    def __init__(self, name, func, kwargs, timeout, after):
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs
+        self.timeout = timeout
+        self.after = after
+        self.launched = False
+        self.started_at = None
+        self.timer = None
+        self.timed_out = False
+
+
+class DispatchRun:
+    """1回分の配送。fire() が即座に返し、完了を待ちたい場合のみ wait() を使う"""
+
+    def __init__(self, dispatcher, hook_name, subscribers):
+        self.dispatcher = dispatcher
+        self.hook_name = hook_name
+        self.subscribers = {s.name: s for s in subscribers}
+        self.results = {}
+        self.report = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def start(self):
+        if not self.subscribers:
+            self._done.set()
+            return self
+        self._launch_ready()
+        return self
+
+    def wait(self, timeout=None):
+        """全購読者が完了（またはタイムアウト）するまで待つ"""
+        return self._done.wait(timeout)
+
+    def _launch_ready(self):
+        with self._lock:
+            ready = []
+            for sub in self.subscribers.values():
+                if sub.launched:
+                    continue
+                # 存在しない購読者への依存は無視する
+                deps = [d for d in sub.after if d in self.subscribers]
+                if all(d in self.report for d in deps):
+                    sub.launched = True
+                    ready.append(sub)
+        for sub in ready:
+            sub.started_at = time.perf_counter()
+            if sub.timeout:
+                sub.timer = threading.Timer(sub.timeout, self._settle, (sub, "timeout", None))
+                sub.timer.daemon = True
+                sub.timer.start()
+            self.dispatcher.executor.submit(self._invoke, sub)
+
+    def _invoke(self, sub):
+        try:
+            result = sub.func(**sub.kwargs)
+            self._settle(sub, "ok", result)
+        except Exception as e:
+            print(f"[Dispatch] {self.hook_name} -> {sub.name} でエラー: {e}")
+            traceback.print_exc()
+            self._settle(sub, "error", None)
+        finally:
+            with self._lock:
+                late = sub.timed_out
+            if late:
+                self.dispatcher._release_stuck(sub.name)
+
+    def _settle(self, sub, status, result):
+        with self._lock:
+            # タイムアウトと実処理の完了のうち、先に来た方だけを採用する
+            if sub.name in self.report:
+                return
+            elapsed = (time.perf_counter() - sub.started_at) * 1000
+            self.report[sub.name] = {"ms": elapsed, "status": status}
+            if status == "ok":
+                self.results[sub.name] = result
+            if status == "timeout":
+                # 戻ってきた時に _invoke が解除する（解除より先に数えるよう、ロック中に数える）
+                sub.timed_out = True
+                self.dispatcher._mark_stuck(sub.name)
+            finished = len(self.report) == len(self.subscribers)
+        if sub.timer:
+            sub.timer.cancel()
+        if status == "timeout":
+            print(f"[Dispatch] {self.hook_name} -> {sub.name} がタイムアウト ({sub.timeout}s)。待たずに続行します")
+        if finished:
+            summary = " ".join(
+                f"{name}={r['ms']:.0f}ms" + ("" if r["status"] == "ok" else f"({r['status']})")
+                for name, r in self.report.items()
+            )
+            print(f"[Dispatch] {self.hook_name} 配送完了: {summary}")
+            self._done.set()
+        else:
+            self._launch_ready()
+
+
+class HookDispatcher:
+    def __init__(self, pm, max_workers=8, default_timeout=60.0, max_stuck=2):
+        """
+        max_stuck : タイムアウト後も戻らない呼び出しがこの件数ある購読者には、戻るまで配送しない
+        """
+        self.pm = pm
+        self.default_timeout = default_timeout
+        self.max_stuck = max(1, max_stuck)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="komomo-dispatch")
+        # (hook名, 購読者名) -> {"timeout": 秒, "after": [購読者名, ...]}
+        self.policies = {}
+        # 購読者名 -> タイムアウト後もワーカースレッドを占有している呼び出しの数
+        self._stuck = {}
+        self._skipped = 0
+        self._stuck_lock = threading.Lock()
+
+    def _mark_stuck(self, name):
+        with self._stuck_lock:
+            self._stuck[name] = self._stuck.get(name, 0) + 1
+
+    def _release_stuck(self, name):
+        with self._stuck_lock:
+            self._stuck[name] -= 1
+            if not self._stuck[name]:
+                del self._stuck[name]
+
+    def stats(self):
+        """タイムアウト後も実行中の呼び出し数（購読者ごと）と、そのために見送った配送の数"""
+        with self._stuck_lock:
+            return {"stuck": dict(self._stuck), "stuck_total": sum(self._stuck.values()), "skipped": self._skipped}
+
+    def declare(self, hook_name, subscriber, timeout=None, after=()):
+        """外部から購読者のタイムアウト・順序を宣言する（プラグイン側の宣言より優先）"""
+        policy = {"after": list(after)}
+        if timeout is not None:
+            policy["timeout"] = timeout
+        self.policies[(hook_name, subscriber)] = policy
+
+    def fire(self, hook_name, **kwargs):
+        """Hook を非同期に配送し、DispatchRun を即座に返す"""
+        hook = getattr(self.pm.hook, hook_name)
+        subscribers = []
+        for impl in hook.get_hookimpls():
+            # hookwrapper は呼び出しチェーン前提のため並行配送の対象外
+            if getattr(impl, "hookwrapper", False) or getattr(impl, "wrapper", False):
+                continue
+            name = subscriber_name(impl.plugin)
+            with self._stuck_lock:
+                stuck = self._stuck.get(name, 0) >= self.max_stuck
+                if stuck:
+                    self._skipped += 1
+            if stuck:
+                print(f"[Dispatch] {hook_name} -> {name} は前の呼び出しが戻っていないため配送を見送ります")
+                continue
+            policy = self._policy(hook_name, impl.plugin, name)
+            subscribers.append(_Subscriber(
+                name,
+                impl.function,
+                {arg: kwargs[arg] for arg in impl.argnames if arg in kwargs},
+                policy.get("timeout", self.default_timeout),
+                list(policy.get("after", ())),
+            ))
+        return DispatchRun(self, hook_name, subscribers).start()
+
+    def _policy(self, hook_name, plugin, name):
+        if (hook_name, name) in self.policies:
+            return self.policies[(hook_name, name)]
+        return getattr(plugin, "dispatch_policy", {}).get(hook_name, {})
@@ -0,0 +1,205 @@
+"""
+Komomo System Core - Embedding Service
+Version: v4.3.0
+
+[役割]
+記憶の保存・検索・回答キャッシュで使う埋め込みベクトルを一元的に計算するモジュール。
+同じ文章を何度もベクトル化しないよう、内容のハッシュをキーにした永続キャッシュ（SQLite）を持ち、
+キャッシュに無いものだけをまとめてバッチ推論します。
+
+[主な機能]
+- 内容ハッシュ（SHA-1）＋モデル名をキーにした SQLite 上の埋め込みキャッシュ（＋メモリ上のLRU）
+- 設定可能なバッチサイズ・同時に推論するバッチ数によるCPUでのバッチ推論
+  （1回の推論の内部スレッド数はモデル側の既定のまま。設定 embedding_threads は同時に推論するバッチ数）
+- モデルの切り替え（"default": ChromaDB既定の all-MiniLM-L6-v2 / それ以外: sentence-transformers のモデル名）
+- chromadb を使わない "default" モデルの計算（onnxruntime + tokenizers で同じONNXモデルを直接読み込む。
+  memory_store が "numpy" の場合に使い、chromadb のインストールと読み込みを不要にする）
+"""
+import hashlib
+import os
+import tarfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from core.cache import LRUCache
+
+# ChromaDB が既定の埋め込みに使うモデルと同じファイル・同じ保存先（どちらで計算しても同じベクトル空間）
+ONNX_MINILM_URL = "https://chroma-onnx-models.s3.amazonaws.com/all-MiniLM-L6-v2/onnx.tar.gz"
+ONNX_MINILM_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chroma", "onnx_models", "all-MiniLM-L6-v2")
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class OnnxMiniLM:
+    """ONNX版 all-MiniLM-L6-v2 を chromadb なしで実行する（ChromaDB の DefaultEmbeddingFunction と同じ前処理・平均プーリング）"""
+
+    def __init__(self, model_dir=ONNX_MINILM_DIR, max_length=256):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        files = os.path.join(model_dir, "onnx")
+        if not os.path.exists(os.path.join(files, "model.onnx")):
+            self._download(model_dir)
+        self.tokenizer = Tokenizer.from_file(os.path.join(files, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]", length=max_length)
+        self.session = onnxruntime.InferenceSession(os.path.join(files, "model.onnx"),
+                                                    providers=["CPUExecutionProvider"])
+
+    def _download(self, model_dir):
+        from core import http_client
+
+        print(f"[Embedding] ONNXモデルをダウンロード中: {ONNX_MINILM_URL}")
+        os.makedirs(model_dir, exist_ok=True)
+        archive = os.path.join(model_dir, "onnx.tar.gz")
+        res = http_client.get_session(ONNX_MINILM_URL).get(ONNX_MINILM_URL, stream=True, timeout=60)
+        res.raise_for_status()
+        with open(archive, "wb") as f:
+            for chunk in res.iter_content(chunk_size=1 << 20):
+                f.write(chunk)
+        with tarfile.open(archive, "r:gz") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(model_dir, filter="data")
+            else:
+                # data フィルタの無い Python では、model_dir の外を指すパス・リンクを自前で弾く
+                root = os.path.realpath(model_dir)
+                for member in tar.getmembers():
+                    target = os.path.realpath(os.path.join(model_dir, member.name))
+                    if os.path.commonpath([root, target]) != root or not (member.isfile() or member.isdir()):
+                        raise ValueError(f"モデルのアーカイブに不正なパスがあります: {member.name}")
+                tar.extractall(model_dir)
+
+    def __call__(self, texts):
+        import numpy as np
+
+        encoded = self.tokenizer.encode_batch(list(texts))
+        input_ids = np.array([e.ids for e in encoded], dtype=np.int64)
+        attention_mask = np.array([e.attention_mask for e in encoded], dtype=np.int64)
+        hidden = self.session.run(None, {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "token_type_ids": np.zeros_like(input_ids),
+        })[0]
+        mask = attention_mask[..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.astype(np.float32).tolist()
+
+
+def _load_model(model_name, use_chromadb=True):
+    """model_name に応じた埋め込み関数 fn([text, ...]) -> [[float, ...], ...] を返す"""
+    if model_name == "default" and not use_chromadb:
+        return OnnxMiniLM()
+    if model_name == "default":
+        # ChromaDB の既定（ONNX版 all-MiniLM-L6-v2）。既存の chroma_db と同じベクトル空間
+        from chromadb.utils import embedding_functions
+        fn = embedding_functions.DefaultEmbeddingFunction()
+        return lambda texts: [list(vec) for vec in fn(list(texts))]
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device="cpu")
+    return lambda texts: model.encode(list(texts), normalize_embeddings=True).tolist()
+
+
+class EmbeddingService:
+    def __init__(self, db, model="default", batch_size=32, batch_workers=2, cache_size=1024, use_chromadb=True):
+        """
+        db         : 埋め込みキャッシュを保存する MemoryDB
+        model      : 埋め込みモデル名（キャッシュのキーにも含める）
+        use_chromadb : False なら "default" モデルを chromadb を介さずに読み込む（NumPy記憶ストア用）
+        batch_size : 1回の推論でまとめて処理する件数
+        batch_workers : 同時に推論するバッチの数（推論1回あたりの内部スレッド数ではない）
+        cache_size : メモリ上に保持する埋め込みの件数
+        """
+        self.model = model
+        self.use_chromadb = use_chromadb
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, batch_workers), thread_name_prefix="komomo-embed")
+        self.memory_cache = LRUCache(maxsize=cache_size)
+        self._embed_fn = None
+        self._model_lock = threading.Lock()
+        self.stats = {"requested": 0, "computed": 0}
+        self._init_db()
+
+    def _init_db(self):
+        self.db.execute('''CREATE TABLE IF NOT EXISTS embedding_cache
+                           (hash TEXT, model TEXT, vector BLOB,
+                            PRIMARY KEY (hash, model))''')
+
+    def _get_embed_fn(self):
+        # モデルの読み込みは重いので初回利用時に1度だけ行う
+        with self._model_lock:
+            if self._embed_fn is None:
+                print(f"[Embedding] モデル読み込み中: {self.model}")
+                self._embed_fn = _load_model(self.model, self.use_chromadb)
+            return self._embed_fn
+
+    def embed(self, texts):
+        """テキストのリストを埋め込みベクトルのリストに変換する（キャッシュ済みのものは再計算しない）"""
+        texts = list(texts)
+        hashes = [content_hash(t) for t in texts]
+        self.stats["requested"] += len(texts)
+        vectors = {}
+
+        # 1. メモリ上のキャッシュ
+        for h in set(hashes):
+            vec = self.memory_cache.get(h)
+            if vec is not None:
+                vectors[h] = vec
+
+        # 2. SQLite 上のキャッシュ
+        missing = [h for h in dict.fromkeys(hashes) if h not in vectors]
+        if missing:
+            vectors.update(self._load_cached(missing))
+
+        # 3. 残りをバッチ推論
+        todo = {}
+        for h, t in zip(hashes, texts):
+            if h not in vectors:
+                todo.setdefault(h, t)
+        if todo:
+            computed = self._compute(list(todo.values()))
+            new_entries = dict(zip(todo.keys(), computed))
+            vectors.update(new_entries)
+            self._store_cached(new_entries)
+            self.stats["computed"] += len(new_entries)
+
+        for h, vec in vectors.items():
+            self.memory_cache.put(h, vec)
+        return [vectors[h] for h in hashes]
+
+    def _compute(self, texts):
+        embed_fn = self._get_embed_fn()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results = []
+        for batch_vectors in self.executor.map(embed_fn, batches):
+            results.extend(batch_vectors)
+        return results
+
+    def _load_cached(self, hashes):
+        found = {}
+        # SQLite の変数上限を超えないよう分割して問い合わせる
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.fetchall(
+                f"SELECT hash, vector FROM embedding_cache WHERE model = ? AND hash IN ({placeholders})",
+                [self.model] + chunk
+            )
+            for h, blob in rows:
+                found[h] = array("f", blob).tolist()
+        return found
+
+    def _store_cached(self, entries):
+        # キャッシュの書き込み完了は待たない（失敗しても次回計算し直すだけ）
+        future = self.db.executemany(
+            "INSERT OR REPLACE INTO embedding_cache (hash, model, vector) VALUES (?, ?, ?)",
+            [(h, self.model, array("f", vec).tobytes()) for h, vec in entries.items()],
+            wait=False
+        )
+        future.add_done_callback(
+            lambda f: f.exception() and print(f"[Embedding] キャッシュ保存エラー: {f.exception()}")
+        )
@@ -0,0 +1,116 @@
+"""
+Komomo System Core - Shared HTTP Client
+Version: v4.3.0
+
+[役割]
+全プラグインの外部通信（OpenAI, Groq, OpenRouter, VoiceVox, Unity）を集約する共通HTTP層。
+接続先ホストごとにコネクションプールを持ち、Keep-Alive で TCP/TLS 接続を使い回すことで、
+1ターンに5〜7回発生するリクエストのハンドシェイク待ちを削減します。
+
+[主な機能]
+- ホスト単位のコネクションプール（requests.Session + HTTPAdapter）
+- 接続先（エンドポイント種別）ごとのタイムアウト・リトライ方針
+- httpx + h2 が導入済みの環境では、HTTPS の通常リクエストを HTTP/2 で送信
+"""
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+    import h2  # noqa: F401  (httpx の HTTP/2 対応に必要)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# エンドポイント種別ごとの通信方針
+# timeout: 既定のタイムアウト秒数（呼び出し側で timeout= を渡せば上書き）
+# retries: 接続失敗時の再試行回数（429 は LLM 側のフォールバックに任せる）
+# idempotent: 同じ POST を2回送っても結果が変わらない接続先か（True の場合のみ 502/503/504 でも再試行する。
+#             LLM の生成などは、サーバー側で処理済みのリクエストを重ねて送らないよう接続失敗時のみ再試行）
+ENDPOINT_POLICIES = {
+    "default":    {"timeout": 10, "retries": 0, "idempotent": False},
+    "openai":     {"timeout": 20, "retries": 1, "idempotent": False},
+    "groq":       {"timeout": 15, "retries": 1, "idempotent": False},
+    "openrouter": {"timeout": 15, "retries": 1, "idempotent": False},
+    "voicevox":   {"timeout": 30, "retries": 1, "idempotent": True},
+    "unity":      {"timeout": 5,  "retries": 0, "idempotent": False},
+}
+
+POOL_MAXSIZE = 8
+
+_sessions = {}
+_http2_clients = {}
+_lock = threading.Lock()
+
+
+def _policy(endpoint):
+    return ENDPOINT_POLICIES.get(endpoint, ENDPOINT_POLICIES["default"])
+
+
+def _host_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def get_session(url, endpoint="default"):
+    """接続先ホスト（とエンドポイント種別）ごとに共有される requests.Session を返す"""
+    key = (endpoint, _host_key(url))
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            policy = _policy(endpoint)
+            retry = Retry(
+                total=policy["retries"],
+                read=0,
+                status_forcelist=(502, 503, 504) if policy["idempotent"] else (),
+                allowed_methods=frozenset({"GET", "POST"}),
+                backoff_factor=0.2,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+
+def _get_http2_client(url, endpoint):
+    key = (endpoint, _host_key(url))
+    with _lock:
+        client = _http2_clients.get(key)
+        if client is None:
+            client = httpx.Client(
+                http2=True,
+                transport=httpx.HTTPTransport(http2=True, retries=_policy(endpoint)["retries"]),
+                limits=httpx.Limits(max_keepalive_connections=POOL_MAXSIZE),
+            )
+            _http2_clients[key] = client
+        return client
+
+
+def post(url, endpoint="default", timeout=None, stream=False, **kwargs):
+    """
+    共有プール経由の POST。戻り値は status_code / json() / content を持つレスポンス。
+    stream=True の場合は常に requests のレスポンス（iter_lines 利用可）を返す。
+    """
+    if timeout is None:
+        timeout = _policy(endpoint)["timeout"]
+    if HTTP2_AVAILABLE and not stream and url.startswith("https://"):
+        return _get_http2_client(url, endpoint).post(url, timeout=timeout, **kwargs)
+    return get_session(url, endpoint).post(url, timeout=timeout, stream=stream, **kwargs)
+
+
+def close_all():
+    """全プールを閉じる（終了時用）"""
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        for client in _http2_clients.values():
+            client.close()
+        _sessions.clear()
+        _http2_clients.clear()
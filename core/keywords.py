@@ -0,0 +1,85 @@
+"""
+Komomo System Core - Local Keyword Extractor
+Version: v4.3.0
+
+[役割]
+記憶検索（ChromaDB）に渡す検索キーワードを、ネットワークを使わずに抽出するモジュール。
+毎ターンの OpenAI 呼び出し（最大10秒）を会話の経路から外し、オフラインでも動作します。
+
+[主な機能]
+- 形態素解析（janome、導入済みの場合）による名詞・動詞・形容詞の抽出
+- 未導入時は文字種（漢字・カタカナ・英数字）の連なりによる簡易抽出
+- 助詞的な語・汎用的すぎる語（する、こと、それ 等）を除くストップワード
+"""
+import re
+import threading
+
+try:
+    from janome.tokenizer import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+# 検索の手がかりにならない語
+STOPWORDS = {
+    "する", "ある", "いる", "なる", "できる", "いう", "思う", "くる", "くれる", "もらう", "やる", "みる",
+    "こと", "もの", "とき", "ところ", "よう", "ため", "ほう", "さん", "くん", "ちゃん",
+    "これ", "それ", "あれ", "どれ", "ここ", "そこ", "あそこ", "どこ", "なに", "なん",
+    "わたし", "私", "僕", "俺", "あなた", "きみ", "君", "こもも", "あっきー",
+    "今", "今日", "ちょっと", "なんか", "本当", "ほんと", "いい", "よい", "ない",
+}
+
+# 名詞のうち検索語として採用しない細分類
+_EXCLUDED_NOUN_TYPES = ("非自立", "代名詞", "数", "接尾", "副詞可能")
+
+# 簡易抽出用：漢字・カタカナ・英数字の連なり
+_FALLBACK_PATTERN = re.compile(r'[一-龥々ー]{2,}|[ァ-ヴー]{2,}|[A-Za-z0-9][A-Za-z0-9\-\.]+')
+
+
+class KeywordExtractor:
+    def __init__(self, max_keywords=5, stopwords=None):
+        """max_keywords: 返すキーワードの最大数, stopwords: 追加のストップワード"""
+        self.max_keywords = max_keywords
+        self.stopwords = STOPWORDS | set(stopwords or ())
+        self._tokenizer = None
+        self._lock = threading.Lock()
+        if Tokenizer is None:
+            print("[Keywords] janome 未導入のため、文字種による簡易抽出を使用します")
+
+    def _get_tokenizer(self):
+        # 辞書の読み込みに時間がかかるため、初回利用時に1度だけ生成する
+        if self._tokenizer is None:
+            self._tokenizer = Tokenizer()
+        return self._tokenizer
+
+    def extract(self, text):
+        """テキストから検索キーワードを出現順に抽出する（重複なし）"""
+        if Tokenizer is not None:
+            candidates = self._extract_morphological(text)
+        else:
+            candidates = _FALLBACK_PATTERN.findall(text)
+
+        keywords = []
+        for word in candidates:
+            if word in self.stopwords or word in keywords:
+                continue
+            keywords.append(word)
+            if len(keywords) >= self.max_keywords:
+                break
+        return keywords
+
+    def _extract_morphological(self, text):
+        words = []
+        with self._lock:
+            tokens = list(self._get_tokenizer().tokenize(text))
+        for token in tokens:
+            pos = token.part_of_speech.split(",")
+            if pos[0] == "名詞":
+                if pos[1] in _EXCLUDED_NOUN_TYPES:
+                    continue
+                words.append(token.surface)
+            elif pos[0] in ("動詞", "形容詞") and pos[1] == "自立":
+                # 活用形の揺れを吸収するため基本形で扱う
+                base = token.base_form if token.base_form != "*" else token.surface
+                words.append(base)
+        # ひらがな1文字などの断片は検索語として弱いので除く
+        return [w for w in words if len(w) >= 2 or re.match(r'[一-龥]', w)]
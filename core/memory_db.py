@@ -0,0 +1,168 @@
+"""
+Komomo System Core - Memory Database
+Version: v4.3.0
+
+[役割]
+記憶データベース（komomo_v4_memory.db）への読み書きを一元管理するモジュール。
+呼び出しのたびに接続を開き直す代わりに、スレッドごとの読み取り接続を使い回し、
+書き込みは専用の書き込みスレッド1本に集約します。
+WALモードにより、バックグラウンドの書き込み中でも会話中の読み取りが「database is locked」で止まりません。
+
+[主な機能]
+- WAL ジャーナル + synchronous=NORMAL
+- スレッドごとに再利用される読み取り接続（接続ごとのプリペアドステートメントキャッシュが効く）
+- 書き込みスレッドによる逐次実行と、同時に届いた書き込みのまとめコミット（グループコミット）
+  （各書き込みはセーブポイントで区切るため、1件の失敗が他の書き込みを巻き込まない）
+- 記憶DBの基本テーブル（プロフィール・会話履歴・分析キュー等）の作成（init_schema）
+"""
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+_STOP = object()
+
+
+class MemoryDB:
+    def __init__(self, path, max_batch=64):
+        """
+        path      : SQLite ファイルのパス
+        max_batch : 1回のコミットにまとめる書き込みの最大数
+        """
+        self.path = path
+        self.max_batch = max_batch
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self.stats = {"writes": 0, "commits": 0}
+        self._writer_thread = threading.Thread(target=self._writer, name="komomo-db-writer", daemon=True)
+        self._writer_thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    # --- 読み取り（呼び出し元スレッドの接続で実行） ---
+
+    def fetchall(self, sql, params=()):
+        return self._reader().execute(sql, params).fetchall()
+
+    def fetchone(self, sql, params=()):
+        return self._reader().execute(sql, params).fetchone()
+
+    def iterate(self, sql, params=(), batch_size=500):
+        """結果を少しずつ読み出す（全件をメモリに載せない）"""
+        cursor = self._reader().cursor()
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    # --- 書き込み（書き込みスレッドで実行） ---
+
+    def transaction(self, fn, wait=True):
+        """
+        fn(conn) を書き込みスレッドで1つのトランザクションとして実行する。
+        wait=True なら完了（コミット）まで待って fn の戻り値を返し、False なら Future を返す。
+        """
+        future = Future()
+        self._queue.put((fn, future))
+        return future.result() if wait else future
+
+    def execute(self, sql, params=(), wait=True):
+        return self.transaction(lambda conn: conn.execute(sql, params).rowcount, wait)
+
+    def executemany(self, sql, seq_of_params, wait=True):
+        seq_of_params = list(seq_of_params)
+        return self.transaction(lambda conn: conn.executemany(sql, seq_of_params).rowcount, wait)
+
+    def init_schema(self):
+        """記憶DBの基本テーブルとインデックスを作成する"""
+        def create(conn):
+            cursor = conn.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS user_profile 
+                            (key TEXT PRIMARY KEY, value TEXT, updated_at TIMESTAMP)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS system_status 
+                            (key TEXT PRIMARY KEY, value TEXT)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS conversation_history 
+                            (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                             user_text TEXT, ai_response TEXT, 
+                             inner_monologue TEXT, emotion_id TEXT, 
+                             created_at TIMESTAMP)''')
+            # 未分析の会話（分析完了時に conversation_history へ移す）
+            cursor.execute('''CREATE TABLE IF NOT EXISTS analysis_queue 
+                            (id INTEGER PRIMARY KEY AUTOINCREMENT, 
+                             user_text TEXT, ai_response TEXT, 
+                             attempts INTEGER DEFAULT 0, 
+                             created_at TIMESTAMP)''')
+            # 時系列での取得・並べ替え用
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_history_created_at ON conversation_history (created_at)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_profile_updated_at ON user_profile (updated_at)")
+        self.transaction(create)
+
+    def close(self):
+        """未処理の書き込みをすべてコミットしてから書き込みスレッドを止める"""
+        if self._writer_thread.is_alive():
+            self._queue.put(_STOP)
+            self._writer_thread.join(timeout=10)
+
+    def _writer(self):
+        conn = self._connect()
+        # トランザクションは自前で管理する
+        conn.isolation_level = None
+        stopping = False
+        while not stopping:
+            job = self._queue.get()
+            if job is _STOP:
+                break
+            # 待っている間に溜まった書き込みを同じコミットにまとめる（待ち時間は追加しない）
+            jobs = [job]
+            while len(jobs) < self.max_batch:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is _STOP:
+                    stopping = True
+                    break
+                jobs.append(job)
+            self._run_batch(conn, jobs)
+        conn.close()
+
+    def _run_batch(self, conn, jobs):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, future in jobs:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, fn(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            print(f"[MemoryDB] コミット失敗: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            results = [(future, None, e) for _, future in jobs]
+
+        self.stats["writes"] += len(jobs)
+        self.stats["commits"] += 1
+        for future, value, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
@@ -0,0 +1,375 @@
+"""
+Komomo System Core - Memory Store
+Version: v4.3.0
+
+[役割]
+「思い出」（1往復分の会話）をベクトル化して保存・検索する記憶ストアの共通インターフェース。
+EgoPlugin は保存先の実装を意識せず add / query / delete だけを呼びます。
+
+[主な機能]
+- ChromaMemoryStore : 従来どおり ChromaDB（chroma_db/）に保存するバックエンド
+  （どちらのバックエンドも埋め込みは共通の embed_fn（EmbeddingService）で計算する）
+- NumpyMemoryStore  : 正規化済みの埋め込みを float32 の .npy（メモリマップ）に、
+                      文書とメタデータを komomo_v4_memory.db に保存する軽量バックエンド
+                      （内積による厳密な top-k 検索、容量倍増による追記、削除は墓標方式で空き行は再利用）
+- reembed : 埋め込みモデルを切り替えた際の全件の再ベクトル化
+- reciprocal_rank_fusion : 全文検索とベクトル検索など、複数の検索結果の順位統合（RRF）
+- create_memory_store : 設定（memory_store）に応じたバックエンドの生成
+"""
+import os
+import json
+import threading
+
+import numpy as np
+
+
+class MemoryStore:
+    """記憶ストアの共通インターフェース"""
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        """思い出を追加する（embeddings 省略時は embed_fn で計算。既に存在するIDは無視される）"""
+        raise NotImplementedError
+
+    def query(self, query_text, n_results=2):
+        """query_text に近い思い出の文書を関連度順のリストで返す"""
+        return [doc for doc, _ in self.query_items(query_text, n_results)]
+
+    def query_items(self, query_text, n_results=2):
+        """query_text に近い思い出を [(文書, メタデータ), ...]（関連度順）で返す"""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """思い出を削除する"""
+        raise NotImplementedError
+
+    def count(self):
+        """保存されている思い出の件数"""
+        raise NotImplementedError
+
+    def reembed(self, batch_size=256):
+        """保存済みの全思い出を現在の embed_fn でベクトル化し直す（モデル移行用）"""
+        raise NotImplementedError
+
+    def metadata_items(self):
+        """保存されている全思い出の [(id, メタデータ), ...]（整理・保守用）"""
+        raise NotImplementedError
+
+    def iter_items(self, batch_size=256):
+        """全思い出を (id, 文書, メタデータ, 埋め込み) で少しずつ返す（エクスポート用）"""
+        raise NotImplementedError
+
+
+class ChromaMemoryStore(MemoryStore):
+    def __init__(self, embed_fn, path="./chroma_db", collection_name="komomo_memories"):
+        """embed_fn: embed_fn([text, ...]) -> [[float, ...], ...]（ChromaDB側では埋め込みを計算させない）"""
+        # ChromaDB は読み込みが重いため、このバックエンドを使う場合のみ import する
+        import chromadb
+        self.embed_fn = embed_fn
+        self.collection_name = collection_name
+        # プロジェクトフォルダ内に chroma_db ディレクトリを作成しデータを永続化
+        self.client = chromadb.PersistentClient(path=path)
+        self._recover_reembed()
+        self.collection = self.client.get_or_create_collection(name=collection_name)
+
+    def _recover_reembed(self):
+        """再埋め込みの差し替え途中で止まった場合に、コレクションを復旧する"""
+        # バージョンによりコレクション名の一覧、またはコレクションの一覧が返る
+        names = {getattr(c, "name", c) for c in self.client.list_collections()}
+        temp_name = f"{self.collection_name}__reembed"
+        backup_name = f"{self.collection_name}__backup"
+        if self.collection_name not in names:
+            if backup_name in names:
+                # 差し替え前の状態に戻す
+                self.client.get_collection(backup_name).modify(name=self.collection_name)
+                print("[Memory] 再埋め込みの中断を検出したため、元のコレクションに戻しました")
+            elif temp_name in names:
+                self.client.get_collection(temp_name).modify(name=self.collection_name)
+                names.discard(temp_name)
+                print("[Memory] 再埋め込みの中断を検出したため、作り直したコレクションを使用します")
+        elif backup_name in names:
+            # 差し替えは完了している（古いコレクションの削除だけが残っていた）
+            self.client.delete_collection(backup_name)
+        if temp_name in names:
+            self.client.delete_collection(temp_name)
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        documents = list(documents)
+        if embeddings is None:
+            embeddings = self.embed_fn(documents)
+        self.collection.add(documents=documents, embeddings=[list(map(float, e)) for e in embeddings],
+                            metadatas=metadatas, ids=list(ids))
+
+    def query_items(self, query_text, n_results=2):
+        results = self.collection.query(query_embeddings=self.embed_fn([query_text]), n_results=n_results,
+                                        include=["documents", "metadatas"])
+        if not results or not results['documents'][0]:
+            return []
+        return [(doc, meta or {}) for doc, meta in zip(results['documents'][0], results['metadatas'][0])]
+
+    def delete(self, ids):
+        self.collection.delete(ids=list(ids))
+
+    def count(self):
+        return self.collection.count()
+
+    def metadata_items(self):
+        page = self.collection.get(include=["metadatas"])
+        return [(mem_id, meta or {}) for mem_id, meta in zip(page["ids"], page["metadatas"])]
+
+    def iter_items(self, batch_size=256):
+        offset = 0
+        while True:
+            page = self.collection.get(limit=batch_size, offset=offset,
+                                       include=["documents", "metadatas", "embeddings"])
+            if not len(page["ids"]):
+                return
+            for mem_id, doc, meta, vec in zip(page["ids"], page["documents"], page["metadatas"], page["embeddings"]):
+                yield mem_id, doc, meta or {}, [float(x) for x in vec]
+            offset += len(page["ids"])
+
+    def reembed(self, batch_size=256):
+        # 次元が変わる場合に備え、別コレクションに作り直してから差し替える
+        temp_name = f"{self.collection_name}__reembed"
+        try:
+            self.client.delete_collection(temp_name)
+        except Exception:
+            pass
+        temp = self.client.create_collection(name=temp_name)
+        total = self.collection.count()
+        for offset in range(0, total, batch_size):
+            page = self.collection.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+            if not page["ids"]:
+                break
+            temp.add(ids=page["ids"], documents=page["documents"],
+                     embeddings=self.embed_fn(page["documents"]), metadatas=page["metadatas"])
+            print(f"[Memory] 再埋め込み: {min(offset + batch_size, total)}/{total}")
+        # 元のコレクションは退避名に変えてから差し替え、差し替えが済んでから削除する
+        # （途中で止まっても、次回起動時に _recover_reembed で復旧できる）
+        backup_name = f"{self.collection_name}__backup"
+        self.collection.modify(name=backup_name)
+        temp.modify(name=self.collection_name)
+        self.client.delete_collection(backup_name)
+        self.collection = self.client.get_collection(name=self.collection_name)
+        return total
+
+
+class NumpyMemoryStore(MemoryStore):
+    def __init__(self, embed_fn, db, matrix_path="komomo_v4_memory_vectors.npy", initial_capacity=1024):
+        """
+        embed_fn         : embed_fn([text, ...]) -> [[float, ...], ...]
+        db               : 文書・メタデータを保存する MemoryDB（会話履歴と同じDB）
+        matrix_path      : 埋め込み行列（行 = memory_vectors.row）の保存先
+        initial_capacity : 最初に確保する行数（足りなくなったら倍に拡張）
+        """
+        self.embed_fn = embed_fn
+        self.db = db
+        self.matrix_path = matrix_path
+        self.initial_capacity = initial_capacity
+        self._lock = threading.Lock()
+        self._matrix = None
+        # 使用済みの行数と、各行が有効か（削除済みでないか）
+        self._size = 0
+        self._alive = np.zeros(0, dtype=bool)
+        self._init_db()
+        self._load()
+
+    def _init_db(self):
+        self.db.execute('''CREATE TABLE IF NOT EXISTS memory_vectors
+                           (row INTEGER PRIMARY KEY, id TEXT UNIQUE,
+                            document TEXT, metadata TEXT,
+                            deleted INTEGER DEFAULT 0)''')
+
+    def _load(self):
+        rows = self.db.fetchall("SELECT row, deleted FROM memory_vectors")
+        if os.path.exists(self.matrix_path):
+            self._matrix = np.load(self.matrix_path, mmap_mode="r+")
+        capacity = self._matrix.shape[0] if self._matrix is not None else 0
+        self._size = max((r for r, _ in rows), default=-1) + 1
+        self._alive = np.zeros(max(capacity, self._size), dtype=bool)
+
+        # 行列が見つからない・短い場合、ベクトルの無い行は削除済みとして扱う（再埋め込みで復元できる）
+        missing = [r for r, deleted in rows if r >= capacity and not deleted]
+        if missing:
+            print(f"[Memory] 埋め込みが見つからない思い出が{len(missing)}件あります: {self.matrix_path}")
+            self.db.execute("UPDATE memory_vectors SET deleted = 1 WHERE row >= ?", (capacity,))
+        for r, deleted in rows:
+            self._alive[r] = not deleted and r < capacity
+        print(f"[Memory] NumPy記憶ストア: {int(self._alive.sum())}件")
+
+    def _ensure_capacity(self, needed, dim):
+        """行列を必要な行数まで確保する（容量は倍々で拡張）"""
+        if self._matrix is not None and self._matrix.shape[1] != dim:
+            raise ValueError(f"埋め込みの次元が一致しません: {self._matrix.shape[1]} != {dim}")
+        capacity = self._matrix.shape[0] if self._matrix is not None else 0
+        if needed <= capacity:
+            return
+        new_capacity = max(self.initial_capacity, capacity)
+        while new_capacity < needed:
+            new_capacity *= 2
+
+        tmp_path = self.matrix_path + ".tmp.npy"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(new_capacity, dim))
+        if self._matrix is not None:
+            kept = min(self._size, capacity)
+            grown[:kept] = self._matrix[:kept]
+        grown.flush()
+        # 置き換え前に古いメモリマップを閉じる（Windowsではマップ中のファイルを置き換えられない）
+        del grown
+        self._matrix = None
+        os.replace(tmp_path, self.matrix_path)
+        self._matrix = np.load(self.matrix_path, mmap_mode="r+")
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:len(self._alive)] = self._alive
+        self._alive = alive
+
+    def _embed(self, texts):
+        return self._normalize(self.embed_fn(list(texts)))
+
+    def _normalize(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        ids, documents = list(ids), list(documents)
+        metadatas = list(metadatas) if metadatas else [None] * len(ids)
+        # ChromaDB と同様、既に存在するIDは追加しない
+        if ids:
+            existing = {mem_id for (mem_id,) in self.db.fetchall(
+                f"SELECT id FROM memory_vectors WHERE deleted = 0 AND id IN ({','.join('?' * len(ids))})", ids
+            )}
+            if existing:
+                keep = [i for i, mem_id in enumerate(ids) if mem_id not in existing]
+                ids = [ids[i] for i in keep]
+                documents = [documents[i] for i in keep]
+                metadatas = [metadatas[i] for i in keep]
+                embeddings = [embeddings[i] for i in keep] if embeddings is not None else None
+        if not ids:
+            return
+        vectors = self._embed(documents) if embeddings is None else self._normalize(embeddings)
+        with self._lock:
+            # 削除済みの行を先に再利用し、足りない分だけ末尾に追記する（行列が際限なく伸びないように）
+            free = [int(r) for r in np.flatnonzero(~self._alive[:self._size])][:len(ids)]
+            rows = free + list(range(self._size, self._size + len(ids) - len(free)))
+            self._ensure_capacity(max(rows) + 1, vectors.shape[1])
+            # 1. メタデータを削除済みの状態で登録 -> 2. ベクトルを書き込む -> 3. 有効にする、の順で確定させる
+            # （途中で落ちても、再利用した行の古いベクトルや書きかけのベクトルが有効な思い出として残らない）
+            self.db.executemany(
+                "INSERT OR REPLACE INTO memory_vectors (row, id, document, metadata, deleted) VALUES (?, ?, ?, ?, 1)",
+                [(row, mem_id, doc, json.dumps(meta, ensure_ascii=False) if meta else None)
+                 for row, mem_id, doc, meta in zip(rows, ids, documents, metadatas)]
+            )
+            self._matrix[rows] = vectors
+            self._matrix.flush()
+            self.db.executemany("UPDATE memory_vectors SET deleted = 0 WHERE row = ?", [(row,) for row in rows])
+            self._alive[rows] = True
+            self._size = max(self._size, max(rows) + 1)
+
+    def query_items(self, query_text, n_results=2):
+        query_vec = self._embed([query_text])[0]
+        with self._lock:
+            if self._matrix is None:
+                return []
+            n = min(self._size, self._matrix.shape[0])
+            scores = np.asarray(self._matrix[:n] @ query_vec)
+            scores[~self._alive[:n]] = -np.inf
+            k = min(n_results, int(self._alive[:n].sum()))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+        rows = [int(r) for r in top]
+        placeholders = ",".join("?" * len(rows))
+        found = {r: (doc, json.loads(meta) if meta else {}) for r, doc, meta in self.db.fetchall(
+            f"SELECT row, document, metadata FROM memory_vectors WHERE row IN ({placeholders})", rows
+        )}
+        return [found[r] for r in rows if r in found]
+
+    def delete(self, ids):
+        ids = list(ids)
+        if not ids:
+            return
+        with self._lock:
+            placeholders = ",".join("?" * len(ids))
+            rows = [r for (r,) in self.db.fetchall(
+                f"SELECT row FROM memory_vectors WHERE id IN ({placeholders})", ids
+            )]
+            self.db.execute(f"UPDATE memory_vectors SET deleted = 1 WHERE id IN ({placeholders})", ids)
+            for r in rows:
+                self._alive[r] = False
+
+    def count(self):
+        with self._lock:
+            return int(self._alive[:self._size].sum())
+
+    def metadata_items(self):
+        rows = self.db.fetchall("SELECT id, metadata FROM memory_vectors WHERE deleted = 0 ORDER BY row")
+        return [(mem_id, json.loads(meta) if meta else {}) for mem_id, meta in rows]
+
+    def iter_items(self, batch_size=256):
+        last_row = -1
+        while True:
+            rows = self.db.fetchall(
+                "SELECT row, id, document, metadata FROM memory_vectors WHERE deleted = 0 AND row > ? ORDER BY row LIMIT ?",
+                (last_row, batch_size)
+            )
+            if not rows:
+                return
+            # 行列は拡張・再埋め込みで差し替えられるため、ロック中に必要な行だけ読み出しておく
+            with self._lock:
+                vectors = np.asarray(self._matrix[[row for row, _, _, _ in rows]]).tolist()
+            for (row, mem_id, doc, meta), vector in zip(rows, vectors):
+                yield mem_id, doc, json.loads(meta) if meta else {}, vector
+            last_row = rows[-1][0]
+
+    def reembed(self, batch_size=256):
+        rows = self.db.fetchall("SELECT row, document FROM memory_vectors WHERE deleted = 0 ORDER BY row")
+        with self._lock:
+            if not rows:
+                return 0
+            # 行番号はそのままに、新しい行列を別ファイルに書いてから差し替える
+            capacity = max(self.initial_capacity, self._matrix.shape[0] if self._matrix is not None else 0, self._size)
+            tmp_path = self.matrix_path + ".tmp.npy"
+            rebuilt = None
+            for i in range(0, len(rows), batch_size):
+                chunk = rows[i:i + batch_size]
+                vectors = self._embed([doc for _, doc in chunk])
+                if rebuilt is None:
+                    rebuilt = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                                        shape=(capacity, vectors.shape[1]))
+                rebuilt[[r for r, _ in chunk]] = vectors
+                print(f"[Memory] 再埋め込み: {min(i + batch_size, len(rows))}/{len(rows)}")
+            rebuilt.flush()
+            del rebuilt
+            self._matrix = None
+            os.replace(tmp_path, self.matrix_path)
+            self._matrix = np.load(self.matrix_path, mmap_mode="r+")
+            alive = np.zeros(max(capacity, len(self._alive)), dtype=bool)
+            alive[[r for r, _ in rows]] = True
+            self._alive = alive
+        return len(rows)
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    複数の検索結果の順位を RRF（Σ 1 / (k + 順位)）で統合する。
+    rankings: [[key, ...], ...]（それぞれ関連度順） -> 統合後の key のリスト
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda key: -scores[key])
+
+
+def create_memory_store(config, embed_fn, db):
+    """設定 memory_store（"chroma" / "numpy"）に応じた記憶ストアを生成する"""
+    backend = config.get("memory_store", "chroma")
+    if backend == "numpy":
+        return NumpyMemoryStore(
+            embed_fn,
+            db,
+            matrix_path=config.get("memory_vectors_path", "komomo_v4_memory_vectors.npy"),
+        )
+    return ChromaMemoryStore(embed_fn)
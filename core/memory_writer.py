@@ -0,0 +1,150 @@
+"""
+Komomo System Core - Buffered Memory Writer
+Version: v4.3.0
+
+[役割]
+記憶ストアへの思い出の追加を、まとめて行うための書き込みバッファ。
+1ターンごとに埋め込み計算と索引更新を行う代わりに、件数または経過時間のしきい値でまとめて追加し、
+埋め込みのバッチ推論と索引更新のコストを複数ターンで分け合います。
+
+[主な機能]
+- 件数（max_batch）・経過時間（max_delay）・終了時のいずれかでのまとめ書き込み
+- 単調増加で衝突しない思い出ID（同じ時刻に複数のターンが終わっても重複しない）
+- 書き込み時間の計測（直近の平均・p95・最大）
+- 失敗した思い出の再試行（1件あたりの試行回数とバッファの件数に上限。超えた分はログに残して破棄）
+"""
+import threading
+import time
+from collections import deque
+
+
+class BufferedMemoryWriter:
+    def __init__(self, store, max_batch=8, max_delay=5.0, max_attempts=3, max_buffer=256):
+        """
+        store        : 書き込み先の MemoryStore
+        max_batch    : この件数が溜まったら即座に書き込む
+        max_delay    : 最初の1件が溜まってからこの秒数が経ったら書き込む
+        max_attempts : 1件の思い出を書き込もうとする回数の上限（書き込めない文書が後続を止め続けないように）
+        max_buffer   : 書き込み失敗で溜まった分も含めたバッファの上限（超えたら古いものから破棄）
+        """
+        self.store = store
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay
+        self.max_attempts = max(1, max_attempts)
+        self.max_buffer = max(self.max_batch, max_buffer)
+        self._buffer = []
+        self._first_buffered_at = None
+        self._last_id_ns = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        # (書き込み件数, 所要秒数) の履歴
+        self._flushes = deque(maxlen=100)
+        self.failures = 0
+        self.dropped = 0
+        threading.Thread(target=self._timer_loop, name="komomo-memory-writer", daemon=True).start()
+
+    def new_id(self):
+        """単調増加する思い出IDを発行する（時刻[ns]ベース。同じ時刻なら1ずつずらす）"""
+        with self._lock:
+            self._last_id_ns = max(time.time_ns(), self._last_id_ns + 1)
+            return f"mem_{self._last_id_ns}"
+
+    def add(self, document, metadata=None):
+        """思い出をバッファに積み、発行したIDを返す"""
+        mem_id = self.new_id()
+        with self._lock:
+            self._buffer.append((mem_id, document, metadata, 0))
+            if self._first_buffered_at is None:
+                self._first_buffered_at = time.monotonic()
+            full = len(self._buffer) >= self.max_batch
+        if full:
+            self.flush()
+        else:
+            self._wakeup.set()
+        return mem_id
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """バッファの内容をまとめて記憶ストアへ書き込む"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                self._first_buffered_at = None
+            if not batch:
+                return 0
+            started = time.perf_counter()
+            try:
+                self.store.add(
+                    ids=[mem_id for mem_id, _, _, _ in batch],
+                    documents=[doc for _, doc, _, _ in batch],
+                    metadatas=[meta for _, _, meta, _ in batch],
+                )
+            except Exception as e:
+                self.failures += 1
+                self._requeue(batch, e)
+                return 0
+            elapsed = time.perf_counter() - started
+            self._flushes.append((len(batch), elapsed))
+            print(f"[MemoryWriter] 思い出 {len(batch)}件を書き込みました ({elapsed * 1000:.0f}ms)")
+            return len(batch)
+
+    def _requeue(self, batch, error):
+        """失敗した分をバッファの先頭に戻して次回再試行する（試行回数・バッファの上限を超えた分は破棄）"""
+        retry = [(mem_id, doc, meta, attempts + 1) for mem_id, doc, meta, attempts in batch
+                 if attempts + 1 < self.max_attempts]
+        expired = len(batch) - len(retry)
+        with self._lock:
+            self._buffer = retry + self._buffer
+            overflow = max(0, len(self._buffer) - self.max_buffer)
+            # 古いものから捨てる（バッファの先頭ほど古い）
+            del self._buffer[:overflow]
+            if self._buffer:
+                self._first_buffered_at = self._first_buffered_at or time.monotonic()
+        self.dropped += expired + overflow
+        print(f"[MemoryWriter] 書き込み失敗 ({len(batch)}件、{len(retry)}件を次回再試行): {error}")
+        if expired or overflow:
+            # 会話履歴には残っているため、次回起動時の未登録チェックで登録し直される
+            print(f"[MemoryWriter] 再試行の上限を超えた思い出 {expired}件・バッファから溢れた思い出 {overflow}件を破棄しました")
+
+    def metrics(self):
+        """書き込み時間の統計（秒）"""
+        durations = sorted(d for _, d in self._flushes)
+        if not durations:
+            return {"flushes": 0, "items": 0, "pending": self.pending(), "failures": self.failures,
+                    "dropped": self.dropped}
+        return {
+            "flushes": len(durations),
+            "items": sum(n for n, _ in self._flushes),
+            "pending": self.pending(),
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "mean": sum(durations) / len(durations),
+            "p95": durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            "max": durations[-1],
+        }
+
+    def close(self):
+        """残りを書き込んで停止する（終了時用）"""
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+    def _timer_loop(self):
+        while not self._closed:
+            with self._lock:
+                first = self._first_buffered_at
+            if first is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            remaining = self.max_delay - (time.monotonic() - first)
+            if remaining > 0:
+                self._wakeup.wait(timeout=remaining)
+                self._wakeup.clear()
+                continue
+            self.flush()
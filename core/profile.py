@@ -0,0 +1,72 @@
+"""
+Komomo System Core - User Profile Cache
+Version: v4.3.0
+
+[役割]
+ユーザープロフィール（user_profile テーブル）をメモリ上に保持するモジュール。
+起動時に1度だけ読み込み、以降は事実の保存経路からの書き込みで更新する（ライトスルー）ため、
+毎ターンの SELECT と文字列の組み立て直しが不要になります。
+
+[主な機能]
+- プロフィールの [(key, value), ...]（新しく更新された順）と描画済みの節文字列のキャッシュ
+- 内容が変わった時だけ進む版番号（PromptBuilder のプレフィックスキャッシュのキー）
+"""
+import threading
+
+from core.prompt import render_profile
+
+
+class UserProfile:
+    def __init__(self, db):
+        """db: user_profile テーブルを持つ MemoryDB"""
+        self.db = db
+        self.version = 0
+        self._entries = {}
+        self._items = None
+        self._summary = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """DBから読み込み直す（起動時、またはDBを外部で書き換えた時）"""
+        rows = self.db.fetchall("SELECT key, value, updated_at FROM user_profile")
+        with self._lock:
+            self._entries = {k: (v, updated_at or "") for k, v, updated_at in rows}
+            self._invalidate()
+
+    def update(self, facts, updated_at):
+        """DBに保存した事実をメモリ上にも反映する"""
+        if not facts:
+            return
+        with self._lock:
+            for k, v in facts.items():
+                self._entries[k] = (str(v), updated_at)
+            # 同じ値でも更新日時（＝並び順）が変わるため、常に版を進める
+            self._invalidate()
+
+    def _invalidate(self):
+        self.version += 1
+        self._items = None
+        self._summary = None
+
+    def _ordered_items(self):
+        if self._items is None:
+            ordered = sorted(self._entries.items(), key=lambda e: e[1][1], reverse=True)
+            self._items = [(k, v) for k, (v, _) in ordered]
+        return self._items
+
+    def items(self):
+        """[(key, value), ...]（新しく更新された順）"""
+        return self.snapshot()[1]
+
+    def snapshot(self):
+        """(版番号, [(key, value), ...]) を同じ時点の組として返す"""
+        with self._lock:
+            return self.version, self._ordered_items()
+
+    def summary(self):
+        """描画済みのプロフィール節（変更があった時だけ作り直す）"""
+        with self._lock:
+            if self._summary is None:
+                self._summary = render_profile(self._ordered_items())
+            return self._summary
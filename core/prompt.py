@@ -0,0 +1,222 @@
+"""
+Komomo System Core - Prompt Builder
+Version: v4.3.0
+
+[役割]
+LLMへ渡すシステムプロンプトを組み立てるモジュール。
+キャラクター設定・記憶の取り扱い方針・プロフィール・最近の会話・関連する思い出を
+トークン予算内に収まるよう優先度順に取捨選択し、重複した記憶を取り除きます。
+プロフィール表が育っても、入力トークン（応答遅延・コスト）が際限なく増えなくなります。
+
+[主な機能]
+- ローカルのトークナイザ（tiktoken、未導入時は文字種ベースの概算）によるトークン数計測
+- 「最近の会話」と「関連する思い出」の両方に現れる記憶の重複除去
+- 優先度（新しい会話 > 関連する思い出 > 古い会話）に基づく予算内への切り詰め
+  （プロフィールは専用枠の中で、新しく更新された順に採用）
+- ターンごとの最終プロンプトサイズのレポート
+- プロバイダのプレフィックスキャッシュが効くよう、不変部分（キャラ設定・方針・版付きプロフィール）と
+  毎ターン変わる部分（最近の会話・関連する思い出）を分離
+- 各記憶セクションの描画（EgoPlugin と共通の書式）
+"""
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+PROFILE_HEADER = "\n### あなたが覚えているあっきーの情報 ###\n"
+PROFILE_FOOTER = "########################################\n"
+RECENT_HEADER = "\n### 最近の二人の会話の思い出 ###\n"
+RECENT_FOOTER = "##################################\n"
+SEMANTIC_HEADER = "\n### 関連する過去の思い出 ###\n"
+SEMANTIC_FOOTER = "###########################\n"
+
+
+def render_profile(items):
+    """[(key, value), ...] -> プロフィール節"""
+    if not items:
+        return ""
+    return PROFILE_HEADER + "".join(f"・{k}: {v}\n" for k, v in items) + PROFILE_FOOTER
+
+
+def render_dialogue(user_text, ai_response):
+    """1往復分の会話（ChromaDBに保存する思い出と同じ書式）"""
+    return f"あっきー: {user_text}\nこもも: {ai_response}"
+
+
+def render_recent(items):
+    """[(user_text, ai_response), ...]（古い順） -> 最近の会話節"""
+    if not items:
+        return ""
+    return RECENT_HEADER + "".join(render_dialogue(u, a) + "\n" for u, a in items) + RECENT_FOOTER
+
+
+def render_semantic(docs):
+    """[思い出の文書, ...]（関連度順） -> 関連する思い出節"""
+    if not docs:
+        return ""
+    return SEMANTIC_HEADER + "".join(f"・{doc}\n" for doc in docs) + SEMANTIC_FOOTER
+
+
+def _dedup_key(text):
+    return re.sub(r'\s', '', text)
+
+
+class BuiltPrompt:
+    """
+    組み立て済みのシステムプロンプト。
+    prefix : キャラ設定＋方針＋プロフィール（ターンをまたいでバイト単位で不変＝プロバイダのキャッシュ対象）
+    suffix : 最近の会話＋関連する思い出（毎ターン変わる部分）
+    """
+
+    def __init__(self, prefix, suffix, tokens, profile_version):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.tokens = tokens
+        self.profile_version = profile_version
+
+    @property
+    def text(self):
+        return self.prefix + self.suffix
+
+    def __str__(self):
+        return self.text
+
+
+class PromptBuilder:
+    def __init__(self, token_budget=3000, profile_budget=None, encoding="o200k_base"):
+        """
+        token_budget   : システムプロンプト全体のトークン上限
+        profile_budget : プロフィール節の上限（既定は全体の1/3）
+                         プレフィックスを不変に保つため、プロフィールは会話側の量に関係なく
+                         この枠の中だけで切り詰める
+        """
+        self.token_budget = token_budget
+        self.profile_budget = profile_budget if profile_budget is not None else token_budget // 3
+        self.encoder = None
+        if tiktoken is not None:
+            try:
+                self.encoder = tiktoken.get_encoding(encoding)
+            except Exception as e:
+                print(f"[Prompt] トークナイザ読み込み失敗、概算で計測します: {e}")
+        # プロフィール節のスナップショット（内容が変わった時だけ版を進める）
+        self.profile_version = 0
+        self._profile_snapshot = None
+        self._prefix_cache = (None, None)
+        self.last_report = {}
+
+    def count_tokens(self, text):
+        if not text:
+            return 0
+        if self.encoder is not None:
+            return len(self.encoder.encode(text))
+        # 概算：ASCIIは約4文字で1トークン、日本語などはほぼ1文字1トークン
+        ascii_chars = sum(1 for c in text if ord(c) < 128)
+        return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+    def build(self, instruction, rules, profile_items=(), recent_items=(), semantic_docs=(), profile_version=None):
+        """
+        instruction     : キャラクター設定（必ず含める）
+        rules           : 記憶と知識の取り扱い方針（必ず含める）
+        profile_items   : [(key, value), ...]（新しく更新された順）
+        profile_version : プロフィールの版番号（UserProfile.version）。指定時は項目の比較を省き、
+                          版番号が同じならプレフィックスを組み立て直さない
+        recent_items    : [(user_text, ai_response), ...]（古い順）
+        semantic_docs   : [文書, ...]（関連度順）
+        戻り値: BuiltPrompt（不変のプレフィックス＋変動するサフィックス）
+        """
+        recent_items = list(recent_items)
+        profile_items = list(profile_items)
+
+        # 1. 不変プレフィックス：キャラ設定＋方針＋プロフィール（会話側の内容には依存させない）
+        prefix, prefix_tokens, kept_profile = self._build_prefix(instruction, rules, profile_items, profile_version)
+
+        # 2. 重複除去：最近の会話に既に含まれる思い出、および思い出同士の重複を除く
+        seen = {_dedup_key(render_dialogue(u, a)) for u, a in recent_items}
+        docs = []
+        for doc in semantic_docs:
+            key = _dedup_key(doc)
+            if key in seen:
+                continue
+            seen.add(key)
+            docs.append(doc)
+        deduped = len(semantic_docs) - len(docs)
+
+        # 3. 残りの予算で、変動部分の候補を優先度の高い順に採用する
+        used = prefix_tokens
+        candidates = []
+        for age, item in enumerate(reversed(recent_items)):
+            # 直近2往復は会話の流れに必須なので最優先、それより古いものは思い出より下
+            priority = 100 - age if age < 2 else 40 - age
+            candidates.append((priority, "recent", item, render_dialogue(*item) + "\n"))
+        for rank, doc in enumerate(docs):
+            candidates.append((60 - rank, "semantic", doc, f"・{doc}\n"))
+
+        # 節の見出し分も予算に含める
+        header_cost = {
+            "recent": self.count_tokens(RECENT_HEADER + RECENT_FOOTER),
+            "semantic": self.count_tokens(SEMANTIC_HEADER + SEMANTIC_FOOTER),
+        }
+        chosen = {"recent": set(), "semantic": set()}
+        for priority, section, item, line in sorted(candidates, key=lambda c: -c[0]):
+            cost = self.count_tokens(line) + (0 if chosen[section] else header_cost[section])
+            if used + cost > self.token_budget:
+                continue
+            used += cost
+            chosen[section].add(item)
+
+        # 4. 採用したものを元の並び順で描画
+        kept_recent = [i for i in recent_items if i in chosen["recent"]]
+        kept_docs = [d for d in docs if d in chosen["semantic"]]
+        suffix = f"{render_recent(kept_recent)}\n{render_semantic(kept_docs)}"
+
+        total = prefix_tokens + self.count_tokens(suffix)
+        self.last_report = {
+            "tokens": total,
+            "prefix_tokens": prefix_tokens,
+            "budget": self.token_budget,
+            "profile_version": self.profile_version,
+            "profile": (len(kept_profile), len(profile_items)),
+            "recent": (len(kept_recent), len(recent_items)),
+            "semantic": (len(kept_docs), len(docs)),
+            "deduplicated": deduped,
+        }
+        print(
+            f"[Prompt] {total}/{self.token_budget} tokens (prefix {prefix_tokens}, profile v{self.profile_version}"
+            f" {len(kept_profile)}/{len(profile_items)},"
+            f" recent {len(kept_recent)}/{len(recent_items)},"
+            f" semantic {len(kept_docs)}/{len(docs)}, 重複除去 {deduped})"
+        )
+        return BuiltPrompt(prefix, suffix, total, self.profile_version)
+
+    def _build_prefix(self, instruction, rules, profile_items, profile_version=None):
+        """プレフィックスを組み立てる。入力が前回と同じなら同じ文字列をそのまま返す"""
+        if profile_version is not None:
+            cache_key = (instruction, rules, "version", profile_version)
+        else:
+            cache_key = (instruction, rules, tuple(profile_items))
+        if self._prefix_cache[0] == cache_key:
+            return self._prefix_cache[1]
+
+        fixed = f"{instruction}\n{rules}\n"
+        fixed_tokens = self.count_tokens(fixed)
+        limit = min(self.profile_budget, max(0, self.token_budget - fixed_tokens))
+        used = self.count_tokens(PROFILE_HEADER + PROFILE_FOOTER)
+        kept_profile = []
+        for item in profile_items:
+            cost = self.count_tokens(f"・{item[0]}: {item[1]}\n")
+            if used + cost > limit:
+                continue
+            used += cost
+            kept_profile.append(item)
+
+        profile_block = render_profile(kept_profile)
+        if profile_block != self._profile_snapshot:
+            self._profile_snapshot = profile_block
+            self.profile_version += 1
+
+        prefix = f"{fixed}{profile_block}\n"
+        result = (prefix, self.count_tokens(prefix), kept_profile)
+        self._prefix_cache = (cache_key, result)
+        return result
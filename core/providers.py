@@ -0,0 +1,136 @@
+"""
+Komomo System Core - LLM Provider Registry
+Version: v4.3.0
+
+[役割]
+LLMプロバイダ（OpenAI, Gemini, Groq）ごとの稼働状況を記録し、
+故障中のプロバイダを会話の経路から外す「サーキットブレーカー」を提供するモジュール。
+Quota切れ（429）や5xxが続くプロバイダに、毎ターン timeout 分の待ち時間を払わなくなります。
+
+[主な機能]
+- プロバイダごとの直近の成功率・応答時間（p95）の記録
+- 連続失敗時の回路オープン（以降は呼び出しをスキップ）
+- クールダウン後、バックグラウンドでの半開（half-open）プローブによる自動復帰
+"""
+import time
+import threading
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """1プロバイダ分の稼働統計と回路の状態"""
+
+    def __init__(self, name, window=20):
+        self.name = name
+        # 直近の呼び出し結果 (成功フラグ)
+        self.results = deque(maxlen=window)
+        # モードごとの直近の応答時間[秒]（"response": 全文, "stream": 最初の1文）
+        self.latencies = {}
+        self.window = window
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.cooldown = 0.0
+
+    @property
+    def success_rate(self):
+        if not self.results:
+            return 1.0
+        return sum(self.results) / len(self.results)
+
+    def p95(self, mode):
+        samples = sorted(self.latencies.get(mode, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))], len(samples)
+
+
+class ProviderRegistry:
+    def __init__(self, names, failure_threshold=3, cooldown=30.0, max_cooldown=300.0, probe=None):
+        """
+        failure_threshold : 何回連続で失敗したら回路を開くか
+        cooldown          : 回路を開いてから最初のプローブまでの秒数（失敗ごとに倍増）
+        max_cooldown      : クールダウンの上限秒数
+        probe             : probe(name) -> bool。半開状態で復帰を確認する軽量な呼び出し
+        """
+        self.providers = {name: ProviderHealth(name) for name in names}
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe = probe
+        self._lock = threading.Lock()
+        threading.Thread(target=self._probe_loop, name="komomo-provider-probe", daemon=True).start()
+
+    def is_available(self, name):
+        """ホットパスで呼んでよいか（回路が閉じている場合のみ True）"""
+        with self._lock:
+            return self.providers[name].state == CLOSED
+
+    def record_success(self, name, mode=None, seconds=None):
+        with self._lock:
+            health = self.providers[name]
+            health.results.append(True)
+            if mode is not None and seconds is not None:
+                health.latencies.setdefault(mode, deque(maxlen=health.window * 2)).append(seconds)
+            health.consecutive_failures = 0
+            if health.state != CLOSED:
+                print(f"[Provider] {name} 復帰しました（回路クローズ）")
+            health.state = CLOSED
+            health.cooldown = 0.0
+
+    def record_failure(self, name, reason=""):
+        with self._lock:
+            health = self.providers[name]
+            health.results.append(False)
+            health.consecutive_failures += 1
+            if health.state == CLOSED and health.consecutive_failures < self.failure_threshold:
+                return
+            # 閾値到達、または半開プローブの失敗 -> 回路を開く（クールダウンは倍々で延長）
+            health.cooldown = min(self.max_cooldown, health.cooldown * 2 or self.base_cooldown)
+            health.opened_at = time.monotonic()
+            if health.state != OPEN:
+                print(f"[Provider] {name} を一時停止します（{health.consecutive_failures}回連続失敗: {reason}）"
+                      f" {health.cooldown:.0f}s 後に再確認")
+            health.state = OPEN
+
+    def p95_latency(self, name, mode, min_samples=5):
+        """直近の応答時間の p95（サンプル不足時は None）"""
+        with self._lock:
+            result = self.providers[name].p95(mode)
+        if result is None or result[1] < min_samples:
+            return None
+        return result[0]
+
+    def snapshot(self):
+        """各プロバイダの状態一覧（デバッグ・表示用）"""
+        with self._lock:
+            return {
+                name: {"state": h.state, "success_rate": h.success_rate,
+                       "consecutive_failures": h.consecutive_failures}
+                for name, h in self.providers.items()
+            }
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(1.0)
+            due = []
+            with self._lock:
+                now = time.monotonic()
+                for name, health in self.providers.items():
+                    if health.state == OPEN and now - health.opened_at >= health.cooldown:
+                        health.state = HALF_OPEN
+                        due.append(name)
+            for name in due:
+                ok = False
+                try:
+                    ok = bool(self.probe(name)) if self.probe else True
+                except Exception as e:
+                    print(f"[Provider] {name} プローブ失敗: {e}")
+                if ok:
+                    self.record_success(name)
+                else:
+                    self.record_failure(name, "probe")
@@ -0,0 +1,131 @@
+"""
+Komomo System Core - Turn Scheduler
+Version: v4.3.0
+
+[役割]
+ユーザー発話（GUI入力・音声認識）を「ターン」として一元管理するモジュール。
+入力ごとにスレッドを立てる代わりに、上限付きキューと固定数のワーカーで処理し、
+LLM・VoiceVox・SQLite への同時アクセスの競合を防ぎます。
+
+[主な機能]
+- 上限付きキューと設定可能なワーカー数によるターン実行（満杯時は受付拒否）
+- 割り込み（バージイン）：新しい発話が来たら処理中・待機中の古いターンを取り消し
+- ターンごとの取り消しフラグ（LLMストリーミングや発声パイプラインが参照）
+- 受付のたびの割り込み通知（ターン完了後も再生が続く古い回答を止めるため）
+"""
+import queue
+import threading
+import itertools
+import time
+import traceback
+
+
+class Turn:
+    """1回分のユーザー発話と、その取り消し状態"""
+
+    def __init__(self, turn_id, text):
+        self.id = turn_id
+        self.text = text
+        self.created_at = time.time()
+        self.cancel_event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+class TurnScheduler:
+    def __init__(self, handler, workers=1, max_queue=4, barge_in=True, on_cancel=None,
+                 on_barge_in=None):
+        """
+        handler   : ターンを処理する関数 handler(turn)
+        workers   : 同時に処理するターン数
+        max_queue : 待機できるターン数の上限（超えた入力は拒否＝バックプレッシャー）
+        barge_in  : True なら新しい発話の受付時に古いターンをすべて取り消す
+        on_cancel : ターン取り消し時に呼ばれる関数 on_cancel(turn)
+        on_barge_in : 割り込み有効時、発話を受け付けるたびに呼ばれる関数 on_barge_in(turn)
+                      ターンは回答の配送直後に完了扱いになるが、発声・再生はその後も続くため、
+                      処理中のターンがなくても古い回答の再生を止められるよう毎回通知する
+        """
+        self.handler = handler
+        self.barge_in = barge_in
+        self.on_cancel = on_cancel
+        self.on_barge_in = on_barge_in
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # 受付済みで未完了のターン（待機中＋処理中）
+        self._active = {}
+
+        for i in range(max(1, workers)):
+            threading.Thread(target=self._worker, name=f"komomo-turn-{i}", daemon=True).start()
+
+    def submit(self, text):
+        """発話をターンとして投入する。キュー満杯で受け付けられない場合は None を返す"""
+        turn = Turn(next(self._ids), text)
+        if self.barge_in:
+            self.cancel_all(reason=f"新しい発話 #{turn.id}")
+        with self._lock:
+            if self.barge_in:
+                # 取り消し済みの待機ターンがキューの枠を占めたまま新しい発話を拒否しないよう、先に取り除く
+                self._drain_cancelled()
+            try:
+                self.queue.put_nowait(turn)
+            except queue.Full:
+                print(f"[Scheduler] キュー満杯のため入力を拒否しました: {text[:10]}...")
+                return None
+            self._active[turn.id] = turn
+        if self.barge_in and self.on_barge_in:
+            try:
+                self.on_barge_in(turn)
+            except Exception as e:
+                print(f"[Scheduler] 割り込み通知エラー: {e}")
+        return turn
+
+    def _drain_cancelled(self):
+        """キューで待機中の取り消し済みターンを取り除く（_lock を保持して呼ぶ）"""
+        kept = []
+        while True:
+            try:
+                turn = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.queue.task_done()
+            if turn.cancelled:
+                self._active.pop(turn.id, None)
+            else:
+                kept.append(turn)
+        for turn in kept:
+            self.queue.put_nowait(turn)
+
+    def cancel_all(self, reason=""):
+        """待機中・処理中のすべてのターンを取り消す"""
+        with self._lock:
+            targets = [t for t in self._active.values() if not t.cancelled]
+            for turn in targets:
+                turn.cancel()
+        for turn in targets:
+            print(f"[Scheduler] ターン #{turn.id} を取り消しました ({reason})")
+            if self.on_cancel:
+                try:
+                    self.on_cancel(turn)
+                except Exception as e:
+                    print(f"[Scheduler] 取り消し通知エラー: {e}")
+
+    def _worker(self):
+        while True:
+            turn = self.queue.get()
+            try:
+                if turn.cancelled:
+                    continue
+                self.handler(turn)
+            except Exception as e:
+                print(f"[Scheduler] ターン #{turn.id} 処理エラー: {e}")
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    self._active.pop(turn.id, None)
+                self.queue.task_done()
@@ -25,8 +25,28 @@ class KomomoSpecs:
         """ユーザー入力時"""
 
     @hookspec
-    def on_llm_response_generated(self, response_text: str):
-        """LLM回答時"""
+    def on_partial_transcript(self, text: str):
+        """音声認識の途中経過（話している最中に逐次通知。確定した結果は on_query_received）"""
+
+    @hookspec
+    def on_llm_response_generated(self, response_text: str, turn_id: int):
+        """LLM回答時（turn_id はターン外の発話なら None）"""
+
+    @hookspec
+    def on_llm_sentence_generated(self, sentence_text: str, turn_id: int):
+        """LLMストリーミング回答時（文単位で逐次通知）"""
+
+    @hookspec
+    def on_llm_stream_completed(self, response_text: str):
+        """LLMストリーミング回答の完了時（全文）"""
+
+    @hookspec
+    def on_turn_cancelled(self, turn_id: int):
+        """新しい発話による割り込みで、処理中のターンが取り消された時"""
+
+    @hookspec
+    def on_barge_in(self, turn_id: int):
+        """割り込み有効時に新しい発話を受け付けた時（それより前のターンの発声・再生は止める）"""
 
     @hookspec
     def on_audio_generated(self, audio_data: bytes):
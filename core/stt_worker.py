@@ -0,0 +1,196 @@
+"""
+Komomo System Core - Speech Recognition Worker Process
+Version: v4.3.0
+
+[役割]
+音声認識（Whisper）を GUI・会話処理とは別のプロセスで動かすためのモジュール。
+モデルの読み込みと推論を専用のワーカープロセスに任せることで、解析中も
+Tk の画面や他のスレッドが Python の処理待ち（GIL）で固まらないようにします。
+
+[主な機能]
+- 起動時にモデルを読み込み、ダミー音声で1度推論してから（ウォームアップ）準備完了を通知
+- 上限付きの依頼キュー（解析が詰まっている時は呼び出し側で待つ／諦める）
+- STTBackend と同じ transcribe で呼び出せるクライアント
+- ワーカープロセスが異常終了した場合、待っている呼び出しをエラーで解放
+- 応答の待ち時間の上限と、停止・無応答になったワーカーの再起動（上限回数を超えたら STTWorkerUnavailable）
+"""
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from core.stt_backend import STTBackend, create_stt_backend
+
+
+def run_stt_worker(config, requests, responses, ready):
+    """
+    ワーカープロセスの本体（spawn で起動できるようにトップレベル関数にしている）
+    requests  : (依頼番号, 音声, プロンプト, condition_on_previous_text) を受け取るキュー（None で終了）
+    responses : (依頼番号, セグメント, エラー文字列) を返すキュー
+    ready     : ウォームアップまで終わったら set するイベント
+    """
+    try:
+        backend = create_stt_backend(config)
+        backend.warm_up()
+    except Exception:
+        responses.put((None, None, traceback.format_exc()))
+        return
+    ready.set()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, audio, prompt, condition_on_previous_text = request
+        try:
+            responses.put((request_id, backend.transcribe(audio, prompt, condition_on_previous_text), None))
+        except Exception as e:
+            responses.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class STTWorkerUnavailable(RuntimeError):
+    """ワーカープロセスが停止し、再起動もできない（呼び出し側はこのプロセス内での解析に切り替える）"""
+
+
+class STTWorkerClient(STTBackend):
+    def __init__(self, config, max_pending=4, submit_timeout=30.0, result_timeout=60.0, max_restarts=2,
+                 ready_timeout=300.0):
+        """
+        config         : 音声認識エンジンの設定（create_stt_backend に渡す）
+        max_pending    : ワーカーに同時に預けられる依頼の上限
+        submit_timeout : 依頼キューが空くのを待つ最大秒数
+        result_timeout : 1件の解析結果を待つ最大秒数（超えたらワーカーが固まったとみなして再起動する）
+        max_restarts   : 停止・無応答になったワーカーを再起動する回数の上限
+        ready_timeout  : モデルの読み込みとウォームアップを待つ最大秒数（起動時・再起動時とも）
+        """
+        self._ctx = multiprocessing.get_context("spawn")
+        self.config = config
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.result_timeout = result_timeout
+        self.restarts_left = max_restarts
+        self.ready_timeout = ready_timeout
+        self._pending = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._closed = False
+        self._start()
+
+    def _start(self):
+        """ワーカープロセスと受信スレッドを起動する（キューは起動ごとに作り直し、古いプロセスの応答を混ぜない）"""
+        self.ready = self._ctx.Event()
+        self._requests = self._ctx.Queue(maxsize=self.max_pending)
+        self._responses = self._ctx.Queue()
+        self.process = self._ctx.Process(target=run_stt_worker, name="komomo-stt-worker",
+                                         args=(self.config, self._requests, self._responses, self.ready),
+                                         daemon=True)
+        self.process.start()
+        threading.Thread(target=self._receive_loop, args=(self.process, self._responses),
+                         name="komomo-stt-receiver", daemon=True).start()
+
+    def wait_ready(self, timeout=None):
+        """モデルの読み込みとウォームアップが終わるまで待つ（ワーカーが落ちた・時間切れなら False）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready.wait(timeout=0.5):
+            if not self.process.is_alive():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return True
+
+    def transcribe(self, audio, prompt=None, condition_on_previous_text=True):
+        if not self.process.is_alive():
+            self._restart(f"停止しています (exit code: {self.process.exitcode})")
+        future = Future()
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = future
+        try:
+            self._requests.put((request_id, audio, prompt, condition_on_previous_text), timeout=self.submit_timeout)
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise RuntimeError("音声認識ワーカーの依頼キューが満杯です")
+        try:
+            return future.result(timeout=self.result_timeout)
+        except FutureTimeoutError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            # 固まったワーカーに後続の依頼を預け続けないよう、作り直してからこの依頼は失敗にする
+            self._restart(f"{self.result_timeout:.0f}秒以内に応答しませんでした", process=self.process)
+            raise RuntimeError("音声認識ワーカーが時間内に応答しませんでした")
+
+    def _restart(self, reason, process=None):
+        """
+        ワーカープロセスを作り直してウォームアップを待つ
+        process : 作り直す対象（別のスレッドが既に作り直していれば何もしない）
+        上限回数を使い切った・起動に失敗した場合は STTWorkerUnavailable
+        """
+        with self._restart_lock:
+            if self._closed:
+                raise STTWorkerUnavailable("音声認識ワーカーは停止済みです")
+            current = self.process
+            if (process is not None and process is not current) or (process is None and current.is_alive()):
+                return
+            if self.restarts_left <= 0:
+                raise STTWorkerUnavailable(f"音声認識ワーカーが{reason}（再起動の上限に達しました）")
+            self.restarts_left -= 1
+            print(f"[STT] 音声認識ワーカーが{reason}。再起動します（残り{self.restarts_left}回）")
+            if current.is_alive():
+                current.terminate()
+                current.join(timeout=5)
+            self._fail_pending(RuntimeError("音声認識ワーカーを再起動しました"))
+            self._start()
+            if not self.wait_ready(self.ready_timeout):
+                # 読み込み中に固まったワーカーを残さない（ロックを持ったまま待ち続けない）
+                if self.process.is_alive():
+                    self.process.terminate()
+                raise STTWorkerUnavailable("音声認識ワーカーを再起動できませんでした")
+
+    def _receive_loop(self, process, responses):
+        while not self._closed:
+            try:
+                request_id, segments, error = responses.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    if process is self.process:
+                        self._fail_pending(RuntimeError("音声認識ワーカーが異常終了しました"))
+                    if not self._closed:
+                        print(f"[STT] 音声認識ワーカーが終了しました (exit code: {process.exitcode})")
+                    return
+                continue
+            if request_id is None:
+                print(f"[STT] 音声認識ワーカーの起動に失敗しました:\n{error}")
+                continue
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(segments)
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def close(self):
+        """ワーカープロセスを止める（終了時用）"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._requests.put(None, timeout=1.0)
+        except queue.Full:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._fail_pending(RuntimeError("音声認識ワーカーを停止しました"))
@@ -8,12 +8,11 @@ Version: v4.3.0.12
 DBに直接的な答えがない場合にLLMが自律的に知識を活用できるよう、プロンプト構成を最適化。
 """
 import sys
-import os
 import threading
 import time
 import json
-import re
 import subprocess
+import multiprocessing
 import pluggy
 import traceback
 
@@ -23,6 +22,13 @@ try:
 except ModuleNotFoundError:
     from specs import KomomoSpecs
 
+from core.context import ContextAssembler
+from core.dispatch import HookDispatcher
+from core.scheduler import TurnScheduler
+from core import http_client
+from core.cache import ResponseCache, is_context_dependent, normalize_query
+from core.prompt import PromptBuilder
+
 # 各プラグインのインポート
 from plugins.llm_plugin import LLMPlugin
 from plugins.ego_plugin import EgoPlugin
@@ -44,6 +50,12 @@ class KomomoSystem:
         # 1. 設定の読み込み
         self._load_configuration()
 
+        # 記憶取得の並列化（ソースごとの締め切り付き）
+        self.context_assembler = ContextAssembler(
+            default_deadline=self.config.get("context_deadline_seconds", 3.0),
+            deadlines=self.config.get("context_deadlines", {}),
+        )
+
         # 2. pluggy PluginManagerの初期化と設計図登録
         self.pm = pluggy.PluginManager("komomo")
         self.pm.add_hookspecs(KomomoSpecs)
@@ -63,6 +75,38 @@ class KomomoSystem:
         for p in plugins:
             self.pm.register(p)
 
+        # 回答の配送は購読プラグインごとに並行実行する（遅いUnity送信等で会話を止めない）
+        self.dispatcher = HookDispatcher(
+            self.pm,
+            max_workers=self.config.get("dispatch_workers", 8),
+            default_timeout=self.config.get("dispatch_timeout_seconds", 60.0),
+            max_stuck=self.config.get("dispatch_max_stuck", 2),
+        )
+
+        # トークン予算付きのプロンプト組み立て（記憶の重複除去・優先度順の切り詰め）
+        self.prompt_builder = PromptBuilder(token_budget=self.config.get("prompt_token_budget", 3000))
+
+        # 定番の問いかけへの回答キャッシュ（オプトイン）
+        self.response_cache = None
+        if self.config.get("response_cache_enabled", False):
+            self.response_cache = ResponseCache(
+                maxsize=self.config.get("response_cache_size", 256),
+                ttl=self.config.get("response_cache_ttl", 3600),
+                similarity_threshold=self.config.get("response_cache_similarity"),
+                embed_fn=getattr(self.ego, "embed_texts", None),
+            )
+
+        # ユーザー発話は上限付きキューのターンとして順に処理する
+        # 新しい発話が来たら古いターン（LLM生成・合成・再生）を取り消す
+        self.scheduler = TurnScheduler(
+            self._process_turn,
+            workers=self.config.get("turn_workers", 1),
+            max_queue=self.config.get("turn_queue_size", 4),
+            barge_in=self.config.get("barge_in", True),
+            on_cancel=lambda turn: self.pm.hook.on_turn_cancelled(turn_id=turn.id),
+            on_barge_in=lambda turn: self.pm.hook.on_barge_in(turn_id=turn.id),
+        )
+
         # 5. 各プラグインへの初期化処理
         if hasattr(self.gui, 'pm'): self.gui.pm = self.pm
         
@@ -110,6 +154,7 @@ class KomomoSystem:
     def on_query_received(self, text):
         """
         GUIやSTTからの入力を中継する司令塔
+        受け付けたらターンとしてスケジューラへ投入し、すぐに呼び出し元へ返す
         """
         # --- 歌唱中はすべての入力を無視するガード ---
         if self.is_singing_now:
@@ -117,16 +162,25 @@ class KomomoSystem:
             return
 
         print(f"[Main] ユーザー入力: {text}")
+        if self.scheduler.submit(text) is None and hasattr(self.gui, "update_status"):
+            self.gui.update_status("ちょっと待ってね... 混み合ってるよ")
+
+    def _process_turn(self, turn):
+        """スケジューラのワーカー上で1ターンを処理する"""
+        text = turn.text
+        # キュー待ちの間に歌唱が始まった場合も応答しない
+        if self.is_singing_now:
+            return
 
         # 0. 音声認識の揺らぎ対策（正規化）
-        normalized_text = re.sub(r'[。\?？!！、\s]', '', text)
+        normalized_text = normalize_query(text)
 
         # 1. アプリ起動チェック（簡易コマンド判定）
         if self._check_app_launch(normalized_text):
             return
 
         # 2. LLMによる応答生成
-        self._handle_llm_conversation(text)
+        self._handle_llm_conversation(text, turn)
 
     def _check_app_launch(self, text):
         """configに基づいたアプリ起動判定"""
@@ -144,20 +198,38 @@ class KomomoSystem:
                         pass
         return False
 
-    def _handle_llm_conversation(self, text):
+    def _handle_llm_conversation(self, text, turn=None):
         """ハイブリッド記憶を活用した回答生成（自律知識活用版）"""
+        cancel_event = turn.cancel_event if turn else None
+        turn_id = turn.id if turn else None
         model_name = getattr(self.llm, 'current_model', getattr(self.llm, 'model_type', 'LLM'))
         
         if hasattr(self.gui, "update_status"):
              self.gui.update_status(f"思考中...({model_name})")
 
         try:
-            # --- 🚀 ハイブリッド記憶の抽出 ---
-            user_profile = self.ego.get_user_profile_summary()
-            recent_memories = self.ego.get_recent_memories(limit=5)
-            semantic_memories = ""
-            if hasattr(self.ego, "search_semantic_memories"):
-                semantic_memories = self.ego.search_semantic_memories(text, n_results=2)
+            user_name = self.config.get("user_name", "あなた")
+
+            # プロフィールはメモリ上のキャッシュから取得（版番号と内容は同じ時点の組）
+            profile_version, profile_items = self.ego.get_user_profile_snapshot()
+
+            # --- 回答キャッシュ：同じ質問 × 同じキャラ設定・プロフィールなら記憶検索とLLMを省略 ---
+            # 最近の会話は毎ターン変わるため、キャッシュキーには含めない代わりに、
+            # 「うん」「なんで？」のような会話の流れで答えが変わる発話はキャッシュしない
+            cache_context = None
+            if self.response_cache and not is_context_dependent(
+                    normalize_query(text), self.config.get("response_cache_min_length", 4)):
+                cache_context = [self.instruction, self.ego.get_user_profile_summary()]
+                cached = self.response_cache.get(text, cache_context)
+                if cached:
+                    self._deliver_cached_response(text, cached, turn)
+                    return
+
+            # --- 🚀 ハイブリッド記憶の抽出（並列・締め切り付き） ---
+            sources = {"recent": lambda: self.ego.get_recent_memory_items(limit=5)}
+            if hasattr(self.ego, "search_semantic_memory_items"):
+                sources["semantic"] = lambda: self.ego.search_semantic_memory_items(text, n_results=2)
+            context = self.context_assembler.assemble(sources, default=[])
             
             # --- 🚀 修正：記憶と自律知識のバランス調整用プロンプト ---
             context_instruction = (
@@ -168,25 +240,48 @@ class KomomoSystem:
                 "3. 記憶に縛られすぎて、単なる「思い出の確認」に終始しないよう注意してください。\n"
             )
             
-            # 4. すべてを合体させてプロンプトを構築
-            full_instruction = (
-                f"{self.instruction}\n"
-                f"{context_instruction}\n"
-                f"{user_profile}\n"
-                f"{recent_memories}\n"
-                f"{semantic_memories}"
+            # 4. すべてを合体させてプロンプトを構築（トークン予算内に収まるよう取捨選択）
+            # 不変プレフィックス（キャラ設定・方針・プロフィール）と変動部分（会話・思い出）を分けて渡す
+            prompt = self.prompt_builder.build(
+                self.instruction,
+                context_instruction,
+                profile_items=profile_items,
+                profile_version=profile_version,
+                recent_items=context["recent"],
+                semantic_docs=context.get("semantic", []),
             )
-            
+
             # 回答生成の実行
-            response = self.llm.generate_response(text, full_instruction)
-            
+            if self.config.get("llm_streaming", True):
+                # ストリーミング：完成した1文ごとに即座に発声パイプラインへ配送
+                sentences = []
+                for sentence in self.llm.generate_response_stream(text, prompt.prefix, cancel_event=cancel_event,
+                                                                  volatile_context=prompt.suffix):
+                    if turn and turn.cancelled:
+                        break
+                    final_sentence = sentence.replace("{{user}}", user_name)
+                    sentences.append(final_sentence)
+                    self.pm.hook.on_llm_sentence_generated(sentence_text=final_sentence, turn_id=turn_id)
+                response = "".join(sentences)
+                if response and not (turn and turn.cancelled):
+                    self.dispatcher.fire("on_llm_stream_completed", response_text=response)
+            else:
+                response = self.llm.generate_response(text, prompt.prefix, cancel_event=cancel_event,
+                                                      volatile_context=prompt.suffix)
+                if response and not (turn and turn.cancelled):
+                    response = response.replace("{{user}}", user_name)
+                    # フック通知：各プラグインへ並行配送（配送を投げた時点で次へ進む）
+                    self.dispatcher.fire("on_llm_response_generated", response_text=response, turn_id=turn_id)
+
+            if turn and turn.cancelled:
+                # 新しい発話に割り込まれた古い回答は、発声も記憶もしない
+                print(f"[Main] ターン #{turn.id} は取り消されたため破棄します")
+                return
+
             if response:
-                user_name = self.config.get("user_name", "あなた")
-                final_res = response.replace("{{user}}", user_name)
-                
-                # フック通知：各プラグインへの配送
-                self.pm.hook.on_llm_response_generated(response_text=final_res)
-                # 感情分析、事実抽出、および履歴保存（SQLite & ChromaDB）
+                if cache_context is not None:
+                    self.response_cache.put(text, cache_context, response)
+                # 感情分析、事実抽出、および履歴保存（SQLite & ChromaDB）は分析キューへ積んで後で行う
                 self.ego.extract_info_from_dialogue(text, response)
                 
         except Exception as e:
@@ -195,6 +290,25 @@ class KomomoSystem:
             if hasattr(self.gui, "update_status"):
                 self.gui.update_status("エラーが発生しました")
 
+    def _deliver_cached_response(self, text, response, turn=None):
+        """キャッシュ済みの回答を通常の回答と同じ経路で配送する（発声はTTSキャッシュが効く）"""
+        print(f"[Main] キャッシュ済みの回答を使用します: {response[:20]}...")
+        turn_id = turn.id if turn else None
+        if self.config.get("llm_streaming", True):
+            for sentence in self.llm.split_sentences(response):
+                if turn and turn.cancelled:
+                    break
+                self.pm.hook.on_llm_sentence_generated(sentence_text=sentence, turn_id=turn_id)
+            if not (turn and turn.cancelled):
+                self.dispatcher.fire("on_llm_stream_completed", response_text=response)
+        elif not (turn and turn.cancelled):
+            self.dispatcher.fire("on_llm_response_generated", response_text=response, turn_id=turn_id)
+
+        if turn and turn.cancelled:
+            print(f"[Main] ターン #{turn.id} は取り消されたため破棄します")
+            return
+        self.ego.extract_info_from_dialogue(text, response)
+
     def _main_processing_loop(self):
         """バックグラウンド監視用ループ"""
         while self.is_running:
@@ -210,8 +324,14 @@ class KomomoSystem:
             self.is_running = False
             print("\n[System] 終了します。")
         finally:
+            http_client.close_all()
+            # バッファ中の思い出と記憶DBの未コミットの書き込みを反映してから終了
+            self.ego.close()
+            self.stt.close()
             sys.exit(0)
 
 if __name__ == "__main__":
+    # exe 化した環境では、spawn で起動した音声認識ワーカーがアプリ全体を再実行しないようにする
+    multiprocessing.freeze_support()
     app = KomomoSystem()
     app.run()
\ No newline at end of file
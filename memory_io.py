@@ -0,0 +1,337 @@
+"""
+Komomo System Tool - Memory Import/Export
+Version: v1.0.0
+
+[役割]
+こももの記憶（プロフィール・会話履歴・分析待ちの会話・システム状態・思い出のベクトル）を
+1行1レコードの JSON Lines（.jsonl / .jsonl.gz）として書き出し・読み込みします。
+komomo_v4_memory.db や chroma_db/ を手作業でコピーせずに、別のPCへ記憶を移せます。
+旧来のJSONメモリ（memory.json.bak）の取り込みにも対応しています。
+
+[主な機能]
+- 全件をメモリに載せないストリーミングでの書き出し・読み込み（件数が増えても使用メモリは一定）
+- 読み込み時のまとめ書き込みと、埋め込み計算の並列実行
+- 同じファイルを何度読み込んでも重複しない取り込み
+  （会話履歴は日時＋発言で、思い出はIDで重複を判定。プロフィールは更新日時が新しい方を採用）
+- 思い出のメタデータの history_id を、取り込み先で振り直された会話履歴のIDに付け替え
+- 会話履歴の要約済みの印の引き継ぎ（要約済みの日を取り込み先で要約し直したり、1往復ごとに登録し直したりしない）
+- memory.json.bak（旧JSONメモリ）からの移行
+
+[使い方]
+python memory_io.py export memories.jsonl.gz                # ベクトルも含めて書き出し
+python memory_io.py export memories.jsonl.gz --no-vectors   # ベクトルを除いて書き出し（読み込み時に再計算）
+python memory_io.py import memories.jsonl.gz                # 読み込み（モデルが違う場合は自動で再計算）
+python memory_io.py import memories.jsonl.gz --reembed      # 常にベクトルを再計算して読み込み
+python memory_io.py migrate-legacy memory.json.bak          # 旧JSONメモリの取り込み
+"""
+import argparse
+import base64
+import gzip
+import json
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from core.consolidation import migrate_schema
+from core.embedding import EmbeddingService
+from core.memory_db import MemoryDB
+from core.memory_store import create_memory_store
+
+FORMAT_VERSION = 2
+DB_PATH = "komomo_v4_memory.db"
+BATCH_SIZE = 256
+
+
+def _open(path, mode):
+    """.gz なら gzip 圧縮で開く（mode: "r" / "w"）"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _encode_vector(vec):
+    return base64.b64encode(array("f", vec).tobytes()).decode("ascii")
+
+
+def _decode_vector(text):
+    return array("f", base64.b64decode(text)).tolist()
+
+
+# --- 書き出し ---
+
+def export_records(db, store, model, include_vectors=True):
+    """記憶を1レコードずつ返す"""
+    yield {"type": "meta", "version": FORMAT_VERSION, "embedding_model": model,
+           "exported_at": datetime.now().isoformat()}
+    for key, value, updated_at in db.iterate("SELECT key, value, updated_at FROM user_profile ORDER BY key"):
+        yield {"type": "profile", "key": key, "value": value, "updated_at": updated_at}
+    for key, value in db.iterate("SELECT key, value FROM system_status ORDER BY key"):
+        yield {"type": "status", "key": key, "value": value}
+    # 記憶の整理を一度も実行していないDBには要約済みの印の列が無い
+    columns = [row[1] for row in db.fetchall("PRAGMA table_info(conversation_history)")]
+    consolidated = "consolidated" if "consolidated" in columns else "0"
+    for history_id, user_text, ai_response, monologue, emotion_id, created_at, done in db.iterate(
+        "SELECT id, user_text, ai_response, inner_monologue, emotion_id, created_at, "
+        f"{consolidated} FROM conversation_history ORDER BY id"
+    ):
+        yield {"type": "history", "id": history_id, "user_text": user_text, "ai_response": ai_response,
+               "inner_monologue": monologue, "emotion_id": emotion_id, "created_at": created_at,
+               "consolidated": int(done or 0)}
+    # まだ分析されていない会話（取り込み先で改めて分析される）
+    for user_text, ai_response, created_at in db.iterate(
+        "SELECT user_text, ai_response, created_at FROM analysis_queue ORDER BY id"
+    ):
+        yield {"type": "pending", "user_text": user_text, "ai_response": ai_response, "created_at": created_at}
+    for mem_id, document, metadata, vector in store.iter_items(batch_size=BATCH_SIZE):
+        record = {"type": "memory", "id": mem_id, "document": document, "metadata": metadata}
+        if include_vectors:
+            record["embedding"] = _encode_vector(vector)
+        yield record
+
+
+def export_file(path, db, store, model, include_vectors=True):
+    counts = {}
+    with _open(path, "w") as f:
+        for record in export_records(db, store, model, include_vectors):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            counts[record["type"]] = counts.get(record["type"], 0) + 1
+    return counts
+
+
+# --- 読み込み ---
+
+class MemoryImporter:
+    def __init__(self, db, store, embedding, reembed=False, workers=2):
+        """
+        reembed : True なら、ファイル内のベクトルを使わず常に再計算する
+        workers : 思い出のベクトル計算・登録を並列に行う数
+        """
+        self.db = db
+        self.store = store
+        self.embedding = embedding
+        self.reembed = reembed
+        self.workers = max(1, workers)
+        self.counts = {}
+        self._source_model = None
+        # 書き出し元の会話履歴ID -> 取り込み先の会話履歴ID
+        self._history_ids = {}
+        self.db.transaction(migrate_schema)
+
+    def run(self, records):
+        batches = {"profile": [], "status": [], "history": [], "pending": [], "memory": []}
+        pending = deque()
+        stored_before = self.store.count()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="komomo-import") as pool:
+            for record in records:
+                kind = record.get("type")
+                if kind == "meta":
+                    self._source_model = record.get("embedding_model")
+                    continue
+                if kind not in batches:
+                    continue
+                if kind == "memory" and batches["history"]:
+                    # 思い出の history_id を付け替えられるよう、先に会話履歴を取り込んでおく
+                    self._flush("history", batches["history"], pool, pending)
+                    batches["history"] = []
+                batches[kind].append(record)
+                if len(batches[kind]) >= BATCH_SIZE:
+                    self._flush(kind, batches[kind], pool, pending)
+                    batches[kind] = []
+            for kind in ("profile", "status", "history", "pending", "memory"):
+                batch = batches[kind]
+                if batch:
+                    self._flush(kind, batch, pool, pending)
+            while pending:
+                pending.popleft().result()
+        # 既に存在したIDは追加されないため、実際に増えた件数を数える
+        self.counts["memory"] = self.store.count() - stored_before
+        return self.counts
+
+    def _flush(self, kind, batch, pool, pending):
+        if kind == "memory":
+            # ベクトル計算と登録は並列に進め、同時に抱えるバッチ数を制限して使用メモリを一定に保つ
+            pending.append(pool.submit(self._import_memories, batch))
+            while len(pending) > self.workers:
+                pending.popleft().result()
+            return
+        written = getattr(self, f"_import_{kind}")(batch)
+        self.counts[kind] = self.counts.get(kind, 0) + written
+
+    def _import_profile(self, batch):
+        # 同じキーは更新日時が新しい方を採用
+        return self.db.executemany(
+            "INSERT INTO user_profile (key, value, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at "
+            "WHERE excluded.updated_at > user_profile.updated_at",
+            [(r["key"], r["value"], r.get("updated_at") or "") for r in batch]
+        )
+
+    def _import_status(self, batch):
+        # 取り込み先の現在の状態は上書きしない
+        return self.db.executemany(
+            "INSERT OR IGNORE INTO system_status (key, value) VALUES (?, ?)",
+            [(r["key"], r["value"]) for r in batch]
+        )
+
+    def _import_history(self, batch):
+        def write(conn):
+            inserted = 0
+            for r in batch:
+                # 同じ日時・発言の履歴が既にあれば、それを対応先として使う
+                row = conn.execute("SELECT id FROM conversation_history WHERE created_at = ? AND user_text = ?",
+                                   (r["created_at"], r["user_text"])).fetchone()
+                consolidated = 1 if r.get("consolidated") else 0
+                if row:
+                    new_id = row[0]
+                    if consolidated:
+                        # 書き出し元で要約済みなら、その要約の思い出も一緒に取り込まれる
+                        conn.execute("UPDATE conversation_history SET consolidated = 1 WHERE id = ?", (new_id,))
+                else:
+                    new_id = conn.execute(
+                        "INSERT INTO conversation_history "
+                        "(user_text, ai_response, inner_monologue, emotion_id, created_at, consolidated) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (r["user_text"], r["ai_response"], r.get("inner_monologue"), r.get("emotion_id"),
+                         r["created_at"], consolidated)
+                    ).lastrowid
+                    inserted += 1
+                if r.get("id") is not None:
+                    self._history_ids[r["id"]] = new_id
+            return inserted
+        return self.db.transaction(write)
+
+    def _import_pending(self, batch):
+        return self.db.executemany(
+            "INSERT INTO analysis_queue (user_text, ai_response, created_at) "
+            "SELECT ?, ?, ? WHERE NOT EXISTS "
+            "(SELECT 1 FROM analysis_queue WHERE created_at = ? AND user_text = ?)",
+            [(r["user_text"], r["ai_response"], r["created_at"], r["created_at"], r["user_text"]) for r in batch]
+        )
+
+    def _remap_metadata(self, metadata):
+        """history_id を取り込み先の会話履歴IDに付け替える（対応先が無ければ外し、日付での照合に任せる）"""
+        metadata = dict(metadata or {})
+        if "history_id" in metadata:
+            new_id = self._history_ids.get(metadata.pop("history_id"))
+            if new_id is not None:
+                metadata["history_id"] = new_id
+        return metadata or None
+
+    def _import_memories(self, batch):
+        usable = (not self.reembed and self._source_model == self.embedding.model
+                  and all(r.get("embedding") for r in batch))
+        documents = [r["document"] for r in batch]
+        if usable:
+            embeddings = [_decode_vector(r["embedding"]) for r in batch]
+        else:
+            embeddings = self.embedding.embed(documents)
+        self.store.add(
+            ids=[r["id"] for r in batch],
+            documents=documents,
+            metadatas=[self._remap_metadata(r.get("metadata")) for r in batch],
+            embeddings=embeddings,
+        )
+
+
+def read_records(path):
+    with _open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# --- 旧JSONメモリの移行 ---
+
+def _legacy_time(text):
+    """"2026-02-04 15:56:26.208534" -> ISO形式"""
+    try:
+        return datetime.fromisoformat(text).isoformat()
+    except (TypeError, ValueError):
+        return datetime.now().isoformat()
+
+
+def legacy_records(path):
+    """memory.json.bak を取り込み用のレコードに変換する"""
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    user_info = data.get("user_info", {})
+    history = user_info.get("history", [])
+    updated_at = max((_legacy_time(h.get("date")) for h in history), default=datetime.now().isoformat())
+
+    # プロフィール（basic / lifestyle / preferences / mind の各項目。空欄は除く）
+    for section in ("basic", "lifestyle", "preferences", "mind"):
+        for key, value in (user_info.get(section) or {}).items():
+            if isinstance(value, list):
+                value = "、".join(str(v) for v in value)
+            if value in ("", None):
+                continue
+            yield {"type": "profile", "key": key, "value": str(value), "updated_at": updated_at}
+
+    # 旧形式の履歴はユーザーの発言のみ
+    for i, item in enumerate(history):
+        text = item.get("text")
+        if not text:
+            continue
+        created_at = _legacy_time(item.get("date"))
+        yield {"type": "history", "user_text": text, "ai_response": "", "inner_monologue": None,
+               "emotion_id": None, "created_at": created_at}
+        yield {"type": "memory", "id": f"legacy_{i}", "document": f"あっきー: {text}",
+               "metadata": {"timestamp": created_at, "kind": "legacy"}}
+
+    if data.get("last_emotion"):
+        yield {"type": "status", "key": "last_emotion", "value": json.dumps(data["last_emotion"], ensure_ascii=False)}
+    if data.get("komomo_ego"):
+        yield {"type": "status", "key": "komomo_ego", "value": json.dumps(data["komomo_ego"], ensure_ascii=False)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Komomo Memory Import/Export")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", help="記憶を JSON Lines に書き出す")
+    p_export.add_argument("path")
+    p_export.add_argument("--no-vectors", action="store_true", help="ベクトルを含めない")
+    p_import = sub.add_parser("import", help="JSON Lines から記憶を読み込む")
+    p_import.add_argument("path")
+    p_import.add_argument("--reembed", action="store_true", help="ベクトルを常に再計算する")
+    p_legacy = sub.add_parser("migrate-legacy", help="旧JSONメモリ（memory.json.bak）を取り込む")
+    p_legacy.add_argument("path", nargs="?", default="memory.json.bak")
+    args = parser.parse_args()
+
+    with open("config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    print("=== Komomo Memory Import/Export ===")
+    db = MemoryDB(DB_PATH)
+    db.init_schema()
+    embedding = EmbeddingService(
+        db,
+        model=config.get("embedding_model", "default"),
+        batch_size=config.get("embedding_batch_size", 32),
+        batch_workers=config.get("embedding_threads", 2),
+        use_chromadb=config.get("memory_store", "chroma") != "numpy",
+    )
+    store = create_memory_store(config, embedding.embed, db)
+
+    started = time.perf_counter()
+    try:
+        if args.command == "export":
+            counts = export_file(args.path, db, store, embedding.model, include_vectors=not args.no_vectors)
+            print(f"書き出し完了: {args.path}")
+        else:
+            records = read_records(args.path) if args.command == "import" else legacy_records(args.path)
+            importer = MemoryImporter(db, store, embedding, reembed=getattr(args, "reembed", False),
+                                      workers=config.get("embedding_threads", 2))
+            counts = importer.run(records)
+            print(f"読み込み完了: {args.path}")
+        for kind, n in counts.items():
+            print(f"  {kind}: {n} 件")
+        print(f"({time.perf_counter() - started:.1f}s)")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,15 +6,26 @@ Version: v4.3.0.13
 感情分析とハイブリッド記憶管理。
 ユーザーの好みや事実を敏感に抽出する強化プロンプトを搭載。
 不正な感情ID（1, 102等）を排除し、厳格に 12, 13, 17, 20 に制限。
-旧来のJSONメモリ管理を廃止し、SQLite + ChromaDB に完全移行。
+旧来のJSONメモリ管理を廃止し、SQLite + ベクトル記憶ストア（ChromaDB / NumPy）に完全移行。
+会話後の分析は SQLite に永続化した分析キューへ積み、バックグラウンドでまとめて処理する
+（会話の経路では OpenRouter の応答を待たない。異常終了しても未分析の会話は失われない）。
 """
 import json
-import requests
-import os
-import sqlite3
+import re
+import threading
+import time
 import traceback
-from datetime import datetime
-import chromadb
+from datetime import datetime, timedelta
+from core import http_client
+from core.cache import LRUCache, normalize_query
+from core.keywords import KeywordExtractor
+from core.embedding import EmbeddingService
+from core.consolidation import MemoryConsolidator
+from core.memory_db import MemoryDB
+from core.memory_store import create_memory_store, reciprocal_rank_fusion
+from core.memory_writer import BufferedMemoryWriter
+from core.profile import UserProfile
+from core.prompt import render_dialogue
 
 class EgoPlugin:
     def __init__(self, config, gui):
@@ -26,47 +37,144 @@ class EgoPlugin:
         # 使用するOpenAIモデル（無料枠リスト内のモデルを指定）
         self.openai_model = "gpt-4o-mini-2024-07-18"
         
-        # 1. SQLite初期化
+        # 検索キーワード抽出（"openai": gpt-4o-mini / "local": 形態素解析）と、その結果のキャッシュ
+        self.keyword_extractor = config.get("keyword_extractor", "openai")
+        self.local_keywords = KeywordExtractor() if self.keyword_extractor == "local" else None
+        self.keyword_cache = LRUCache(maxsize=config.get("keyword_cache_size", 256))
+        
+        # 1. SQLite初期化（WAL・スレッドごとの読み取り接続・書き込みスレッド）
+        self.db = MemoryDB(self.db_path)
         self._init_db()
+        self.fts_available = self._init_fts()
+        # プロフィールはメモリ上に保持し、事実の保存時に書き込む（ライトスルー）
+        self.profile = UserProfile(self.db)
         
-        # 2. ChromaDB (ベクトルDB) 初期化
+        # 2. 記憶ストア (ベクトルDB) 初期化（memory_store: "chroma" / "numpy"）
+        self.embedding = EmbeddingService(
+            self.db,
+            model=config.get("embedding_model", "default"),
+            batch_size=config.get("embedding_batch_size", 32),
+            batch_workers=config.get("embedding_threads", 2),
+            use_chromadb=config.get("memory_store", "chroma") != "numpy",
+        )
+        self.memory_store = None
+        self.memory_writer = None
         try:
-            # プロジェクトフォルダ内に chroma_db ディレクトリを作成しデータを永続化
-            self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
-            # キーワード検索モードでコレクションを取得/作成
-            self.collection = self.chroma_client.get_or_create_collection(name="komomo_memories")
+            self.memory_store = create_memory_store(config, self.embed_texts, self.db)
+            # 思い出の追加はバッファしてまとめて書き込む（埋め込み計算と索引更新をまとめる）
+            self.memory_writer = BufferedMemoryWriter(
+                self.memory_store,
+                max_batch=config.get("memory_write_batch_size", 8),
+                max_delay=config.get("memory_write_delay_seconds", 5.0),
+                max_attempts=config.get("memory_write_max_attempts", 3),
+                max_buffer=config.get("memory_write_max_buffer", 256),
+            )
         except Exception as e:
-            print(f"[Ego] ChromaDB初期化失敗: {e}")
+            print(f"[Ego] 記憶ストア初期化失敗: {e}")
+        if self.memory_writer:
+            # 前回の終了時にバッファに残っていた思い出（会話履歴はあるのにベクトルが無いもの）を登録し直す
+            # 範囲は分析ワーカーが動き出す前の履歴に限る（以降の履歴は通常どおりバッファ経由で登録される）
+            last_id = self.db.fetchone("SELECT MAX(id) FROM conversation_history")[0]
+            if last_id is not None:
+                threading.Thread(target=self._recover_missing_memories, args=(last_id,),
+                                 name="komomo-memory-recovery", daemon=True).start()
+
+        # 3. 分析キューのワーカー（起動時に前回の未処理分も拾う）
+        self.analysis_batch_size = max(1, int(config.get("analysis_batch_size", 4)))
+        self.analysis_batch_wait = float(config.get("analysis_batch_wait_seconds", 3.0))
+        self.analysis_max_attempts = int(config.get("analysis_max_attempts", 3))
+        # 分析をあきらめた会話の保存（分析結果なし）も失敗し続ける場合に、キューから外すまでの回数
+        self.analysis_max_save_attempts = int(config.get("analysis_max_save_attempts", 3))
+        self._analysis_event = threading.Event()
+        # 最新のターン（最後に分析キューへ積んだ会話）。表情はこの会話の分析結果でのみ更新する
+        self._latest_queue_id = None
+        self._analysis_event.set()
+        threading.Thread(target=self._analysis_worker, name="komomo-ego-analysis", daemon=True).start()
+
+        # 4. 古い記憶の整理（日ごとの要約への置き換えと保存期間の適用）
+        self.consolidator = None
+        if config.get("memory_consolidation_enabled", False) and self.memory_store is not None:
+            self.consolidator = MemoryConsolidator(
+                self.db, self.memory_store, self._summarize_dialogues,
+                min_age_days=config.get("memory_consolidation_min_age_days", 7),
+                retention_days=config.get("memory_retention_days", 90),
+                max_history_rows=config.get("memory_max_history_rows"),
+                interval_hours=config.get("memory_consolidation_interval_hours", 24.0),
+            )
+            self.consolidator.start()
         
         print(f"[EgoPlugin] v4.3.0.13 Initialized (Clean Hybrid DB Mode)")
 
     def _init_db(self):
         """SQLiteテーブルの初期化"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('''CREATE TABLE IF NOT EXISTS user_profile 
-                                (key TEXT PRIMARY KEY, value TEXT, updated_at TIMESTAMP)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS system_status 
-                                (key TEXT PRIMARY KEY, value TEXT)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS conversation_history 
-                                (id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                                 user_text TEXT, ai_response TEXT, 
-                                 inner_monologue TEXT, emotion_id TEXT, 
-                                 created_at TIMESTAMP)''')
-                conn.commit()
+            self.db.init_schema()
         except Exception as e:
             print(f"[EgoPlugin] DB初期化エラー: {e}")
 
+    def _init_fts(self):
+        """会話履歴の全文検索インデックス（FTS5 trigram）を作成し、トリガーで同期させる"""
+        def create(conn):
+            cursor = conn.cursor()
+            # 日本語は単語境界が無いため、3文字単位（trigram）で索引を作る
+            cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5
+                            (user_text, ai_response, content='conversation_history', content_rowid='id',
+                             tokenize='trigram')''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_insert
+                            AFTER INSERT ON conversation_history BEGIN
+                              INSERT INTO conversation_fts (rowid, user_text, ai_response)
+                              VALUES (new.id, new.user_text, new.ai_response);
+                            END''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_delete
+                            AFTER DELETE ON conversation_history BEGIN
+                              INSERT INTO conversation_fts (conversation_fts, rowid, user_text, ai_response)
+                              VALUES ('delete', old.id, old.user_text, old.ai_response);
+                            END''')
+            cursor.execute('''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_update
+                            AFTER UPDATE ON conversation_history BEGIN
+                              INSERT INTO conversation_fts (conversation_fts, rowid, user_text, ai_response)
+                              VALUES ('delete', old.id, old.user_text, old.ai_response);
+                              INSERT INTO conversation_fts (rowid, user_text, ai_response)
+                              VALUES (new.id, new.user_text, new.ai_response);
+                            END''')
+            # 既存の履歴は初回だけまとめて索引に登録する
+            if cursor.execute("SELECT 1 FROM system_status WHERE key = 'conversation_fts'").fetchone() is None:
+                cursor.execute("INSERT INTO conversation_fts (conversation_fts) VALUES ('rebuild')")
+                cursor.execute("INSERT INTO system_status (key, value) VALUES ('conversation_fts', 'trigram')")
+        try:
+            self.db.transaction(create)
+            return True
+        except Exception as e:
+            print(f"[EgoPlugin] 全文検索インデックス初期化失敗（ベクトル検索のみで動作します）: {e}")
+            return False
+
     def _get_search_keywords(self, text):
-        """OpenAIモデルを使って検索用のキーワード（意味タグ）を抽出する"""
+        """検索用のキーワード（意味タグ）を抽出する（同じ問いかけはキャッシュから返す）"""
+        cache_key = normalize_query(text)
+        cached = self.keyword_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        if self.local_keywords is not None:
+            keywords = ", ".join(self.local_keywords.extract(text)) or None
+        else:
+            keywords = self._get_openai_keywords(text)
+        if keywords is None:
+            # 抽出できなかった場合は元の文のまま検索する（キャッシュしない）
+            return text
+        self.keyword_cache.put(cache_key, keywords)
+        return keywords
+
+    def _get_openai_keywords(self, text):
+        """OpenAIモデルを使って検索用のキーワード（意味タグ）を抽出する（失敗時は None）"""
         key = self.config.get("openai_api_key")
         if not key:
-            return text
+            return None
             
         try:
-            res = requests.post(
+            res = http_client.post(
                 "https://api.openai.com/v1/chat/completions",
+                endpoint="openai",
                 headers={
                     "Authorization": f"Bearer {key}",
                     "Content-Type": "application/json"
@@ -83,76 +191,216 @@ class EgoPlugin:
             if res.status_code == 200:
                 return res.json()["choices"][0]["message"]["content"]
             else:
-                return text
+                return None
         except:
-            return text
+            return None
 
-    def search_semantic_memories(self, query_text, n_results=2):
-        """今の話題に関連する過去の思い出を検索する"""
+    def embed_texts(self, texts):
+        """記憶ストアと同じ埋め込みモデルでテキストをベクトル化する（計算済みの文章はキャッシュから返す）"""
+        return self.embedding.embed(texts)
+
+    def search_semantic_memory_items(self, query_text, n_results=2, since_days=None, emotion_ids=None):
+        """
+        関連する過去の思い出を文書のリスト（関連度順）で返す。
+        全文検索（BM25：固有名詞などの完全一致に強い）とベクトル検索（言い換えに強い）の結果を RRF で統合する。
+        since_days  : 指定時は直近 N 日の思い出に絞る
+        emotion_ids : 指定時はその感情IDで記録された思い出に絞る（例: [17]）
+        """
         try:
             # 検索キーワードを生成
             search_tags = self._get_search_keywords(query_text)
-            
-            # ChromaDBから検索（テキストベースのマッチング）
-            results = self.collection.query(
-                query_texts=[search_tags],
-                n_results=n_results
-            )
-            
-            if not results or not results['documents'][0]:
-                return ""
-                
-            memory_context = "\n### 関連する過去の思い出 ###\n"
-            for doc in results['documents'][0]:
-                memory_context += f"・{doc}\n"
-            memory_context += "###########################\n"
-            return memory_context
+            since = (datetime.now() - timedelta(days=since_days)).isoformat() if since_days else None
+            emotion_ids = [str(e) for e in emotion_ids] if emotion_ids else None
+            filtered = since is not None or emotion_ids is not None
+
+            rankings = []
+            if self.fts_available:
+                lexical_k = self.config.get("memory_lexical_candidates", 5)
+                rankings.append(self._lexical_search(search_tags, lexical_k, since, emotion_ids))
+
+            # 記憶ストアから検索（埋め込みの類似度）。絞り込み時は除外される分を見込んで多めに取る
+            vector_k = self.config.get("memory_vector_candidates", n_results)
+            vector_hits = self.memory_store.query_items(search_tags, n_results=vector_k * 3 if filtered else vector_k)
+            vector_docs = [doc for doc, meta in vector_hits if self._match_filters(meta, since, emotion_ids)]
+            rankings.append(vector_docs[:vector_k])
+
+            return reciprocal_rank_fusion(rankings)[:n_results]
         except Exception as e:
             print(f"[Ego] 記憶検索エラー: {e}")
-            return ""
+            return []
+
+    def _lexical_search(self, search_tags, limit, since=None, emotion_ids=None):
+        """会話履歴の全文検索（BM25順）。思い出と同じ書式の文書のリストを返す"""
+        terms = [t for t in re.split(r'[,、，\s]+', search_tags) if t]
+        if not terms:
+            return []
+        conditions, params = [], []
+        # trigram 索引は3文字以上の語にのみ効くため、短い語は部分一致で探す
+        long_terms = [t for t in terms if len(t) >= 3]
+        if long_terms:
+            source = "conversation_fts f JOIN conversation_history h ON h.id = f.rowid"
+            conditions.append("conversation_fts MATCH ?")
+            params.append(" OR ".join('"' + t.replace('"', '""') + '"' for t in long_terms))
+            order = "bm25(conversation_fts)"
+        else:
+            source = "conversation_history h"
+            conditions.append("(" + " OR ".join("h.user_text LIKE ? OR h.ai_response LIKE ?" for _ in terms) + ")")
+            for t in terms:
+                params += [f"%{t}%", f"%{t}%"]
+            order = "h.id DESC"
+        if since is not None:
+            conditions.append("h.created_at >= ?")
+            params.append(since)
+        if emotion_ids is not None:
+            conditions.append(f"h.emotion_id IN ({','.join('?' * len(emotion_ids))})")
+            params += emotion_ids
+        rows = self.db.fetchall(
+            f"SELECT h.user_text, h.ai_response FROM {source} WHERE {' AND '.join(conditions)} ORDER BY {order} LIMIT ?",
+            params + [limit]
+        )
+        return [render_dialogue(u, a) for u, a in rows]
+
+    def _match_filters(self, meta, since, emotion_ids):
+        """ベクトル検索の結果をメタデータ（記録時刻・感情ID）で絞り込む"""
+        if since is not None and str(meta.get("timestamp", "")) < since:
+            return False
+        if emotion_ids is not None and str(meta.get("emotion_id")) not in emotion_ids:
+            return False
+        return True
 
     def get_user_profile_summary(self):
-        """DBからプロフィールを取得"""
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT key, value FROM user_profile")
-                rows = cursor.fetchall()
-                if not rows: return ""
-                summary = "\n### あなたが覚えているあっきーの情報 ###\n"
-                for key, value in rows:
-                    summary += f"・{key}: {value}\n"
-                summary += "########################################\n"
-                return summary
-        except: return ""
-
-    def get_recent_memories(self, limit=5):
-        """DBから最新の会話履歴を取得"""
+        """描画済みのプロフィール節を返す（変更時のみ作り直す）"""
+        return self.profile.summary()
+
+    def get_user_profile_snapshot(self):
+        """(プロフィールの版番号, [(key, value), ...]) を返す"""
+        return self.profile.snapshot()
+
+    def get_recent_memory_items(self, limit=5):
+        """最新の会話履歴を [(user_text, ai_response), ...]（古い順）で返す"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute('SELECT user_text, ai_response FROM conversation_history ORDER BY id DESC LIMIT ?', (limit,))
-                rows = cursor.fetchall()
-                if not rows: return ""
-                rows.reverse()
-                memory_text = "\n### 最近の二人の会話の思い出 ###\n"
-                for user, ai in rows:
-                    memory_text += f"あっきー: {user}\nこもも: {ai}\n"
-                memory_text += "##################################\n"
-                return memory_text
-        except: return ""
+            # 分析待ちの会話も「最近の会話」に含める（分析の完了を待たずに次のターンで参照できる）
+            rows = self.db.fetchall('''SELECT user_text, ai_response FROM (
+                                         SELECT user_text, ai_response, created_at FROM conversation_history
+                                         UNION ALL
+                                         SELECT user_text, ai_response, created_at FROM analysis_queue
+                                       ) ORDER BY created_at DESC LIMIT ?''', (limit,))
+            rows.reverse()
+            return rows
+        except: return []
 
     def extract_info_from_dialogue(self, user_text, ai_response):
-        """分析と保存の実行"""
+        """会話を分析キューへ積む（分析と保存はバックグラウンドで行う）"""
+        if not self.config.get("openrouter_api_key"): return
+        try:
+            self._latest_queue_id = self.db.transaction(lambda conn: conn.execute(
+                "INSERT INTO analysis_queue (user_text, ai_response, created_at) VALUES (?, ?, ?)",
+                (user_text, ai_response, datetime.now().isoformat())).lastrowid)
+            self._analysis_event.set()
+        except Exception as e:
+            print(f"[Ego] 分析キュー登録エラー: {e}")
+
+    def _analysis_worker(self):
+        """分析キューを監視し、溜まった会話をまとめて1回のリクエストで分析する"""
+        while True:
+            # 新しい会話が来るまで待機（起動直後・再試行時は定期的にキューを確認）
+            self._analysis_event.wait(timeout=30.0)
+            self._analysis_event.clear()
+            # 続けて届く会話を同じバッチに載せるため、少しだけ待つ
+            time.sleep(self.analysis_batch_wait)
+            try:
+                while True:
+                    rows = self._fetch_pending(self.analysis_batch_size)
+                    if not rows:
+                        break
+                    if not self._process_batch(rows):
+                        # 失敗時は次の起床まで待ってから再試行
+                        break
+            except Exception as e:
+                print(f"[Ego] 分析ワーカーエラー: {e}")
+                traceback.print_exc()
+
+    def _fetch_pending(self, limit):
+        return self.db.fetchall("SELECT id, user_text, ai_response, attempts, created_at FROM analysis_queue ORDER BY id LIMIT ?", (limit,))
+
+    def _process_batch(self, rows):
+        """バッチを分析して保存する。全件を保存できたら True（失敗した会話は attempts を進めて False）"""
+        # 規定回数失敗した会話は、分析結果なしで履歴だけ保存する（記憶を失わないため）
+        # 保存にも失敗した会話は試行回数を進め、上限を超えたらキューから外す（_mark_failed）
+        expired = [r for r in rows if r[3] >= self.analysis_max_attempts]
+        unsaved = [r for r in expired if not self._save_to_db(r[1], r[2], {}, 12, queue_id=r[0], created_at=r[4])]
+        self._mark_failed(unsaved)
+        rows = [r for r in rows if r[3] < self.analysis_max_attempts]
+        if not rows:
+            return not unsaved
+        failed = []
+
+        try:
+            results = self._analyze_batch(rows)
+        except Exception as e:
+            print(f"[Ego] 分析失敗 ({len(rows)}件): {e}")
+            self._mark_failed(rows)
+            return False
+
+        print(f"[Ego] Llama 3.3 バッチ分析完了: {len(rows)}件")
+        latest_id = None
+        for i, row in enumerate(rows, start=1):
+            data = results.get(i)
+            if data is None:
+                # 結果が欠けた会話は空の分析結果で保存せず、再試行に回す
+                print(f"[Ego] 会話{i}: 分析結果がありません (再試行します)")
+                failed.append(row)
+                continue
+            raw_val = str(data.get("emotion_id", "12")).lower()
+            parsed_id = self._robust_parse_id(raw_val)
+            print(f"[Ego] 会話{i}: '{raw_val}' -> 最終決定={parsed_id}")
+            if self._save_to_db(row[1], row[2], data, parsed_id, queue_id=row[0], created_at=row[4]):
+                if row[0] == self._latest_queue_id:
+                    latest_id = parsed_id
+            else:
+                failed.append(row)
+        # 分析はバッチ待ちとLLM呼び出しの分だけ遅れて終わるため、表情は今のターンの会話の結果だけを反映する
+        # （その後に次の会話が積まれていたり、再試行・起動前の会話だったりした場合は古い表情を送らない）
+        if latest_id is not None:
+            self.send_to_unity(latest_id)
+        self._mark_failed(failed)
+        return not (failed or unsaved)
+
+    def _mark_failed(self, rows):
+        """
+        失敗した会話の試行回数を進める（次の起床まで再試行しない）
+        分析をあきらめた後の保存も上限まで失敗した会話はキューから外し、内容をログに残す
+        （残し続けると、毎回同じ先頭の会話で止まって後続の会話が分析されない）
+        """
+        if not rows:
+            return
+        limit = self.analysis_max_attempts + self.analysis_max_save_attempts
+        dead = [r for r in rows if r[3] + 1 >= limit]
+        self.db.executemany("UPDATE analysis_queue SET attempts = attempts + 1 WHERE id = ?",
+                            [(r[0],) for r in rows if r[3] + 1 < limit])
+        if dead:
+            self.db.executemany("DELETE FROM analysis_queue WHERE id = ?", [(r[0],) for r in dead])
+            for r in dead:
+                print(f"[Ego] 保存できなかった会話を分析キューから外しました (id={r[0]}, {r[4]}): "
+                      f"{r[1]!r} -> {r[2]!r}")
+
+    def _analyze_batch(self, rows):
+        """複数の会話を1回の OpenRouter リクエストで分析し、{番号: 結果} を返す"""
         key = self.config.get("openrouter_api_key")
-        if not key: return
+        if not key:
+            raise RuntimeError("openrouter_api_key 未設定")
 
         model_id = "meta-llama/llama-3.3-70b-instruct"
+        dialogues = "\n".join(
+            f'''        [{i + 1}]
+        User says: "{row[1]}"
+        Komomo responds: "{row[2]}"'''
+            for i, row in enumerate(rows)
+        )
         
-        # 好み抽出を強化したプロンプト
-        prompt = f"""Extract data into JSON for "Komomo".
-        User says: "{user_text}"
-        Komomo responds: "{ai_response}"
+        # 好み抽出を強化したプロンプト（複数の会話をまとめて分析）
+        prompt = f"""Extract data into JSON for "Komomo" for each numbered dialogue below.
+{dialogues}
 
         ### 1. NEW INFO EXTRACTION (CRITICAL):
         Identify any personal facts about the user (e.g., likes, dislikes, habits, occupation, preference).
@@ -164,64 +412,155 @@ class EgoPlugin:
         ### 2. EMOTION:
         ID: 13(Music/Excited), 17(Happy), 12(Normal).
         
-        ### Required JSON Format:
+        ### Required JSON Format (one entry per dialogue, in order):
         {{
-            "emotion_stats": {{"joy": 50, "trust": 50, "tension": 20}},
-            "emotion_id": "12",
-            "inner_monologue": "text",
-            "new_facts": {{ "key": "value" }}
+            "results": [
+                {{
+                    "index": 1,
+                    "emotion_stats": {{"joy": 50, "trust": 50, "tension": 20}},
+                    "emotion_id": "12",
+                    "inner_monologue": "text",
+                    "new_facts": {{ "key": "value" }}
+                }}
+            ]
         }}
         """
+        res = http_client.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            endpoint="openrouter",
+            headers={"Authorization": f"Bearer {key}", "HTTP-Referer": "http://localhost"},
+            json={"model": model_id, "messages": [{"role": "user", "content": prompt}], "response_format": {"type": "json_object"}}
+        )
+        if res.status_code != 200:
+            raise RuntimeError(f"HTTP {res.status_code}")
+        data = json.loads(res.json()["choices"][0]["message"]["content"])
+
+        # 1件だけの場合に単体形式で返ってきても受け付ける
+        entries = data.get("results") if isinstance(data.get("results"), list) else [data]
+        entries = [e for e in entries if isinstance(e, dict)]
+        indices = []
+        for pos, entry in enumerate(entries, start=1):
+            try:
+                indices.append(int(entry.get("index", pos)))
+            except (TypeError, ValueError):
+                indices.append(None)
+        # 0始まりで番号を振ってきた場合は1始まりに揃える
+        if indices and None not in indices and min(indices) == 0:
+            indices = [i + 1 for i in indices]
+        results = {}
+        for index, entry in zip(indices, entries):
+            # 範囲外・重複した番号は採用しない（該当する会話は結果なしとして再試行に回る）
+            if index is None or not 1 <= index <= len(rows) or index in results:
+                print(f"[Ego] 不正な分析結果の番号を無視しました: {entry.get('index')}")
+                continue
+            results[index] = entry
+        return results
+
+    def _summarize_dialogues(self, day, dialogues):
+        """1日分の会話を、思い出として残す要約文にまとめる（記憶の整理用）"""
+        key = self.config.get("openrouter_api_key")
+        if not key:
+            raise RuntimeError("openrouter_api_key 未設定")
+
+        model_id = "meta-llama/llama-3.3-70b-instruct"
+        transcript = "\n".join(render_dialogue(u, a) for u, a in dialogues)
+        prompt = f"""以下は {day} の「あっきー」と「こもも」の会話です。
+後で思い出せるよう、話題・出来事・あっきーについて分かったこと（好み・予定・体調など）を
+こももの視点で、日本語の3〜5文に要約してください。要約文だけを出力してください。
+
+{transcript}
+"""
+        res = http_client.post(
+            "https://openrouter.ai/api/v1/chat/completions",
+            endpoint="openrouter",
+            timeout=60,
+            headers={"Authorization": f"Bearer {key}", "HTTP-Referer": "http://localhost"},
+            json={"model": model_id, "messages": [{"role": "user", "content": prompt}]}
+        )
+        if res.status_code != 200:
+            raise RuntimeError(f"HTTP {res.status_code}")
+        return res.json()["choices"][0]["message"]["content"]
+
+    def _save_to_db(self, user_text, ai_response, data, final_id, queue_id=None, created_at=None):
+        """
+        SQLite + 記憶ストアへの永続化（queue_id 指定時は同じトランザクションで分析キューから外す）
+        DBへの保存に成功したら True を返す
+        """
+        now = datetime.now().isoformat()
+        # 履歴の時刻は発話時点（分析キューに積んだ時刻）を使う
+        created_at = created_at or now
+
+        new_facts = data.get("new_facts")
+        if not isinstance(new_facts, dict):
+            new_facts = {}
+
+        # SQLite保存（書き込みスレッドで1トランザクションとして実行）
+        def write(conn):
+            cursor = conn.cursor()
+            new_stats = data.get("emotion_stats")
+            if new_stats:
+                cursor.execute("INSERT OR REPLACE INTO system_status (key, value) VALUES (?, ?)", ("last_emotion", json.dumps(new_stats)))
+            cursor.execute('INSERT INTO conversation_history (user_text, ai_response, inner_monologue, emotion_id, created_at) VALUES (?, ?, ?, ?, ?)',
+                         (user_text, ai_response, data.get("inner_monologue"), str(final_id), created_at))
+            history_id = cursor.lastrowid
+
+            # 事実の保存とログ出力
+            for k, v in new_facts.items():
+                print(f"[Ego] ★新しい記憶を保存: {k} = {v}")
+                cursor.execute("INSERT OR REPLACE INTO user_profile (key, value, updated_at) VALUES (?, ?, ?)", (k, str(v), now))
+            if queue_id is not None:
+                cursor.execute("DELETE FROM analysis_queue WHERE id = ?", (queue_id,))
+            return history_id
+
         try:
-            res = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={"Authorization": f"Bearer {key}", "HTTP-Referer": "http://localhost"},
-                json={"model": model_id, "messages": [{"role": "user", "content": prompt}], "response_format": {"type": "json_object"}},
-                timeout=15
-            )
-            if res.status_code == 200:
-                data = json.loads(res.json()["choices"][0]["message"]["content"])
-                raw_val = str(data.get("emotion_id", "12")).lower()
-                final_id = self._robust_parse_id(raw_val)
-                print(f"[Ego] Llama 3.3 受信: '{raw_val}' -> 最終決定={final_id}")
-                self.send_to_unity(final_id)
-                self._save_to_db(user_text, ai_response, data, final_id)
+            history_id = self.db.transaction(write)
         except Exception as e:
-            print(f"[Ego] 分析失敗: {e}")
+            print(f"[Ego] 保存エラー: {e}")
+            return False
+        # コミット後にメモリ上のプロフィールへ反映
+        self.profile.update(new_facts, now)
 
-    def _save_to_db(self, user_text, ai_response, data, final_id):
-        """SQLite + ChromaDB への永続化"""
+        # 記憶ストア保存（バッファ経由でまとめて書き込む。書き込み前に落ちた分は次回起動時に登録し直す）
+        if not self.memory_writer:
+            return True
         try:
-            now = datetime.now().isoformat()
-            
-            # SQLite保存
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                new_stats = data.get("emotion_stats")
-                if new_stats:
-                    cursor.execute("INSERT OR REPLACE INTO system_status (key, value) VALUES (?, ?)", ("last_emotion", json.dumps(new_stats)))
-                cursor.execute('INSERT INTO conversation_history (user_text, ai_response, inner_monologue, emotion_id, created_at) VALUES (?, ?, ?, ?, ?)',
-                             (user_text, ai_response, data.get("inner_monologue"), str(final_id), now))
-                
-                # 事実の保存とログ出力
-                new_facts = data.get("new_facts")
-                if isinstance(new_facts, dict) and new_facts:
-                    for k, v in new_facts.items():
-                        print(f"[Ego] ★新しい記憶を保存: {k} = {v}")
-                        cursor.execute("INSERT OR REPLACE INTO user_profile (key, value, updated_at) VALUES (?, ?, ?)", (k, str(v), now))
-                conn.commit()
-
-            # ChromaDB保存
-            mem_text = f"あっきー: {user_text}\nこもも: {ai_response}"
-            self.collection.add(
-                documents=[mem_text],
-                metadatas=[{"timestamp": now}],
-                ids=[f"mem_{datetime.now().timestamp()}"]
+            mem_text = render_dialogue(user_text, ai_response)
+            self.memory_writer.add(
+                mem_text,
+                {"timestamp": created_at, "history_id": history_id, "emotion_id": str(final_id)}
             )
-            print("[Ego] ChromaDBに思い出を保存しました。")
+        except Exception as e:
+            print(f"[Ego] 記憶ストア保存エラー: {e}")
+        return True
 
+    def _recover_missing_memories(self, last_id):
+        """会話履歴（id <= last_id）のうち、記憶ストアに思い出が無いものを登録し直す"""
+        try:
+            columns = [row[1] for row in self.db.fetchall("PRAGMA table_info(conversation_history)")]
+            # 要約済みの日は1往復ごとのベクトルを消しているため対象外
+            where = "id <= ? AND consolidated = 0" if "consolidated" in columns else "id <= ?"
+            # history_id の無い古い思い出は、時刻で対応する履歴とみなす
+            stored_ids, stored_times = set(), set()
+            for _, meta in self.memory_store.metadata_items():
+                if meta.get("history_id") is not None:
+                    stored_ids.add(meta["history_id"])
+                elif meta.get("timestamp"):
+                    stored_times.add(meta["timestamp"])
+            missing = [
+                row for row in self.db.fetchall(
+                    f"SELECT id, user_text, ai_response, emotion_id, created_at FROM conversation_history WHERE {where} ORDER BY id",
+                    (last_id,))
+                if row[0] not in stored_ids and row[4] not in stored_times
+            ]
+            if missing:
+                print(f"[Ego] 記憶ストアに未登録だった会話 {len(missing)}件を登録し直します")
+            for history_id, user_text, ai_response, emotion_id, created_at in missing:
+                metadata = {"timestamp": created_at, "history_id": history_id}
+                if emotion_id is not None:
+                    metadata["emotion_id"] = str(emotion_id)
+                self.memory_writer.add(render_dialogue(user_text, ai_response), metadata)
         except Exception as e:
-            print(f"[Ego] 保存エラー: {e}")
+            print(f"[Ego] 未登録の思い出の確認に失敗しました: {e}")
 
     def _robust_parse_id(self, raw_val):
         """不正なID（1, 102等）を排除し、許可された値のみを返す"""
@@ -252,9 +591,15 @@ class EgoPlugin:
 
     def send_to_unity(self, emotion_id):
         try:
-            requests.post("http://127.0.0.1:58080/play/", json={"action": "expression", "index": int(emotion_id)}, timeout=5)
+            http_client.post("http://127.0.0.1:58080/play/", endpoint="unity", json={"action": "expression", "index": int(emotion_id)})
             print(f"[Ego] Unityへ表情ID {emotion_id} を送信しました")
         except: pass
 
+    def close(self):
+        """バッファ中の思い出と未コミットの書き込みを反映して終了する"""
+        if self.memory_writer:
+            self.memory_writer.close()
+        self.db.close()
+
     def on_plugin_loaded(self, pm):
         self.pm = pm
\ No newline at end of file
@@ -30,8 +30,15 @@ else:
 ASSETS_DIR = os.path.join(BASE_DIR, "assets")
 
 class GUIPlugin:
+    # HookDispatcher向け：キュー投入のみのため短めに打ち切る
+    dispatch_policy = {
+        "on_llm_response_generated": {"timeout": 5},
+        "on_llm_stream_completed": {"timeout": 5},
+    }
+
     def __init__(self, config, system):
         self.config = config
+        self.system = system
         self.pm = None
         self.root = None
         self.msg_queue = queue.Queue()
@@ -67,6 +74,11 @@ class GUIPlugin:
         self.msg_queue.put(("user", text))
         self.msg_queue.put(("status", "思考中... 🤔"))
 
+    @hookimpl
+    def on_partial_transcript(self, text: str):
+        # 話している最中の認識結果をステータス欄に表示（長い場合は末尾だけ）
+        self.msg_queue.put(("status", f"🎤 {text[-20:]}"))
+
     @hookimpl
     def on_llm_response_generated(self, response_text: str):
         # 歌詞データが含まれる場合の処理
@@ -79,6 +91,12 @@ class GUIPlugin:
             self.msg_queue.put(("bot", response_text))
             self.msg_queue.put(("status", "おしゃべり中 🗣️"))
 
+    @hookimpl
+    def on_llm_stream_completed(self, response_text: str):
+        # ストリーミング時は全文が揃った時点でログに残す（発声は文単位で先行済み）
+        self.msg_queue.put(("bot", response_text))
+        self.msg_queue.put(("status", "おしゃべり中 🗣️"))
+
     def update_status(self, text):
         """外部からステータス表示を更新する"""
         if self.root and self.status_var:
@@ -296,7 +314,8 @@ class GUIPlugin:
         t = self.entry_var.get().strip()
         if t and self.pm:
             self.entry_var.set(""); self.entry_box.focus_set()
-            threading.Thread(target=lambda: self.pm.hook.on_query_received(text=t), daemon=True).start()
+            # メイン側のスケジューラへ投入するだけなので、ここで直接呼び出す
+            self.pm.hook.on_query_received(text=t)
         return "break"
 
     def _request_settings(self):
@@ -305,4 +324,15 @@ class GUIPlugin:
             self.pm.hook.on_open_settings_requested(root_window=self.root)
 
     def _on_close(self):
-        self.is_running = False; self.root.destroy(); os._exit(0)
\ No newline at end of file
+        """
+        ウィンドウを閉じたらメインループに終了を伝え、run() の終了処理（バッファ中の思い出の書き込み、
+        音声認識ワーカーの停止など）に任せる。終了処理が固まった場合に備えて、最後の手段の強制終了だけ残す
+        """
+        self.is_running = False
+        if self.system is not None:
+            self.system.is_running = False
+        self.root.destroy()
+        # 終了処理がこの時間内に終われば、デーモンスレッドのタイマーはプロセスと一緒に消える
+        timer = threading.Timer(self.config.get("shutdown_timeout_seconds", 30.0), os._exit, (0,))
+        timer.daemon = True
+        timer.start()
\ No newline at end of file
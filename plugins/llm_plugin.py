@@ -6,108 +6,467 @@ Version: v4.3.0.0
 こももの「知能」を司るプラグイン。
 OpenAI, Gemini, Groq の3段階フォールバックシステムを搭載し、
 API制限による会話停止を極力防ぎます。
+ストリーミングモードでは文末ごとに1文ずつ返し、音声合成を先行開始させます。
+レースモード（llm_race）では、ヘッジ遅延ごとに次のプロバイダを並行起動し、
+最初に返ってきた回答を採用します。
+連続して失敗したプロバイダは回路を開いて一時的に経路から外し、
+バックグラウンドのプローブで復帰を確認します。
 
 [優先順位]
 1. OpenAI (gpt-4o-mini) : 安定・高速・無料枠活用
 2. Gemini (Flash 2.0)   : 高性能だがQuota制限がきつい
 3. Groq (Llama 3)       : 最終防衛ライン
 """
-import requests
 import json
 import re
-import traceback
+import time
+import queue
+import threading
 import google.generativeai as genai
+from core import http_client
+from core.providers import ProviderRegistry
+
+# 発声単位として区切る文末記号（閉じカッコは直前の文に含める）
+SENTENCE_PATTERN = re.compile(r'.+?[。！？♪!?]+[」』）)]*', re.DOTALL)
+
+# フォールバックの優先順位
+PROVIDER_ORDER = ("OpenAI", "Gemini", "Groq")
+PROVIDER_KEYS = {"OpenAI": "openai_api_key", "Gemini": "google_api_key", "Groq": "groq_api_key"}
 
 class LLMPlugin:
     def __init__(self, config, gui):
         self.config = config
         self.gui = gui
+        self.current_model = None
+        # プロバイダごとの成功率・応答時間と回路状態（故障中のプロバイダはスキップ）
+        self.registry = ProviderRegistry(
+            PROVIDER_ORDER,
+            failure_threshold=config.get("llm_circuit_failures", 3),
+            cooldown=config.get("llm_circuit_cooldown", 30.0),
+            probe=self._probe,
+        )
+        # Geminiクライアントは (APIキー, モデル名) が変わらない限り使い回す
+        self._gemini_model = None
+        self._gemini_model_key = None
+        # プロバイダごとの入力トークン・キャッシュ済みトークンの累計
+        self.usage_stats = {}
         print("[LLMPlugin] Initialized (OpenAI -> Gemini -> Groq)")
 
-    def generate_response(self, text, instruction):
+    def generate_response(self, text, instruction, cancel_event=None, volatile_context=None):
+        """
+        instruction      : システムプロンプト（ターン間で不変のプレフィックス）
+        volatile_context : 毎ターン変わる追加コンテキスト（プレフィックスの後ろに別メッセージで付与）
+        """
         print(f"[LLM] 思考プロセス開始: '{text}'")
-        conf = self.config
-        response_text = None
+        system_parts = [instruction, volatile_context]
+        providers = self._available_providers()
 
-        # --- 1. OpenAI (最優先: 安定版) ---
-        openai_key = conf.get("openai_api_key")
-        if openai_key:
-            try:
-                self.gui.update_status("思考中...(OpenAI)")
-                res = requests.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {openai_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": conf.get("openai_model", "gpt-4o-mini-2024-07-18"),
-                        "messages": [
-                            {"role": "system", "content": instruction},
-                            {"role": "user", "content": text}
-                        ],
-                        "temperature": 0.7
-                    }, timeout=20
-                )
-                if res.status_code == 200:
-                    response_text = res.json()["choices"][0]["message"]["content"]
-                    self.current_model = "OpenAI"
-                    print("[LLM] OpenAIから応答を受信")
-                    self.gui.update_status("オンライン (OpenAI)")
-                else:
-                    print(f"[LLM] OpenAI Error: {res.status_code}")
-            except Exception as e:
-                print(f"[LLM] OpenAI接続エラー: {e}")
+        # --- レースモード：ヘッジ遅延ごとに次のプロバイダを並行起動し、最初の回答を採用 ---
+        if self.config.get("llm_race", False):
+            contenders = [(name, lambda cancel, name=name: self._call_once(name, text, system_parts))
+                          for name in self._race_providers(providers)]
+            for response_text in self._race(contenders, "response", cancel_event):
+                return self._clean_response(response_text)
+            self.gui.update_status("全API接続失敗")
+            return None
 
-        # --- 2. Gemini (フォールバック 1) ---
-        google_key = conf.get("google_api_key")
-        if not response_text and google_key:
+        # --- 逐次フォールバック：OpenAI -> Gemini -> Groq ---
+        response_text = None
+        for i, name in enumerate(providers):
+            # 割り込まれたターンでは次のプロバイダへ進まない
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            if i == 0:
+                self.gui.update_status(f"思考中...({name})")
+            else:
+                self.gui.update_status(f"{providers[i - 1]}不可... {name}へ切替")
             try:
-                self.gui.update_status("OpenAI不可... Geminiへ切替")
-                genai.configure(api_key=google_key)
-                # モデル名の 'models/' 接頭辞を除去して正規化
-                model_name = conf.get("gemini_model", "gemini-2.0-flash").replace("models/", "")
-                model = genai.GenerativeModel(model_name)
-                
-                # Geminiは systemプロンプトを generate_content の引数に入れるか、
-                # SystemInstructionとして渡す必要があるが、簡易的に結合する
-                full_prompt = f"System: {instruction}\nUser: {text}"
-                
-                res = model.generate_content(full_prompt)
-                if res and res.text:
-                    response_text = res.text
-                    self.current_model = "Gemini"
-                    print("[LLM] Geminiから応答を受信")
-                    self.gui.update_status("オンライン (Gemini)")
+                started = time.monotonic()
+                response_text = self._call_provider(name, text, system_parts)
+                if response_text:
+                    self.registry.record_success(name, "response", time.monotonic() - started)
+                    self.current_model = name
+                    print(f"[LLM] {name}から応答を受信")
+                    self.gui.update_status(f"オンライン ({name})")
+                    break
+                self.registry.record_failure(name, "empty response")
             except Exception as e:
-                print(f"[LLM] Gemini接続エラー: {e}")
+                print(f"[LLM] {name}接続エラー: {e}")
+                self.registry.record_failure(name, str(e))
+
+        if not response_text:
+            self.gui.update_status("全API接続失敗")
+        return self._clean_response(response_text) if response_text else None
+
+    def generate_response_stream(self, text, instruction, cancel_event=None, volatile_context=None):
+        """
+        ストリーミング版の回答生成。
+        トークンを受信しながら文末（。！？♪）で区切り、完成した1文ずつ yield する。
+        最初の1文を返す前に失敗したプロバイダのみ、次のプロバイダへフォールバックする。
+        cancel_event がセットされたら受信中のストリームを閉じて終了する。
+        """
+        print(f"[LLM] 思考プロセス開始 (Streaming): '{text}'")
+        system_parts = [instruction, volatile_context]
+        providers = self._available_providers()
+
+        # --- レースモード：最初の1文が最も早く届いたプロバイダを採用し、他は接続を閉じる ---
+        if self.config.get("llm_race", False):
+            contenders = [(name, lambda cancel, name=name: self._stream_sentences(name, text, system_parts, cancel))
+                          for name in self._race_providers(providers)]
+            yielded = False
+            for sentence in self._race(contenders, "stream", cancel_event):
+                yielded = True
+                yield sentence
+            if not yielded:
+                self.gui.update_status("全API接続失敗")
+            return
 
-        # --- 3. Groq (フォールバック 2: 最終手段) ---
-        groq_key = conf.get("groq_api_key")
-        if not response_text and groq_key:
+        for name in providers:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            token_stream = self._stream_provider(name, text, system_parts)
+            yielded = False
+            started = time.monotonic()
             try:
-                self.gui.update_status("Gemini制限中... Groqへ切替")
-                res = requests.post(
-                    "https://api.groq.com/openai/v1/chat/completions",
-                    headers={"Authorization": f"Bearer {groq_key}"},
-                    json={
-                        "model": conf.get("groq_model", "llama-3.3-70b-versatile"),
-                        "messages": [
-                            {"role": "system", "content": instruction},
-                            {"role": "user", "content": text}
-                        ]
-                    }, timeout=15
-                )
-                if res.status_code == 200:
-                    response_text = res.json()["choices"][0]["message"]["content"]
-                    self.current_model = "Groq"
-                    print("[LLM] Groqから応答を受信")
-                    self.gui.update_status("オンライン (Groq)")
+                self.gui.update_status(f"思考中...({name})")
+                for sentence in self._iter_sentences(token_stream, cancel_event):
+                    if not yielded:
+                        self.registry.record_success(name, "stream", time.monotonic() - started)
+                        self.current_model = name
+                        print(f"[LLM] {name}から最初の1文を受信")
+                        self.gui.update_status(f"オンライン ({name})")
+                    yielded = True
+                    yield sentence
             except Exception as e:
-                print(f"[LLM] Groq接続エラー: {e}")
-                self.gui.update_status("全API接続失敗")
+                print(f"[LLM] {name} ストリーミングエラー: {e}")
+            finally:
+                # 途中終了時もHTTP接続を確実に解放する
+                token_stream.close()
+            if yielded or (cancel_event is not None and cancel_event.is_set()):
+                return
+            self.registry.record_failure(name, "stream failed")
+        self.gui.update_status("全API接続失敗")
 
-        return self._clean_response(response_text) if response_text else None
+    # --- プロバイダ呼び出し ---
+    def _available_providers(self):
+        """
+        APIキーが設定され、回路が閉じている（故障中でない）プロバイダを優先順位順に返す。
+        すべて停止中の場合は、黙り込むよりはましなので全プロバイダを試す。
+        """
+        configured = [name for name in PROVIDER_ORDER if self.config.get(PROVIDER_KEYS[name])]
+        healthy = [name for name in configured if self.registry.is_available(name)]
+        skipped = [name for name in configured if name not in healthy]
+        if skipped and healthy:
+            print(f"[LLM] 停止中のプロバイダをスキップ: {', '.join(skipped)}")
+        return healthy or configured
+
+    def _probe(self, name):
+        """回路半開時の復帰確認：最小限のプロンプトで1回だけ生成させる"""
+        if not self.config.get(PROVIDER_KEYS[name]):
+            return False
+        return bool(self._call_provider(name, "ping", ["Reply with a single word: OK"]))
+
+    def _call_provider(self, name, text, system_parts):
+        """指定プロバイダで回答を1回生成する（失敗時は None または例外）"""
+        conf = self.config
+        if name == "OpenAI":
+            return self._call_openai_compatible(
+                "https://api.openai.com/v1/chat/completions", "openai",
+                {"Authorization": f"Bearer {conf.get('openai_api_key')}", "Content-Type": "application/json"},
+                self._openai_payload(text, system_parts), name
+            )
+        if name == "Gemini":
+            return self._call_gemini(text, system_parts)
+        if name == "Groq":
+            return self._call_openai_compatible(
+                "https://api.groq.com/openai/v1/chat/completions", "groq",
+                {"Authorization": f"Bearer {conf.get('groq_api_key')}"},
+                self._groq_payload(text, system_parts), name
+            )
+        return None
+
+    def _stream_provider(self, name, text, system_parts):
+        """指定プロバイダのトークンストリームを返す（反復を始めるまで通信しない）"""
+        conf = self.config
+        if name == "OpenAI":
+            return self._stream_openai_compatible(
+                "https://api.openai.com/v1/chat/completions", "openai",
+                {"Authorization": f"Bearer {conf.get('openai_api_key')}", "Content-Type": "application/json"},
+                # 最終チャンクで usage（キャッシュ済みトークン数を含む）を受け取る
+                {**self._openai_payload(text, system_parts), "stream_options": {"include_usage": True}},
+                name
+            )
+        if name == "Gemini":
+            return self._stream_gemini(text, system_parts)
+        return self._stream_openai_compatible(
+            "https://api.groq.com/openai/v1/chat/completions", "groq",
+            {"Authorization": f"Bearer {conf.get('groq_api_key')}"},
+            self._groq_payload(text, system_parts),
+            name
+        )
+
+    def _messages(self, text, system_parts):
+        """
+        不変プレフィックスを先頭の system メッセージに置き、変動部分を2つ目に分ける。
+        先頭がターン間でバイト単位で一致するため、OpenAI等のプレフィックスキャッシュが効く
+        """
+        messages = [{"role": "system", "content": part} for part in system_parts if part]
+        messages.append({"role": "user", "content": text})
+        return messages
+
+    def _gemini_prompt(self, text, system_parts):
+        # Geminiは systemプロンプトを generate_content の引数に入れるか、
+        # SystemInstructionとして渡す必要があるが、簡易的に結合する（不変部分を先頭に置く）
+        return "System: " + "\n".join(part for part in system_parts if part) + f"\nUser: {text}"
+
+    def _openai_payload(self, text, system_parts):
+        return {
+            "model": self.config.get("openai_model", "gpt-4o-mini-2024-07-18"),
+            "messages": self._messages(text, system_parts),
+            "temperature": 0.7
+        }
+
+    def _groq_payload(self, text, system_parts):
+        return {
+            "model": self.config.get("groq_model", "llama-3.3-70b-versatile"),
+            "messages": self._messages(text, system_parts)
+        }
+
+    def _call_openai_compatible(self, url, endpoint, headers, payload, name):
+        res = http_client.post(url, endpoint=endpoint, headers=headers, json=payload)
+        if res.status_code == 200:
+            data = res.json()
+            self._record_openai_usage(name, data.get("usage"))
+            return data["choices"][0]["message"]["content"]
+        # 429/5xx などは例外として扱い、プロバイダの失敗として記録させる
+        raise RuntimeError(f"{name} HTTP {res.status_code}")
+
+    def _get_gemini_model(self):
+        """GenerativeModel を一度だけ構築して使い回す（キー・モデル変更時のみ再構築）"""
+        api_key = self.config.get("google_api_key")
+        # モデル名の 'models/' 接頭辞を除去して正規化
+        model_name = self.config.get("gemini_model", "gemini-2.0-flash").replace("models/", "")
+        if self._gemini_model is None or self._gemini_model_key != (api_key, model_name):
+            genai.configure(api_key=api_key)
+            self._gemini_model = genai.GenerativeModel(model_name)
+            self._gemini_model_key = (api_key, model_name)
+        return self._gemini_model
+
+    def _call_gemini(self, text, system_parts):
+        model = self._get_gemini_model()
+        full_prompt = self._gemini_prompt(text, system_parts)
+
+        res = model.generate_content(full_prompt)
+        self._record_gemini_usage(getattr(res, "usage_metadata", None))
+        if res and res.text:
+            return res.text
+        return None
+
+    def _stream_sentences(self, name, text, system_parts, cancel):
+        """レース用：1文ずつのイテレータ。取り消し時はHTTP接続を閉じる"""
+        token_stream = self._stream_provider(name, text, system_parts)
+        try:
+            yield from self._iter_sentences(token_stream, cancel)
+        finally:
+            token_stream.close()
+
+    def _call_once(self, name, text, system_parts):
+        """レース用：1回分の回答を1要素のイテレータとして返す"""
+        response_text = self._call_provider(name, text, system_parts)
+        if response_text:
+            yield response_text
+
+    # --- レース（ヘッジ）制御 ---
+    def _race_providers(self, providers):
+        """レースに参加させるプロバイダ（設定順、キー未設定のものは除外）"""
+        names = self.config.get("llm_race_providers") or list(PROVIDER_ORDER)
+        return [name for name in names if name in providers]
+
+    def _hedge_delay(self, name, mode):
+        """
+        次のプロバイダを並行起動するまでの待ち時間。
+        llm_hedge_delay が "auto" の場合は、先頭プロバイダの最近の応答時間の p95 を使う。
+        """
+        delay = self.config.get("llm_hedge_delay", "auto")
+        if delay != "auto":
+            return float(delay)
+        p95 = self.registry.p95_latency(name, mode)
+        if p95 is None:
+            return float(self.config.get("llm_hedge_delay_default", 3.0))
+        return max(0.5, p95)
+
+    def _race(self, contenders, mode, cancel_event=None):
+        """
+        contenders: [(プロバイダ名, run(cancel) -> 結果のイテレータ)]
+        先頭から起動し、ヘッジ遅延内に最初の結果が来なければ次を並行起動する。
+        最初に結果を返したプロバイダを勝者とし、残りには取り消しを通知して結果を捨てる。
+        勝者の結果だけを順に yield する。
+        """
+        if not contenders:
+            return
+        events = queue.Queue()
+        cancels = {}
+        launched = []
+        finished = set()
+        winner = None
+        hedge = self._hedge_delay(contenders[0][0], mode)
+
+        def launch():
+            name, run = contenders[len(launched)]
+            cancel = threading.Event()
+            cancels[name] = cancel
+            launched.append(name)
+            started = time.monotonic()
+
+            def worker():
+                ok = False
+                try:
+                    for item in run(cancel):
+                        if cancel.is_set():
+                            break
+                        if not ok:
+                            self.registry.record_success(name, mode, time.monotonic() - started)
+                        ok = True
+                        events.put(("item", name, item))
+                except Exception as e:
+                    print(f"[LLM] {name}接続エラー (レース): {e}")
+                # 負けて取り消されたプロバイダは故障扱いにしない
+                if not ok and not cancel.is_set():
+                    self.registry.record_failure(name, "race failed")
+                events.put(("done", name, ok))
+
+            print(f"[LLM] レース参加: {name}")
+            threading.Thread(target=worker, daemon=True).start()
+            return time.monotonic() + hedge
+
+        self.gui.update_status(f"思考中...({contenders[0][0]})")
+        next_hedge = launch()
+        try:
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                try:
+                    kind, name, value = events.get(timeout=0.1)
+                except queue.Empty:
+                    if winner is None and len(launched) < len(contenders) and time.monotonic() >= next_hedge:
+                        print(f"[LLM] {hedge:.1f}s 応答なし -> ヘッジ起動")
+                        self.gui.update_status(f"応答待ち... {contenders[len(launched)][0]}も並行で試行")
+                        next_hedge = launch()
+                    continue
+
+                if kind == "item":
+                    if winner is None:
+                        winner = name
+                        self.current_model = name
+                        print(f"[LLM] レース勝者: {name}")
+                        self.gui.update_status(f"オンライン ({name})")
+                        for other, cancel in cancels.items():
+                            if other != name:
+                                cancel.set()
+                    if name == winner:
+                        yield value
+                    continue
+
+                finished.add(name)
+                if name == winner:
+                    return
+                if winner is None:
+                    if len(launched) < len(contenders):
+                        # 失敗したプロバイダの分は、ヘッジ遅延を待たずに次を起動する
+                        next_hedge = launch()
+                    elif len(finished) == len(launched):
+                        return
+        finally:
+            # 勝者確定後・中断時ともに、まだ走っているプロバイダへ取り消しを通知する
+            for name, cancel in cancels.items():
+                if name not in finished:
+                    cancel.set()
+
+    # --- ストリーミング ---
+    def _stream_openai_compatible(self, url, endpoint, headers, payload, name):
+        """OpenAI互換API (OpenAI / Groq) の SSE ストリームからトークンを取り出す"""
+        with http_client.post(url, endpoint=endpoint, headers=headers,
+                              json={**payload, "stream": True}, stream=True) as res:
+            if res.status_code != 200:
+                raise RuntimeError(f"HTTP {res.status_code}")
+            for line in res.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                # OpenAI は最終チャンクの usage、Groq は x_groq.usage に集計が入る
+                usage = chunk.get("usage") or (chunk.get("x_groq") or {}).get("usage")
+                if usage:
+                    self._record_openai_usage(name, usage)
+                choices = chunk.get("choices") or []
+                token = choices[0].get("delta", {}).get("content") if choices else None
+                if token:
+                    yield token
+
+    def _stream_gemini(self, text, system_parts):
+        """Gemini の generate_content(stream=True) からトークンを取り出す"""
+        model = self._get_gemini_model()
+        full_prompt = self._gemini_prompt(text, system_parts)
+        usage = None
+        for chunk in model.generate_content(full_prompt, stream=True):
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            if chunk.text:
+                yield chunk.text
+        self._record_gemini_usage(usage)
+
+    # --- 使用量（プレフィックスキャッシュのヒット状況）の記録 ---
+    def _record_openai_usage(self, name, usage):
+        if not usage:
+            return
+        details = usage.get("prompt_tokens_details") or {}
+        self._record_usage(name, usage.get("prompt_tokens", 0), details.get("cached_tokens", 0))
+
+    def _record_gemini_usage(self, usage):
+        if usage is None:
+            return
+        self._record_usage("Gemini", getattr(usage, "prompt_token_count", 0) or 0,
+                           getattr(usage, "cached_content_token_count", 0) or 0)
+
+    def _record_usage(self, name, prompt_tokens, cached_tokens):
+        """プロバイダごとの入力トークン数とキャッシュ済みトークン数を累計する"""
+        stats = self.usage_stats.setdefault(name, {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0})
+        stats["requests"] += 1
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        ratio = cached_tokens / prompt_tokens * 100 if prompt_tokens else 0
+        print(f"[LLM] {name} 入力 {prompt_tokens} tokens (キャッシュ {cached_tokens}, {ratio:.0f}%)")
+
+    def split_sentences(self, text):
+        """完成済みの回答を発声単位の文に分割する（キャッシュ回答の配送用）"""
+        return list(self._iter_sentences([text]))
+
+    def _iter_sentences(self, tokens, cancel_event=None):
+        """トークン列をバッファリングし、文末記号ごとにクリーニング済みの1文を返す"""
+        buffer = ""
+        for token in tokens:
+            if cancel_event is not None and cancel_event.is_set():
+                print("[LLM] 取り消しによりストリーミングを中断しました")
+                return
+            buffer += token
+            # <think> ブロックの途中では区切らない（閉じタグが来るまで待つ）
+            if "<think>" in buffer and "</think>" not in buffer:
+                continue
+            buffer = re.sub(r'<think>.*?</think>', '', buffer, flags=re.DOTALL)
+            pos = 0
+            for m in SENTENCE_PATTERN.finditer(buffer):
+                # 記号が連続する可能性があるため、バッファ末尾に接した文は次のトークンを待つ
+                if m.end() == len(buffer):
+                    break
+                sentence = self._clean_response(m.group())
+                if sentence:
+                    yield sentence
+                pos = m.end()
+            buffer = buffer[pos:]
+        sentence = self._clean_response(buffer)
+        if sentence:
+            yield sentence
 
     def _clean_response(self, text):
         """発声に不要なタグ [ID:xx] などを除去"""
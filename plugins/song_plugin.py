@@ -98,8 +98,10 @@ class Plugin:
 
         # 1. イントロのセリフ（これは喋らせる）
         intro_text = "コンサート、始めちゃうよ！" if is_concert else "私の歌、聴いてほしいな。"
-        self.pm.hook.on_llm_response_generated(response_text=intro_text)
-        time.sleep(2.5)
+        self.pm.hook.on_llm_response_generated(response_text=intro_text, turn_id=None)
+        # 発声は合成・再生キューに積まれるだけなので、再生し終わるまで待ってから曲を送る
+        # （先に曲を送ると、遅れて届いたセリフの音声がUnity側で曲を上書きしてしまう）
+        self._wait_voice_idle(voice_p)
 
         for fname in files:
             # 表情制御：ID:20（歌唱用）を直接送信
@@ -141,8 +143,8 @@ class Plugin:
         if is_concert:
             time.sleep(1.0)
             # 感謝の言葉
-            self.pm.hook.on_llm_response_generated(response_text="聴いてくれてありがとう。")
-            time.sleep(2.5) # 最後のセリフが終わるまでブロックを維持
+            self.pm.hook.on_llm_response_generated(response_text="聴いてくれてありがとう。", turn_id=None)
+            self._wait_voice_idle(voice_p) # 最後のセリフが終わるまでブロックを維持
         
         # フラグを解除して通常会話を許可
         self.is_singing = False
@@ -152,6 +154,13 @@ class Plugin:
 
         print("[SongPlugin] 歌唱シーケンス終了。通常モードに戻ります。")
 
+    def _wait_voice_idle(self, voice_p):
+        """セリフの再生完了を待つ（VoicePlugin がなければ従来どおり一定時間待つ）"""
+        if voice_p and hasattr(voice_p, "wait_until_idle"):
+            voice_p.wait_until_idle()
+        else:
+            time.sleep(2.5)
+
     def _get_wav_duration(self, file_path):
         """wavファイルの長さを秒で取得"""
         try:
@@ -9,20 +9,104 @@ Version: v4.2.0
 
 [主な機能]
 - VAD（音声区間検出）による自動録音・解析
-- Whisperモデルを利用した高精度な音声認識
+- Whisperモデルを利用した高精度な音声認識（openai-whisper / faster-whisper を設定で切り替え）
+- マイクの音声を 16kHz の float32 配列のままモデルへ渡す（一時WAVファイル・ffmpeg を使わない）
+- 常時聴取モード：ボタン操作なしで発話区間を検出（発話前の音声も含めて解析、ノイズフロアは自動追従）
+  （こももの発声中は聴取を止め、自分の声を発話として拾わない）
+- ストリーミングモード：話している最中から重なりのある窓で逐次解析し、途中経過を通知
+  （話し終わった時点では未確定の短い区間だけを解析すればよい）
+- 推論専用のワーカープロセス（解析中も画面が固まらない。起動時のウォームアップ後に準備完了）
 - コンサートモード中などの特定条件下での入力抑制（メイン側と連動）
 """
 import pluggy
+import queue
 import threading
 import time
 import speech_recognition as sr
-import whisper
-import os
-import torch
 import traceback
 
+from core.audio import AudioRingBuffer, EnergyVAD, pcm16_to_float32, resample, rms
+from core.stt_backend import SAMPLE_RATE, create_stt_backend
+from core.stt_worker import STTWorkerClient, STTWorkerUnavailable
+
 hookimpl = pluggy.HookimplMarker("komomo")
 
+
+class StreamingTranscriber:
+    """
+    録音中の音声を一定間隔で解析し、確定した区間の文字列を積み上げていく。
+    毎回「未確定の区間」だけを解析し、窓の末尾から十分離れて終わったセグメントを確定させるため、
+    解析する窓は発話が長くなっても短いまま保たれる。
+    """
+
+    def __init__(self, transcribe_fn, buffer, start, step_seconds=1.0, stable_margin_seconds=1.0, on_partial=None):
+        """
+        transcribe_fn         : transcribe_fn(audio, prompt, condition_on_previous_text) -> [(開始秒, 終了秒, 文字列), ...]
+        buffer                : 録音中の音声を書き込む AudioRingBuffer
+        start                 : 発話の開始位置（buffer の絶対位置）
+        step_seconds          : 新しい音声がこの秒数溜まるごとに解析し直す
+        stable_margin_seconds : 窓の末尾からこの秒数以上前に終わったセグメントを確定する
+        on_partial            : 途中経過の通知先 on_partial(text)
+        """
+        self.transcribe_fn = transcribe_fn
+        self.buffer = buffer
+        self.step = int(step_seconds * SAMPLE_RATE)
+        self.stable_margin = stable_margin_seconds
+        self.on_partial = on_partial
+        self.committed_text = ""
+        self.committed_at = start
+        self.passes = 0
+        self._last_partial = ""
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="komomo-stt-stream", daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        decoded_until = self.committed_at
+        while not self._stop.is_set():
+            total = self.buffer.total
+            if total - decoded_until < self.step:
+                self._stop.wait(0.05)
+                continue
+            decoded_until = total
+            try:
+                self._decode(total)
+            except Exception as e:
+                print(f"[STT] 逐次解析エラー: {e}")
+
+    def _decode(self, end, final=False):
+        audio = self.buffer.read(self.committed_at, end)
+        if not len(audio):
+            return self.committed_text
+        # 窓ごとに解析し直すため、窓の中でも前のセグメントの結果を引きずらないようにする
+        segments = self.transcribe_fn(audio, self.committed_text[-200:] or None, condition_on_previous_text=False)
+        self.passes += 1
+        if final:
+            return self.committed_text + "".join(text for _, _, text in segments)
+
+        # 最後のセグメントは続きの音声で変わりうるため、確定させない
+        duration = len(audio) / SAMPLE_RATE
+        stable = [seg for seg in segments[:-1] if seg[1] <= duration - self.stable_margin]
+        if stable:
+            self.committed_text += "".join(text for _, _, text in stable)
+            self.committed_at = min(end, self.committed_at + int(stable[-1][1] * SAMPLE_RATE))
+        partial = self.committed_text + "".join(text for _, _, text in segments[len(stable):])
+        if partial and partial != self._last_partial and self.on_partial:
+            self._last_partial = partial
+            self.on_partial(partial)
+        return partial
+
+    def cancel(self):
+        """逐次解析を止める（結果は使わない）"""
+        self._stop.set()
+
+    def finish(self, end):
+        """逐次解析を止め、未確定の区間だけを解析して最終結果を返す"""
+        self._stop.set()
+        self._thread.join()
+        return self._decode(end, final=True).strip()
+
+
 class STTPlugin:
     def __init__(self, config, gui):
         self.config = config
@@ -36,8 +120,35 @@ class STTPlugin:
         
         self.model_size = config.get("whisper_model", "small")
         self.model = None
+        self.model_ready = threading.Event()
+        # このプロセス内で推論する場合、逐次解析と確定処理から同時にモデルを呼ばないようにする
+        self._transcribe_lock = threading.Lock()
+        self.use_worker = config.get("stt_worker_process", True)
         self.is_recording = False
-        self.source = sr.Microphone()
+        # 環境音に合わせた energy_threshold の調整は最初の録音で1度だけ行い、以降は保持した値を使う
+        # （押すたびに0.5秒測ると、その分だけ待たされ、話し始めが録音されない）
+        self._calibrated = False
+        # Whisper と同じ 16kHz で録音し、解析前の変換（リサンプリング）を不要にする
+        self.source = sr.Microphone(sample_rate=SAMPLE_RATE)
+
+        # ストリーミング認識（話している最中から逐次解析する）
+        self.streaming = config.get("stt_streaming", False)
+        self.stream_step_seconds = config.get("stt_stream_step_seconds", 1.0)
+        self.stream_stable_margin_seconds = config.get("stt_stream_stable_margin_seconds", 1.0)
+
+        # 常時聴取（ボタン操作なしで発話を検出する）
+        self.always_on = config.get("stt_always_on", False)
+        self.sample_rate = config.get("sample_rate", SAMPLE_RATE)
+        self.channels = config.get("channels", 1)
+        # max_record_seconds を過ぎたら短い息継ぎで区切り、話し続けていても stt_max_utterance_seconds で打ち切る
+        self.max_record_seconds = config.get("max_record_seconds", 6.0)
+        self.max_utterance_seconds = max(self.max_record_seconds, config.get("stt_max_utterance_seconds", 30.0))
+        self.silence_threshold = config.get("silence_threshold", 0.008)
+        self.silence_limit_seconds = config.get("silence_limit_seconds", 0.8)
+        self.pre_roll_seconds = config.get("stt_pre_roll_seconds", 0.3)
+        self.vad_noise_margin = config.get("stt_vad_noise_margin", 3.0)
+        self.listening = False
+        self._utterances = queue.Queue(maxsize=2)
         print(f"[STT] インスタンス生成完了")
         # ★ on_plugin_loadedを待たずにロードを開始する
         threading.Thread(target=self._load_model, daemon=True).start()
@@ -45,27 +156,83 @@ class STTPlugin:
     def on_plugin_loaded(self, pm):
         self.pm = pm
         print(f"[STT] PluginManagerをセットしました")
+        if self.always_on and not self.listening:
+            self.listening = True
+            threading.Thread(target=self._listen_loop, name="komomo-stt-listen", daemon=True).start()
+            threading.Thread(target=self._utterance_worker, name="komomo-stt-decode", daemon=True).start()
 
     def _load_model(self):
         print(f"[STT] Whisperモデル({self.model_size})ロード開始...")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.model = whisper.load_model(self.model_size, device=device)
+        if self.use_worker:
+            # 推論は別プロセスで行う（モデルの読み込みとウォームアップが終わるまで待つ）
+            worker = STTWorkerClient(self.config, max_pending=self.config.get("stt_worker_queue_size", 4),
+                                     result_timeout=self.config.get("stt_worker_timeout_seconds", 60.0),
+                                     max_restarts=self.config.get("stt_worker_max_restarts", 2),
+                                     ready_timeout=self.config.get("stt_worker_ready_timeout_seconds", 300.0))
+            if worker.wait_ready(worker.ready_timeout):
+                self.model = worker
+            else:
+                worker.close()
+                print("[STT] 音声認識ワーカーを起動できなかったため、このプロセス内で解析します")
+        if self.model is None:
+            self.model = self._load_local_backend()
+        self.model_ready.set()
         print(f"[STT] モデルロード完了。マイク入力準備OK。")
 
+    def _load_local_backend(self):
+        model = create_stt_backend(self.config)
+        model.warm_up()
+        return model
+
+    def _transcribe(self, audio, prompt=None, condition_on_previous_text=True):
+        """モデルでの解析（ワーカープロセスは依頼を順に処理するため、このプロセス内で推論する場合のみ排他する）"""
+        worker = self.model
+        if isinstance(worker, STTWorkerClient):
+            try:
+                return worker.transcribe(audio, prompt, condition_on_previous_text)
+            except STTWorkerUnavailable as e:
+                print(f"[STT] {e}。このプロセス内での解析に切り替えます")
+                self._fallback_to_local(worker)
+        with self._transcribe_lock:
+            return self.model.transcribe(audio, prompt, condition_on_previous_text)
+
+    def _fallback_to_local(self, worker):
+        """再起動できなくなったワーカーを閉じ、このプロセス内のモデルに差し替える（一度だけ読み込む）"""
+        with self._transcribe_lock:
+            if self.model is worker:
+                worker.close()
+                self.model = self._load_local_backend()
+
+    def _transcribe_text(self, audio, prompt=None):
+        return "".join(text for _, _, text in self._transcribe(audio, prompt)).strip()
+
+    def close(self):
+        """常時聴取と音声認識ワーカーを止める（終了時用）"""
+        self.listening = False
+        if hasattr(self.model, "close"):
+            self.model.close()
+
     @hookimpl
     def on_start_recording_requested(self):
+        if self.always_on:
+            print("[STT] 常時聴取モードのため、録音ボタンは使用しません")
+            return
         if self.is_recording:
             return
         print("[STT] 録音開始リクエストを受信 -> 録音スレッド起動")
         self.is_recording = True
         # ボタンが押されたら、その都度録音処理をスレッドで走らせる
-        threading.Thread(target=self._record_process, daemon=True).start()
+        target = self._stream_process if self.streaming else self._record_process
+        threading.Thread(target=target, daemon=True).start()
 
     @hookimpl
     def on_stop_recording_requested(self):
-        # 今回は「無音検知」または「30秒」で自動停止するため、
-        # ここではフラグ管理のみ（必要なら強制停止ロジックを組む）
-        print("[STT] 録音停止リクエストを受信 (自動停止を待ちます)")
+        # 通常モードは「無音検知」または「30秒」で自動停止するため、ここではフラグ管理のみ
+        # ストリーミングモードではこのフラグで発話を締めくくる
+        if self.streaming:
+            print("[STT] 録音停止リクエストを受信 (発話を確定します)")
+        else:
+            print("[STT] 録音停止リクエストを受信 (自動停止を待ちます)")
         self.is_recording = False
 
     def _record_process(self):
@@ -76,15 +243,14 @@ class STTPlugin:
 
         try:
             with self.source as source:
-                # 最初の0.5秒で環境音に慣らす
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                self._calibrate_once(source)
                 print("[STT] 聴取中... (話し終わると自動で解析します)")
                 
                 # phrase_time_limit: 最大30秒
                 # timeout: 何も聞こえないまま5秒経ったら終了
                 audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=30)
                 
-            print(f"[STT] 録音終了 (データ受信: {len(audio.get_wav_data())} bytes)")
+            print(f"[STT] 録音終了 (データ受信: {len(audio.frame_data)} bytes)")
             self._transcribe_and_send(audio)
 
         except sr.WaitTimeoutError:
@@ -97,40 +263,227 @@ class STTPlugin:
             if hasattr(self.gui, "update_status"):
                 self.gui.update_status("スタンバイ OK ✨")
 
-    def _transcribe_and_send(self, audio):
-        """Whisper解析とメインへの送信"""
+    def _calibrate_once(self, source):
+        """最初の録音でだけ0.5秒間の環境音から energy_threshold を決める（以降は listen() の自動調整に任せる）"""
+        if self._calibrated:
+            return
+        self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
+        self._calibrated = True
+        print(f"[STT] 環境音に合わせて感度を調整しました (energy_threshold: {self.recognizer.energy_threshold:.0f})")
+
+    def _stream_process(self, timeout=5, phrase_time_limit=30):
+        """ストリーミング録音：録音しながら逐次解析し、話し終わりで確定させる"""
+        print("[STT] >>> 録音フェーズ開始 (ストリーミング)")
+        if hasattr(self.gui, "update_status"):
+            self.gui.update_status("きいてるよ... 🎤")
+
+        # 発話の上限＋発話前の余裕分を保持する
+        buffer = AudioRingBuffer((phrase_time_limit + 1) * SAMPLE_RATE)
+        transcriber = None
+        try:
+            # 録音しながら解析するため、先にモデルの準備を済ませる
+            self._wait_for_model()
+            with self.source as source:
+                self._calibrate_once(source)
+                print("[STT] 聴取中... (話しながら解析します)")
+                chunk_seconds = source.CHUNK / SAMPLE_RATE
+                waited = silence = 0.0
+                while True:
+                    samples = pcm16_to_float32(source.stream.read(source.CHUNK))
+                    buffer.write(samples)
+                    # energy_threshold は16bit PCM の振幅で表される
+                    loud = rms(samples) * 32768 > self.recognizer.energy_threshold
+
+                    if transcriber is None:
+                        waited += chunk_seconds
+                        if loud:
+                            # 話し始めの直前（0.5秒）から解析に含める
+                            start = max(buffer.oldest, buffer.total - int(0.5 * SAMPLE_RATE))
+                            transcriber = StreamingTranscriber(
+                                self._transcribe, buffer, start,
+                                step_seconds=self.stream_step_seconds,
+                                stable_margin_seconds=self.stream_stable_margin_seconds,
+                                on_partial=self._publish_partial,
+                            )
+                        elif waited >= timeout or not self.is_recording:
+                            print("[STT] タイムアウト: 音声が検知されませんでした")
+                            return
+                        continue
+
+                    silence = 0.0 if loud else silence + chunk_seconds
+                    spoken = (buffer.total - transcriber.committed_at) / SAMPLE_RATE
+                    if silence >= self.recognizer.pause_threshold or not self.is_recording \
+                            or buffer.total - start >= phrase_time_limit * SAMPLE_RATE:
+                        break
+
+            end_of_speech = time.perf_counter()
+            text = transcriber.finish(buffer.total)
+            print(f"[STT] 発話終了から確定まで {time.perf_counter() - end_of_speech:.2f}s "
+                  f"(未確定区間 {spoken:.1f}s, 解析 {transcriber.passes}回)")
+            self._send_text(text)
+
+        except Exception as e:
+            print(f"[STT] 録音エラー: {e}")
+            traceback.print_exc()
+        finally:
+            # 確定前に失敗した場合も逐次解析のスレッドを残さない（確定済みなら何もしない）
+            if transcriber is not None:
+                transcriber.cancel()
+            self.is_recording = False
+            if hasattr(self.gui, "update_status"):
+                self.gui.update_status("スタンバイ OK ✨")
+
+    # --- 常時聴取モード ---
+    def _listen_loop(self, block_seconds=0.1):
+        """マイクを開いたまま、発話区間を検出するたびに解析キューへ渡す"""
+        self._wait_for_model()
+        pyaudio = sr.Microphone.get_pyaudio()
+        pa = pyaudio.PyAudio()
+        block = int(self.sample_rate * block_seconds)
+        stream = pa.open(format=pyaudio.paInt16, channels=self.channels, rate=self.sample_rate,
+                         input=True, frames_per_buffer=block)
+        # 発話前の余裕分＋発話の上限に、解析待ちの間に上書きされない余裕を持たせる
+        buffer = AudioRingBuffer(int((self.pre_roll_seconds + self.max_utterance_seconds) * 2 + 5) * SAMPLE_RATE)
+        vad = EnergyVAD(SAMPLE_RATE, threshold=self.silence_threshold, margin=self.vad_noise_margin)
+        pre_roll = int(self.pre_roll_seconds * SAMPLE_RATE)
+        start = transcriber = None
+        silence = 0.0
+        try:
+            # ノイズフロアの初期値は起動時に1度だけ測り、以降は聴取しながら追従させる
+            vad.calibrate(self._read_block(stream, int(self.sample_rate * 0.5)))
+            print(f"[STT] 常時聴取を開始しました (ノイズフロア: {vad.noise_floor:.4f})")
+            if hasattr(self.gui, "update_status"):
+                self.gui.update_status("スタンバイ OK ✨")
+            while self.listening:
+                samples = self._read_block(stream, block)
+                if self._playback_active():
+                    # エコーキャンセルが無いため、こももの発声中は聴取しない（ノイズフロアも更新しない）
+                    if start is not None:
+                        if transcriber is not None:
+                            transcriber.cancel()
+                        start = transcriber = None
+                        print("[STT] 発声が始まったため、聴取中の音声を破棄しました")
+                    continue
+                buffer.write(samples)
+                speech = vad.analyze(samples)
+
+                if start is None:
+                    # 単発のノイズで反応しないよう、2フレーム以上の発話で開始する
+                    if speech.sum() >= 2:
+                        start = max(buffer.oldest, buffer.total - len(samples) - pre_roll)
+                        silence = 0.0
+                        if self.streaming:
+                            transcriber = StreamingTranscriber(
+                                self._transcribe, buffer, start,
+                                step_seconds=self.stream_step_seconds,
+                                stable_margin_seconds=self.stream_stable_margin_seconds,
+                                on_partial=self._publish_partial,
+                            )
+                        if hasattr(self.gui, "update_status"):
+                            self.gui.update_status("きいてるよ... 🎤")
+                    continue
+
+                silence = 0.0 if speech.any() else silence + block_seconds
+                length = (buffer.total - start) / SAMPLE_RATE
+                # 長い発話は途中で切らず、max_record_seconds を過ぎたら短い息継ぎ（無音の半分）で区切る
+                limit = self.silence_limit_seconds if length < self.max_record_seconds else self.silence_limit_seconds / 2
+                if silence >= limit or length >= self.max_utterance_seconds:
+                    self._submit_utterance(buffer, start, buffer.total, transcriber)
+                    start = transcriber = None
+        except Exception as e:
+            print(f"[STT] 常時聴取エラー: {e}")
+            traceback.print_exc()
+        finally:
+            if transcriber is not None:
+                transcriber.cancel()
+            self.listening = False
+            stream.stop_stream()
+            stream.close()
+            pa.terminate()
+
+    def _playback_active(self):
+        """VoicePlugin が発声中かどうか"""
+        if not self.pm:
+            return False
+        for p in self.pm.get_plugins():
+            is_playing = getattr(p, "is_playing", None)
+            if callable(is_playing) and is_playing():
+                return True
+        return False
+
+    def _read_block(self, stream, frames):
+        """マイクから読み、モノラル・16kHz の float32 配列にする"""
+        samples = pcm16_to_float32(stream.read(frames, exception_on_overflow=False))
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1)
+        return resample(samples, self.sample_rate, SAMPLE_RATE)
+
+    def _submit_utterance(self, buffer, start, end, transcriber=None):
+        """検出した発話を解析キューへ渡す（聴取は止めずに続ける）"""
+        if transcriber is not None:
+            job = lambda: transcriber.finish(end)
+        else:
+            samples = buffer.read(start, end)
+            job = lambda: self._transcribe_text(samples)
+        try:
+            self._utterances.put_nowait(job)
+        except queue.Full:
+            if transcriber is not None:
+                transcriber.cancel()
+            print("[STT] 解析が追いつかないため、発話を1件破棄しました")
+
+    def _utterance_worker(self):
+        while True:
+            job = self._utterances.get()
+            try:
+                text = job()
+                self._send_text(text)
+                if not text and hasattr(self.gui, "update_status"):
+                    self.gui.update_status("スタンバイ OK ✨")
+            except Exception as e:
+                print(f"[STT] 解析エラー: {e}")
+
+    def _publish_partial(self, text):
+        if self.pm:
+            self.pm.hook.on_partial_transcript(text=text)
+
+    def _wait_for_model(self):
         # --- ↓ モデルがまだロード中の場合の待機を追加 ↓ ---
-        if self.model is None:
+        if not self.model_ready.is_set():
             print("[STT] Whisperモデルのロードを待機しています...")
             if hasattr(self.gui, "update_status"):
                 self.gui.update_status("準備中... ⏳")
-            while self.model is None:
-                time.sleep(0.5)
+            self.model_ready.wait()
+
+    def _send_text(self, text):
+        if text:
+            print(f"[STT] 認識結果: 「{text}」")
+            if self.pm:
+                print(f"[STT] -> PluginManager経由でメインに送信します")
+                self.pm.hook.on_query_received(text=text)
+            else:
+                # ここが原因の可能性大！
+                print(f"[STT] !! 警告 !! self.pm が None です。送信に失敗しました。")
+        else:
+            print("[STT] 認識結果が空です")
+
+    def _transcribe_and_send(self, audio):
+        """Whisper解析とメインへの送信"""
+        self._wait_for_model()
         
         print("[STT] Whisper解析開始...")
         if hasattr(self.gui, "update_status"):
             self.gui.update_status("考え中... ⏳")
 
-        path = "temp_stt.wav"
         try:
-            with open(path, "wb") as f:
-                f.write(audio.get_wav_data())
-            
-            result = self.model.transcribe(path, language="ja")
-            text = result["text"].strip()
-            if text:
-                print(f"[STT] 認識結果: 「{text}」")
-                if self.pm:
-                    print(f"[STT] -> PluginManager経由でメインに送信します")
-                    self.pm.hook.on_query_received(text=text)
-                else:
-                    # ここが原因の可能性大！
-                    print(f"[STT] !! 警告 !! self.pm が None です。送信に失敗しました。")
-            else:
-                print("[STT] 認識結果が空です") 
-
+            self._send_text(self._transcribe_text(self._to_samples(audio)))
         except Exception as e:
             print(f"[STT] 解析エラー: {e}")
-        finally:
-            if os.path.exists(path):
-                os.remove(path)
\ No newline at end of file
+
+    def _to_samples(self, audio):
+        """AudioData -> 16kHz の float32 配列（録音形式が合っていれば変換なしで PCM をそのまま読む）"""
+        if audio.sample_rate == SAMPLE_RATE and audio.sample_width == 2:
+            raw = audio.frame_data
+        else:
+            raw = audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2)
+        return pcm16_to_float32(raw)
\ No newline at end of file
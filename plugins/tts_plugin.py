@@ -13,12 +13,15 @@ Version: v4.2.0
 """
 import re
 import pluggy
-import requests
 import json
+from core import http_client
 
 hookimpl = pluggy.HookimplMarker("komomo")
 
 class Plugin:
+    # HookDispatcher向け：audio_query/synthesis それぞれ最大60s
+    dispatch_policy = {"on_llm_response_generated": {"timeout": 120}}
+
     def __init__(self, config):
         self.config = config
         self.pm = None
@@ -46,8 +49,9 @@ class Plugin:
         
         try:
             # 1. 音声合成用のクエリ作成
-            res1 = requests.post(
+            res1 = http_client.post(
                 f"{self.url}/audio_query",
+                endpoint="voicevox",
                 params={"text": clean_text, "speaker": self.speaker_id},
                 timeout=60
             )
@@ -57,8 +61,9 @@ class Plugin:
             query_data = res1.json()
 
             # 2. 音声合成（WAV生成）実行
-            res2 = requests.post(
+            res2 = http_client.post(
                 f"{self.url}/synthesis",
+                endpoint="voicevox",
                 params={"speaker": self.speaker_id},
                 data=json.dumps(query_data),
                 timeout=60
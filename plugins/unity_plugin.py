@@ -12,13 +12,16 @@ Unity上の「こもも（3Dモデル）」と通信を行うための架け橋
 - 歌唱モーションや演出指示の同期送信
 """
 import pluggy
-import requests
 import json
+from core import http_client
 import re
 
 hookimpl = pluggy.HookimplMarker("komomo")
 
 class Plugin:
+    # HookDispatcher向け：表情送信は0.5sで諦めるため短く打ち切る
+    dispatch_policy = {"on_llm_response_generated": {"timeout": 2}}
+
     def __init__(self, config):
         self.config = config
         self.unity_url = config.get("unity_url", "http://127.0.0.1:58080/play/") 
@@ -44,8 +47,9 @@ class Plugin:
 
     def _send_audio(self, wav_data):
         try:
-            res = requests.post(
+            res = http_client.post(
                 self.unity_url,
+                endpoint="unity",
                 data=wav_data,
                 headers={"Content-Type": "audio/wav"},
                 timeout=20 # 歌のデータは大きいので少し長めに
@@ -57,7 +61,7 @@ class Plugin:
 
     def _send_expression(self, index):
         try:
-            requests.post(self.emotion_url, json={"action": "expression", "index": index}, timeout=0.5)
+            http_client.post(self.emotion_url, endpoint="unity", json={"action": "expression", "index": index}, timeout=0.5)
         except: pass
 
     def _analyze_emotion(self, text):
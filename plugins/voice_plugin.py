@@ -11,15 +11,24 @@ Unity側へのソケット送信を担当します。
 - VoiceVox APIを利用したテキストからの音声合成
 - 音声バイナリデータのUnityへのリアルタイム送信
 - 歌唱データ（WAV）の転送および再生指示
+- ストリーミング回答の文単位パイプライン（合成と再生を並行実行）
 """
-import requests
 import json
 import os
 import time
 import re
+import io
+import wave
+import queue
+import threading
 import pluggy  # NameErrorを解消するために追加
+from core import http_client
+from core.cache import LRUCache
 
 class VoicePlugin:
+    # HookDispatcher向け：合成(10s+30s)+Unity送信(5s)を上限とする
+    dispatch_policy = {"on_llm_response_generated": {"timeout": 45}}
+
     def __init__(self, config, gui):
         self.config = config
         self.gui = gui
@@ -33,6 +42,22 @@ class VoicePlugin:
         # 歌詞テキスト送信先
         self.unity_lyrics_url = "http://127.0.0.1:58080/lyrics/"
         
+        # 合成済み音声のキャッシュ（同じ文を同じ話者で再合成しない）
+        self.tts_cache = LRUCache(maxsize=config.get("tts_cache_size", 64))
+
+        # ストリーミング用パイプライン
+        # 文キュー -> 合成スレッド -> 音声キュー -> 再生スレッド の順に流れる
+        self.sentence_queue = queue.Queue()
+        self.audio_queue = queue.Queue(maxsize=2)
+        self._playback_until = 0.0
+        # 割り込み時に進める世代番号（これより古いターンの文・音声は捨てる）
+        # ターンの発話は turn_id、ターン外の発話は投入時点の世代番号で印を付ける
+        self._generation = 0
+        # 世代の判定とキューへの投入を、割り込みによる世代の更新と不可分にする
+        self._generation_lock = threading.Lock()
+        threading.Thread(target=self._synthesis_worker, daemon=True).start()
+        threading.Thread(target=self._playback_worker, daemon=True).start()
+
         print("[VoicePlugin] v4.1.9.4 Initialized (Unity-Sync Mode)")
 
     def sing(self, song_path):
@@ -47,66 +72,186 @@ class VoicePlugin:
                 song_data = f.read()
             
             # Unity側のポート 58080 へバイナリ送信
-            res = requests.post(self.unity_url, data=song_data, timeout=15)
+            res = http_client.post(self.unity_url, endpoint="unity", data=song_data, timeout=15)
             if res.status_code == 200:
                 print("[Voice] Unityへ歌唱データの送信に成功しました。")
+                # 歌唱中は発声パイプラインが次の音声を送って曲を上書きしないよう、再生中として扱う
+                self._playback_until = time.monotonic() + self._get_wav_duration(song_data)
             else:
                 print(f"[Voice] Unity送信エラー: HTTP {res.status_code}")
         except Exception as e:
             print(f"[Voice] 歌唱送信中に例外が発生: {e}")
 
-    def speak(self, text):
-        """テキストを音声合成し、Unityへ送信して再生・口パクさせる"""
+    def speak(self, text, wait=False):
+        """
+        テキストを音声合成し、Unityへ送信して再生・口パクさせる
+        ストリーミング発声と同じパイプラインに積むため、再生中の音声と重ならず、割り込みで取り消せる
+        wait=True なら、この発声（と先に積まれた発声）の再生が終わるまで戻らない
+        """
         if not text:
             return
-        
-        # 発声前に不要なタグ（(笑)など）をクリーニング
-        clean_text = self._clean_text(text)
+        print(f"[Voice] 発声リクエスト (Unity送信): {self._clean_text(text)[:20]}...")
+        self._enqueue(text)
+        if wait:
+            self.wait_until_idle()
 
-        print(f"[Voice] 発声リクエスト (Unity送信): {clean_text[:20]}...")
-        
+    def wait_until_idle(self, timeout=60.0, tail=0.3):
+        """
+        合成待ち・送信待ちの発声がなくなり、Unityでの再生も終わるまで待つ
+        時間内に終われば True、timeout 秒を超えたら False を返す
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while (self.sentence_queue.unfinished_tasks or self.audio_queue.unfinished_tasks
+               or self.is_playing(tail)):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _enqueue(self, text, turn_id=None):
+        """文を合成キューへ積む。割り込まれた古いターンの文なら捨てて False を返す"""
+        with self._generation_lock:
+            if turn_id is not None and turn_id < self._generation:
+                return False
+            self.sentence_queue.put((self._generation if turn_id is None else turn_id, text))
+            return True
+
+    def is_playing(self, tail=0.3):
+        """Unityで再生中（または再生待ちの音声がある）なら True。tail 秒は再生終了後の残響分"""
+        return time.monotonic() < self._playback_until + tail or not self.audio_queue.empty()
+
+    def _synthesize(self, clean_text):
+        """VoiceVoxで音声合成し、WAVバイナリを返す（失敗時は None）"""
+        cache_key = (self.speaker_id, clean_text)
+        cached = self.tts_cache.get(cache_key)
+        if cached is not None:
+            print(f"[Voice] 合成キャッシュを使用: {clean_text[:20]}...")
+            return cached
+
+        # 1. 音声合成用クエリ作成
+        params = (('text', clean_text), ('speaker', self.speaker_id))
+        query_res = http_client.post(f'{self.base_url}/audio_query', endpoint="voicevox", params=params, timeout=10)
+        if query_res.status_code != 200:
+            print(f"[Voice] Query Error: {query_res.status_code}")
+            return None
+        query_data = query_res.json()
+
+        # 2. 音声合成 (Synthesis)
+        synthesis_res = http_client.post(
+            f'{self.base_url}/synthesis',
+            endpoint="voicevox",
+            headers={'Content-Type': 'application/json'},
+            params={'speaker': self.speaker_id},
+            data=json.dumps(query_data)
+        )
+        if synthesis_res.status_code != 200:
+            print(f"[Voice] Synthesis Error: {synthesis_res.status_code}")
+            return None
+        self.tts_cache.put(cache_key, synthesis_res.content)
+        return synthesis_res.content
+
+    def _send_to_unity(self, wav_data):
+        """3. Unityへの送信 (口パク・再生用)"""
         try:
-            # 1. 音声合成用クエリ作成
-            params = (('text', clean_text), ('speaker', self.speaker_id))
-            query_res = requests.post(f'{self.base_url}/audio_query', params=params, timeout=10)
-            if query_res.status_code != 200:
-                print(f"[Voice] Query Error: {query_res.status_code}")
-                return
-            query_data = query_res.json()
-
-            # 2. 音声合成 (Synthesis)
-            synthesis_res = requests.post(
-                f'{self.base_url}/synthesis',
-                headers={'Content-Type': 'application/json'},
-                params={'speaker': self.speaker_id},
-                data=json.dumps(query_data),
-                timeout=30
-            )
-            if synthesis_res.status_code != 200:
-                print(f"[Voice] Synthesis Error: {synthesis_res.status_code}")
-                return
+            res = http_client.post(self.unity_url, endpoint="unity", data=wav_data)
+            if res.status_code == 200:
+                print("[Voice] Unityへ音声データを送信しました。")
+            else:
+                print(f"[Voice] Unity HTTP Error: {res.status_code}")
+        except Exception as ue:
+            print(f"[Voice] Unity連携エラー (Unityは起動していますか？): {ue}")
 
-            # 3. Unityへの送信 (口パク・再生用)
+    # --- ストリーミング発声パイプライン ---
+    def _synthesis_worker(self):
+        """文キューから取り出して合成し、再生キューへ渡す（次の文の生成と並行）"""
+        while True:
+            generation, text = self.sentence_queue.get()
             try:
-                res = requests.post(self.unity_url, data=synthesis_res.content, timeout=5)
-                if res.status_code == 200:
-                    print("[Voice] Unityへ音声データを送信しました。")
-                else:
-                    print(f"[Voice] Unity HTTP Error: {res.status_code}")
-            except Exception as ue:
-                print(f"[Voice] Unity連携エラー (Unityは起動していますか？): {ue}")
+                clean_text = self._clean_text(text)
+                if not clean_text or generation < self._generation:
+                    continue
+                wav_data = self._synthesize(clean_text)
+                if wav_data and generation >= self._generation:
+                    self.audio_queue.put((generation, wav_data))
+            except Exception as e:
+                print(f"[Voice] 文単位合成エラー: {e}")
+            finally:
+                self.sentence_queue.task_done()
 
-            print("[Voice] リクエスト処理完了")
+    def _playback_worker(self):
+        """前の文の再生が終わるのを待ってから、次の音声をUnityへ送信する"""
+        while True:
+            generation, wav_data = self.audio_queue.get()
+            try:
+                wait = self._playback_until - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                if generation < self._generation:
+                    continue
+                self._send_to_unity(wav_data)
+                self._playback_until = time.monotonic() + self._get_wav_duration(wav_data)
+                if generation < self._generation:
+                    # 送信中に割り込まれた場合、先に届いた無音WAVをこの音声が上書きしているので止め直す
+                    self._interrupt_unity()
+            finally:
+                self.audio_queue.task_done()
 
-        except Exception as e:
-            print(f"[Voice] Error: {e}")
+    def _drain(self, q):
+        """キューを空にし、取り出した件数を返す"""
+        count = 0
+        try:
+            while True:
+                q.get_nowait()
+                q.task_done()
+                count += 1
+        except queue.Empty:
+            pass
+        return count
+
+    def _interrupt(self, generation):
+        """
+        世代を進めて未合成の文・未送信の音声を破棄し、再生中ならUnityの音声を無音で上書きする
+        何かを止めた場合は True を返す
+        """
+        with self._generation_lock:
+            if generation <= self._generation:
+                return False
+            self._generation = generation
+            dropped = self._drain(self.sentence_queue) + self._drain(self.audio_queue)
+        playing = self._playback_until > time.monotonic()
+        if playing:
+            self._playback_until = 0.0
+            self._interrupt_unity()
+        return playing or dropped > 0
+
+    def _interrupt_unity(self):
+        if self.config.get("unity_interrupt_on_cancel", True):
+            threading.Thread(target=self._send_to_unity, args=(self._silent_wav(),), daemon=True).start()
+
+    def _silent_wav(self, seconds=0.05, rate=24000):
+        """Unity側の再生を上書きして止めるための短い無音WAV"""
+        buf = io.BytesIO()
+        with wave.open(buf, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(rate)
+            f.writeframes(b"\x00\x00" * int(rate * seconds))
+        return buf.getvalue()
+
+    def _get_wav_duration(self, wav_data):
+        """WAVバイナリの再生時間（秒）を返す"""
+        try:
+            with wave.open(io.BytesIO(wav_data), 'rb') as f:
+                return f.getnframes() / float(f.getframerate())
+        except Exception:
+            return 0.0
 
     def clear_lyrics(self):
         """Unity側の歌詞表示を消去する"""
         try:
             # 空の文字列を送信して、表示を消す
             payload = {"text": ""}
-            res = requests.post(self.unity_lyrics_url, json=payload, timeout=5)
+            res = http_client.post(self.unity_lyrics_url, endpoint="unity", json=payload)
             if res.status_code == 200:
                 print("[Voice] Unityの歌詞表示をクリアしました。")
         except Exception as e:
@@ -120,9 +265,38 @@ class VoicePlugin:
         return text.strip()
 
     @pluggy.HookimplMarker("komomo")
-    def on_llm_response_generated(self, response_text):
+    def on_llm_response_generated(self, response_text, turn_id):
         """
         PluginManager経由で呼ばれるフック
-        LLMの回答が生成されたら自動的に発声を開始する
+        LLMの回答が生成されたら自動的に発声を開始する（配送中に割り込まれたターンの回答は喋らない）
+        """
+        if not response_text:
+            return
+        print(f"[Voice] 発声リクエスト (Unity送信): {self._clean_text(response_text)[:20]}...")
+        self._enqueue(response_text, turn_id)
+
+    @pluggy.HookimplMarker("komomo")
+    def on_llm_sentence_generated(self, sentence_text, turn_id):
+        """
+        ストリーミング回答の1文ごとに呼ばれるフック
+        生成の続きを待たずに合成パイプラインへ投入する
+        """
+        self._enqueue(sentence_text, turn_id)
+
+    @pluggy.HookimplMarker("komomo")
+    def on_turn_cancelled(self, turn_id):
+        """
+        割り込みで取り消されたターンの発声を止める
+        未合成の文・未送信の音声を破棄し、再生中ならUnityの音声を無音で上書きする
+        """
+        self._interrupt(turn_id + 1)
+        print(f"[Voice] ターン #{turn_id} の発声を取り消しました")
+
+    @pluggy.HookimplMarker("komomo")
+    def on_barge_in(self, turn_id):
+        """
+        新しい発話の受付時に呼ばれるフック
+        ターン自体は完了していても、前の回答の合成・再生が残っていれば止める
         """
-        self.speak(response_text)
\ No newline at end of file
+        if self._interrupt(turn_id):
+            print(f"[Voice] 新しい発話 #{turn_id} のため、前の回答の発声を止めました")
@@ -0,0 +1,68 @@
+"""
+Komomo System Tool - Memory Re-Embedder
+Version: v1.0.0
+
+[役割]
+保存済みの「思い出」をすべて指定した埋め込みモデルでベクトル化し直します。
+埋め込みモデルを切り替えた（config.json の embedding_model を変更した）後に実行してください。
+
+[主な機能]
+- config.json の memory_store（chroma / numpy）に応じた記憶ストアの全件再埋め込み
+- EmbeddingService によるバッチ推論（計算結果は埋め込みキャッシュにも保存）
+- 実行前の確認プロセス(y/n)
+
+[使い方]
+python reembed.py                 # config.json の embedding_model で再埋め込み
+python reembed.py --model NAME    # 指定したモデルで再埋め込み（完了後 config.json も書き換えてください）
+"""
+import argparse
+import json
+import time
+
+from core.embedding import EmbeddingService
+from core.memory_db import MemoryDB
+from core.memory_store import create_memory_store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Komomo Memory Re-Embedder")
+    parser.add_argument("--model", help="埋め込みモデル名（省略時は config.json の embedding_model）")
+    parser.add_argument("--batch", type=int, default=256, help="1回に読み込む思い出の件数")
+    args = parser.parse_args()
+
+    with open("config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+    model = args.model or config.get("embedding_model", "default")
+
+    print("=== Komomo Memory Re-Embedder ===")
+    print(f"記憶ストア : {config.get('memory_store', 'chroma')}")
+    print(f"埋め込みモデル: {model}")
+
+    db = MemoryDB("komomo_v4_memory.db")
+    embedding = EmbeddingService(
+        db,
+        model=model,
+        batch_size=config.get("embedding_batch_size", 32),
+        batch_workers=config.get("embedding_threads", 2),
+        use_chromadb=config.get("memory_store", "chroma") != "numpy",
+    )
+    store = create_memory_store(config, embedding.embed, db)
+    print(f"対象の思い出: {store.count()} 件")
+
+    confirm = input("\nすべての思い出をこのモデルで再埋め込みしますか？ (y/n): ")
+    if confirm.lower() != 'y':
+        print("\n再埋め込みをキャンセルしました。")
+        db.close()
+        return
+
+    started = time.perf_counter()
+    total = store.reembed(batch_size=args.batch)
+    elapsed = time.perf_counter() - started
+    db.close()
+    print(f"\n再埋め込みが完了しました: {total} 件 ({elapsed:.1f}s, 新規計算 {embedding.stats['computed']} 件)")
+    if model != config.get("embedding_model", "default"):
+        print(f"config.json の embedding_model を \"{model}\" に変更してから起動してください。")
+
+
+if __name__ == "__main__":
+    main()
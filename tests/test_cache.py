@@ -0,0 +1,46 @@
+import time
+
+from core.cache import LRUCache, ResponseCache, is_context_dependent, normalize_query
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_lru_entries_expire_after_ttl():
+    cache = LRUCache(maxsize=4, ttl=0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.08)
+    assert cache.get("a") is None
+    assert cache.items() == []
+
+
+def test_response_cache_is_keyed_by_normalized_query_and_context():
+    cache = ResponseCache(maxsize=8, ttl=60)
+    cache.put("おはよう！", ["キャラ設定", "プロフィールv1"], "おはよう、あっきー")
+    assert cache.get("おはよう", ["キャラ設定", "プロフィールv1"]) == "おはよう、あっきー"
+    assert cache.get("おはよう", ["キャラ設定", "プロフィールv2"]) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_response_cache_similarity_hit_stays_within_context():
+    vectors = {"今日の天気は": [1.0, 0.0], "今日の天気を教えて": [0.99, 0.1], "好きな食べ物は": [0.0, 1.0]}
+    cache = ResponseCache(similarity_threshold=0.95, embed_fn=lambda texts: [vectors[t] for t in texts])
+    cache.put("今日の天気は？", ["ctx"], "晴れだよ")
+    assert cache.get("今日の天気を教えて", ["ctx"]) == "晴れだよ"
+    assert cache.get("今日の天気を教えて", ["other"]) is None
+    assert cache.get("好きな食べ物は", ["ctx"]) is None
+    assert cache.semantic_hits == 1
+
+
+def test_short_or_deictic_queries_are_context_dependent():
+    assert is_context_dependent(normalize_query("うん"))
+    assert is_context_dependent(normalize_query("それってなんで？"))
+    assert not is_context_dependent(normalize_query("今日の天気は？"))
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+from core.consolidation import MemoryConsolidator
+from core.memory_db import MemoryDB
+from core.memory_store import MemoryStore
+
+
+class DictMemoryStore(MemoryStore):
+    """埋め込みを計算しない、辞書だけの記憶ストア"""
+
+    def __init__(self):
+        self.items = {}
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        metadatas = metadatas or [None] * len(ids)
+        for mem_id, doc, meta in zip(ids, documents, metadatas):
+            self.items.setdefault(mem_id, (doc, meta or {}))
+
+    def delete(self, ids):
+        for mem_id in ids:
+            self.items.pop(mem_id, None)
+
+    def count(self):
+        return len(self.items)
+
+    def metadata_items(self):
+        return [(mem_id, meta) for mem_id, (_, meta) in self.items.items()]
+
+
+def _add_turns(db, store, day, texts):
+    for text in texts:
+        db.execute(
+            "INSERT INTO conversation_history (user_text, ai_response, created_at) VALUES (?, ?, ?)",
+            (text, "うん", f"{day}T12:00:00"),
+        )
+        history_id = db.fetchone("SELECT max(id) FROM conversation_history")[0]
+        store.add([f"mem_{history_id}"], [text], [{"timestamp": f"{day}T12:00:00", "history_id": history_id}])
+
+
+def test_reconsolidating_a_day_keeps_earlier_summaries(tmp_path):
+    db = MemoryDB(str(tmp_path / "memory.db"))
+    db.init_schema()
+    store = DictMemoryStore()
+    consolidator = MemoryConsolidator(db, store, lambda day, turns: " / ".join(u for u, _ in turns),
+                                      retention_days=None)
+    day = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    try:
+        _add_turns(db, store, day, ["朝ごはん", "散歩"])
+        consolidator.run()
+        # 要約済みの日に、遅れて分析された会話が後から追加される
+        _add_turns(db, store, day, ["夕ごはん"])
+        consolidator.run()
+
+        summaries = sorted(doc for doc, meta in store.items.values() if meta.get("kind") == "summary")
+        assert summaries == [f"{day}の思い出: 夕ごはん", f"{day}の思い出: 朝ごはん / 散歩"]
+        assert all(meta.get("kind") == "summary" for _, meta in store.metadata_items())
+        assert db.fetchone("SELECT count(*) FROM memory_summaries WHERE day = ?", (day,))[0] == 2
+        assert db.fetchone("SELECT count(*) FROM conversation_history WHERE consolidated = 0")[0] == 0
+    finally:
+        db.close()
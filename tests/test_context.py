@@ -0,0 +1,41 @@
+import threading
+import time
+
+from core.context import ContextAssembler
+
+
+def test_slow_source_is_cut_at_its_deadline():
+    assembler = ContextAssembler(default_deadline=0.5, deadlines={"slow": 0.05})
+    release = threading.Event()
+    results = assembler.assemble({"fast": lambda: "f", "slow": lambda: release.wait(2) and "s"}, default=None)
+    release.set()
+    assert results == {"fast": "f", "slow": None}
+    assert assembler.last_report["sources"]["slow"]["status"] == "timeout"
+
+
+def test_back_to_back_turns_keep_sources_that_have_not_timed_out():
+    assembler = ContextAssembler(default_deadline=1.0, max_workers=4)
+
+    def slowish():
+        time.sleep(0.1)
+        return "recent"
+
+    previous = threading.Thread(target=assembler.assemble, args=({"recent": slowish},))
+    previous.start()
+    time.sleep(0.02)
+    # 前のターンの取得が締め切り内で実行中でも、このターンの分は改めて取得する
+    assert assembler.assemble({"recent": slowish}) == {"recent": "recent"}
+    previous.join()
+
+
+def test_timed_out_source_is_skipped_until_it_finishes():
+    assembler = ContextAssembler(default_deadline=0.05)
+    release = threading.Event()
+    assembler.assemble({"semantic": lambda: release.wait(2)})
+    assert assembler.last_report["sources"]["semantic"]["status"] == "timeout"
+    assembler.assemble({"semantic": lambda: "again"})
+    assert assembler.last_report["sources"]["semantic"]["status"] == "busy"
+
+    release.set()
+    time.sleep(0.05)
+    assert assembler.assemble({"semantic": lambda: "again"}) == {"semantic": "again"}
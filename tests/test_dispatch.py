@@ -0,0 +1,86 @@
+import threading
+import time
+
+import pluggy
+
+from core.dispatch import HookDispatcher
+from core.specs import KomomoSpecs
+
+hookimpl = pluggy.HookimplMarker("komomo")
+
+
+def _dispatcher(*plugins, **kwargs):
+    pm = pluggy.PluginManager("komomo")
+    pm.add_hookspecs(KomomoSpecs)
+    for plugin in plugins:
+        pm.register(plugin)
+    return HookDispatcher(pm, **kwargs)
+
+
+class Recorder:
+    def __init__(self, log, delay=0.0, dispatch_policy=None):
+        self.log = log
+        self.delay = delay
+        self.dispatch_policy = dispatch_policy or {}
+
+    @hookimpl
+    def on_llm_stream_completed(self, response_text):
+        time.sleep(self.delay)
+        self.log.append((type(self).__name__, response_text))
+
+
+class GUIPlugin(Recorder):
+    pass
+
+
+class VoicePlugin(Recorder):
+    pass
+
+
+class Blocker:
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    @hookimpl
+    def on_llm_stream_completed(self, response_text):
+        self.calls += 1
+        self.release.wait(5)
+
+
+def test_after_runs_the_dependency_first():
+    log = []
+    gui = GUIPlugin(log, delay=0.05)
+    voice = VoicePlugin(log, dispatch_policy={"on_llm_stream_completed": {"after": ["GUIPlugin"]}})
+    run = _dispatcher(voice, gui).fire("on_llm_stream_completed", response_text="hi")
+    assert run.wait(2)
+    assert [name for name, _ in log] == ["GUIPlugin", "VoicePlugin"]
+
+
+def test_timeout_settles_without_waiting_for_slow_subscriber():
+    log = []
+    slow = GUIPlugin(log, delay=0.5, dispatch_policy={"on_llm_stream_completed": {"timeout": 0.05}})
+    fast = VoicePlugin(log)
+    run = _dispatcher(slow, fast).fire("on_llm_stream_completed", response_text="hi")
+    assert run.wait(0.3)
+    assert run.report["GUIPlugin"]["status"] == "timeout"
+    assert run.report["VoicePlugin"]["status"] == "ok"
+
+
+def test_stuck_subscriber_is_skipped_until_it_returns():
+    blocker = Blocker()
+    dispatcher = _dispatcher(blocker, default_timeout=0.05, max_stuck=1)
+    assert dispatcher.fire("on_llm_stream_completed", response_text="1").wait(1)
+    assert dispatcher.stats()["stuck_total"] == 1
+
+    dispatcher.fire("on_llm_stream_completed", response_text="2").wait(1)
+    assert blocker.calls == 1
+    assert dispatcher.stats()["skipped"] == 1
+
+    blocker.release.set()
+    deadline = time.monotonic() + 1
+    while dispatcher.stats()["stuck_total"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert dispatcher.stats()["stuck_total"] == 0
+    dispatcher.fire("on_llm_stream_completed", response_text="3").wait(1)
+    assert blocker.calls == 2
@@ -0,0 +1,42 @@
+from plugins.ego_plugin import EgoPlugin
+from core.memory_db import MemoryDB
+
+
+def _ego(db, save_ok):
+    """分析キューの処理に必要な部分だけを持つ EgoPlugin"""
+    ego = EgoPlugin.__new__(EgoPlugin)
+    ego.db = db
+    ego.analysis_max_attempts = 3
+    ego.analysis_max_save_attempts = 2
+    ego._latest_queue_id = None
+    ego._save_to_db = lambda *args, **kwargs: save_ok
+    return ego
+
+
+def test_expired_row_that_cannot_be_saved_leaves_the_queue(tmp_path):
+    db = MemoryDB(str(tmp_path / "memory.db"))
+    db.init_schema()
+    try:
+        db.execute("INSERT INTO analysis_queue (user_text, ai_response, attempts, created_at) "
+                   "VALUES ('壊れた会話', 'うん', 3, '2026-01-01T00:00:00')")
+        ego = _ego(db, save_ok=False)
+
+        assert ego._process_batch(ego._fetch_pending(4)) is False
+        assert db.fetchone("SELECT attempts FROM analysis_queue")[0] == 4
+        assert ego._process_batch(ego._fetch_pending(4)) is False
+        # 保存の再試行も上限に達したので、先頭に居座らずキューから外れる
+        assert ego._fetch_pending(4) == []
+    finally:
+        db.close()
+
+
+def test_expired_row_is_saved_without_analysis(tmp_path):
+    db = MemoryDB(str(tmp_path / "memory.db"))
+    db.init_schema()
+    try:
+        db.execute("INSERT INTO analysis_queue (user_text, ai_response, attempts, created_at) "
+                   "VALUES ('こんにちは', 'やっほー', 3, '2026-01-01T00:00:00')")
+        ego = _ego(db, save_ok=True)
+        assert ego._process_batch(ego._fetch_pending(4)) is True
+    finally:
+        db.close()
@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from core.consolidation import MemoryConsolidator
+from core.memory_db import MemoryDB
+from core.memory_store import NumpyMemoryStore
+from memory_io import MemoryImporter, export_file, read_records
+
+
+def _embed(texts):
+    return [[float(len(t)), 1.0, 0.5] for t in texts]
+
+
+def _open_store(tmp_path, name):
+    db = MemoryDB(str(tmp_path / f"{name}.db"))
+    db.init_schema()
+    store = NumpyMemoryStore(_embed, db, matrix_path=str(tmp_path / f"{name}.npy"))
+    return db, store
+
+
+def test_round_trip_keeps_consolidated_days(tmp_path):
+    source_db, source_store = _open_store(tmp_path, "source")
+    target_db, target_store = _open_store(tmp_path, "target")
+    old_day = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    today = datetime.now().strftime("%Y-%m-%d")
+    try:
+        for i, (day, text) in enumerate([(old_day, "朝ごはん"), (old_day, "散歩"), (today, "映画")], start=1):
+            source_db.execute("INSERT INTO conversation_history (user_text, ai_response, created_at) VALUES (?, ?, ?)",
+                              (text, "うん", f"{day}T12:00:0{i}"))
+            source_store.add([f"mem_{i}"], [text], [{"timestamp": f"{day}T12:00:0{i}", "history_id": i}])
+        consolidator = MemoryConsolidator(source_db, source_store, lambda day, turns: "いろいろ", retention_days=None)
+        consolidator.run()
+        assert source_store.count() == 2  # 要約1件 + 未要約の1往復
+
+        path = str(tmp_path / "memories.jsonl.gz")
+        export_file(path, source_db, source_store, "test-model")
+        embedding = SimpleNamespace(model="test-model", embed=_embed)
+        MemoryImporter(target_db, target_store, embedding).run(read_records(path))
+
+        rows = target_db.fetchall("SELECT user_text, consolidated FROM conversation_history ORDER BY created_at")
+        assert rows == [("朝ごはん", 1), ("散歩", 1), ("映画", 0)]
+        assert target_store.count() == source_store.count()
+
+        # 取り込み先で整理し直しても、要約済みの日を上書き・重複させない
+        MemoryConsolidator(target_db, target_store, lambda day, turns: "別の要約", retention_days=None).run()
+        assert target_store.count() == source_store.count()
+        assert [meta.get("kind") for _, meta in target_store.metadata_items()].count("summary") == 1
+    finally:
+        source_db.close()
+        target_db.close()
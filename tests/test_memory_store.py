@@ -0,0 +1,70 @@
+import numpy as np
+
+from core.memory_db import MemoryDB
+from core.memory_store import NumpyMemoryStore
+
+VECTORS = {
+    "ラーメンが好き": [1.0, 0.0, 0.0],
+    "犬を飼っている": [0.0, 1.0, 0.0],
+    "海へ行った": [0.0, 0.0, 1.0],
+    "ラーメン": [0.9, 0.1, 0.0],
+}
+
+
+def _embed(texts):
+    return [VECTORS.get(t, [0.5, 0.5, 0.5]) for t in texts]
+
+
+def _open_store(tmp_path, initial_capacity=1024):
+    db = MemoryDB(str(tmp_path / "memory.db"))
+    db.init_schema()
+    return db, NumpyMemoryStore(_embed, db, matrix_path=str(tmp_path / "vectors.npy"),
+                                initial_capacity=initial_capacity)
+
+
+def test_add_and_query_by_similarity(tmp_path):
+    db, store = _open_store(tmp_path)
+    store.add(["m1", "m2", "m3"], ["ラーメンが好き", "犬を飼っている", "海へ行った"],
+              [{"date": "1"}, {"date": "2"}, None])
+    # 同じIDは追加し直さない
+    store.add(["m1"], ["別の内容"])
+
+    assert store.count() == 3
+    results = store.query_items("ラーメン", n_results=2)
+    assert results[0] == ("ラーメンが好き", {"date": "1"})
+    assert len(results) == 2
+    db.close()
+
+
+def test_deleted_rows_are_hidden_and_reused(tmp_path):
+    db, store = _open_store(tmp_path)
+    store.add(["m1", "m2"], ["ラーメンが好き", "犬を飼っている"])
+    store.delete(["m1"])
+
+    assert store.count() == 1
+    assert [doc for doc, _ in store.query_items("ラーメン", n_results=5)] == ["犬を飼っている"]
+
+    store.add(["m3"], ["海へ行った"])
+    # 削除済みの行を再利用するので行列は伸びない
+    assert store._size == 2
+    assert [mem_id for mem_id, _ in store.metadata_items()] == ["m3", "m2"]
+    assert [doc for doc, _ in store.query_items("ラーメン", n_results=5)] != ["ラーメンが好き"]
+    db.close()
+
+
+def test_matrix_grows_past_initial_capacity_and_reloads(tmp_path):
+    db, store = _open_store(tmp_path, initial_capacity=2)
+    ids = [f"m{i}" for i in range(5)]
+    store.add(ids, [f"思い出{i}" for i in range(5)], embeddings=[[float(i), 1.0, 0.0] for i in range(5)])
+
+    assert store._matrix.shape[0] == 8
+    assert store.count() == 5
+    vectors = {mem_id: vector for mem_id, _, _, vector in store.iter_items(batch_size=2)}
+    assert set(vectors) == set(ids)
+    assert np.allclose(np.linalg.norm(vectors["m4"]), 1.0)
+    db.close()
+
+    db, reopened = _open_store(tmp_path, initial_capacity=2)
+    assert reopened.count() == 5
+    assert reopened.query_items("思い出", n_results=1)
+    db.close()
@@ -0,0 +1,46 @@
+from core.memory_writer import BufferedMemoryWriter
+
+
+class FlakyStore:
+    def __init__(self, failures):
+        self.failures = failures
+        self.added = []
+
+    def add(self, ids, documents, metadatas=None, embeddings=None):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("database is locked")
+        self.added.extend(documents)
+
+
+def test_failed_batch_is_retried_on_next_flush():
+    store = FlakyStore(failures=1)
+    writer = BufferedMemoryWriter(store, max_batch=100, max_delay=60)
+    writer.add("a")
+    writer.add("b")
+    assert writer.flush() == 0
+    assert writer.pending() == 2
+    assert writer.flush() == 2
+    assert store.added == ["a", "b"]
+    writer.close()
+
+
+def test_items_are_dropped_after_max_attempts():
+    store = FlakyStore(failures=10)
+    writer = BufferedMemoryWriter(store, max_batch=100, max_delay=60, max_attempts=2)
+    writer.add("bad")
+    writer.flush()
+    writer.flush()
+    assert writer.pending() == 0
+    assert writer.metrics()["dropped"] == 1
+    writer.close()
+
+
+def test_buffer_is_capped_and_drops_oldest():
+    store = FlakyStore(failures=3)
+    writer = BufferedMemoryWriter(store, max_batch=3, max_delay=60, max_attempts=10, max_buffer=4)
+    for text in "abcdef":
+        writer.add(text)
+    assert store.added == list("bcdef")
+    assert writer.metrics()["dropped"] == 1
+    writer.close()
@@ -0,0 +1,52 @@
+from core.prompt import PromptBuilder, render_dialogue
+
+INSTRUCTION = "あなたは「こもも」です。"
+RULES = "思い出は必要な時だけ使ってください。"
+
+
+def test_prompt_stays_within_budget_and_keeps_latest_turns():
+    builder = PromptBuilder(token_budget=200)
+    recent = [(f"質問{i}" * 5, f"答え{i}" * 5) for i in range(10)]
+    docs = [f"思い出{i}" * 10 for i in range(10)]
+    prompt = builder.build(INSTRUCTION, RULES, recent_items=recent, semantic_docs=docs)
+
+    assert prompt.tokens <= 200
+    assert builder.count_tokens(prompt.text) <= 200
+    kept_recent, total_recent = builder.last_report["recent"]
+    assert kept_recent < total_recent
+    # 直近2往復は予算が足りる限り必ず残る
+    assert render_dialogue(*recent[-1]) in prompt.suffix
+    assert render_dialogue(*recent[-2]) in prompt.suffix
+
+
+def test_memories_already_in_recent_dialogue_are_deduplicated():
+    builder = PromptBuilder()
+    recent = [("好きな色は？", "青だよ")]
+    docs = [render_dialogue("好きな色は？", "青だよ"), "犬を飼っている", "犬を 飼っている"]
+    prompt = builder.build(INSTRUCTION, RULES, recent_items=recent, semantic_docs=docs)
+
+    assert builder.last_report["deduplicated"] == 2
+    assert builder.last_report["semantic"] == (1, 1)
+    assert prompt.suffix.count("犬を") == 1
+
+
+def test_prefix_is_byte_stable_until_profile_changes():
+    builder = PromptBuilder()
+    profile = [("名前", "あっきー"), ("好物", "ラーメン")]
+    first = builder.build(INSTRUCTION, RULES, profile, recent_items=[("a", "b")], semantic_docs=["x"])
+    second = builder.build(INSTRUCTION, RULES, profile, recent_items=[("c", "d")], semantic_docs=["y"])
+    assert first.prefix == second.prefix
+    assert first.suffix != second.suffix
+    assert first.profile_version == second.profile_version
+
+    third = builder.build(INSTRUCTION, RULES, [("名前", "あっきー"), ("好物", "うどん")])
+    assert third.prefix != first.prefix
+    assert third.profile_version == first.profile_version + 1
+
+
+def test_profile_is_trimmed_to_its_own_budget():
+    builder = PromptBuilder(token_budget=300, profile_budget=80)
+    profile = [(f"項目{i}", "とても長い値" * 3) for i in range(10)]
+    builder.build(INSTRUCTION, RULES, profile)
+    kept, total = builder.last_report["profile"]
+    assert 0 < kept < total
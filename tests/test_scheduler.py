@@ -0,0 +1,61 @@
+import threading
+
+from core.scheduler import TurnScheduler
+
+
+class Handler:
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.seen = []
+
+    def __call__(self, turn):
+        self.seen.append(turn.text)
+        self.started.set()
+        # 取り消されるか解放されるまで処理中のまま
+        while not (turn.cancelled or self.release.is_set()):
+            self.release.wait(0.01)
+
+
+def test_new_turn_cancels_the_running_turn():
+    handler = Handler()
+    cancelled, barge_ins = [], []
+    scheduler = TurnScheduler(handler, on_cancel=lambda t: cancelled.append(t.id),
+                              on_barge_in=lambda t: barge_ins.append(t.id))
+    first = scheduler.submit("おはよう")
+    assert handler.started.wait(1)
+    second = scheduler.submit("やっぱりこんばんは")
+
+    assert first.cancelled and not second.cancelled
+    assert cancelled == [first.id]
+    # 割り込みの通知は、取り消すターンがなくても受付ごとに届く
+    assert barge_ins == [first.id, second.id]
+    handler.release.set()
+    scheduler.queue.join()
+    assert handler.seen == ["おはよう", "やっぱりこんばんは"]
+
+
+def test_cancelled_waiting_turns_do_not_block_new_input():
+    handler = Handler()
+    scheduler = TurnScheduler(handler, max_queue=1)
+    scheduler.submit("1")
+    assert handler.started.wait(1)
+    handler.started.clear()
+    # 待機中の取り消し済みターンはキューから取り除かれ、新しい発話は拒否されない
+    assert scheduler.submit("2") is not None
+    assert scheduler.submit("3") is not None
+    handler.release.set()
+    scheduler.queue.join()
+    assert "2" not in handler.seen and handler.seen[-1] == "3"
+
+
+def test_full_queue_rejects_input_without_barge_in():
+    handler = Handler()
+    scheduler = TurnScheduler(handler, max_queue=1, barge_in=False)
+    scheduler.submit("1")
+    assert handler.started.wait(1)
+    assert scheduler.submit("2") is not None
+    assert scheduler.submit("3") is None
+    handler.release.set()
+    scheduler.queue.join()
+    assert handler.seen == ["1", "2"]